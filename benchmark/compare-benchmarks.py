@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import json
+import sys
+
+DEFAULT_THRESHOLD = 10.0
+DEFAULT_MIN_TIME = 0.05
+
+
+def main(arg_list=None):
+    args = parse_args(arg_list)
+
+    baseline = json.load(args.baseline)
+    results = json.load(args.results)
+    print("Comparing {0} ({1}) with baseline {2} ({3})".format(args.results.name, results.get('revision'),
+                                                               args.baseline.name, baseline.get('revision')))
+
+    regressions = 0
+    for size, steps in results['sizes'].items():
+        baseline_steps = baseline['sizes'].get(size)
+        if baseline_steps is None:
+            print("\n{0}: not in baseline".format(size))
+            continue
+
+        print("\n{0:<72} {1:>10} {2:>10} {3:>8}".format(size, 'baseline', 'current', 'change'))
+        for step_name, step in steps.items():
+            baseline_step = baseline_steps.get(step_name)
+            if baseline_step is None:
+                continue
+            for name, baseline_value, value, unit in get_comparisons(step_name, baseline_step, step, args.min_time):
+                change = (value - baseline_value) / baseline_value * 100 if baseline_value else 0.0
+                regressed = change > args.threshold
+                regressions += regressed
+                print("{0:<72} {1:>9.3f}{4} {2:>9.3f}{4} {3:>+7.1f}% {5}".format(
+                    name[:72], baseline_value, value, change, unit, '<-- regressed' if regressed else ''))
+
+    print("\n{0} regression(s) of more than {1}%".format(regressions, args.threshold))
+    if regressions and args.fail_on_regression:
+        sys.exit(1)
+
+
+def parse_args(arg_list):
+    parser = argparse.ArgumentParser(description='Compare two benchmark results, flagging phases that got slower')
+    parser.add_argument('baseline',
+                        help='JSON results of the baseline run',
+                        type=argparse.FileType('r'))
+    parser.add_argument('results',
+                        help='JSON results of the run to compare with the baseline',
+                        type=argparse.FileType('r'))
+    parser.add_argument('--threshold', '-t',
+                        help='Percentage a time or memory figure has to grow by to count as a regression '
+                             '[%(default)s]',
+                        dest='threshold',
+                        type=float,
+                        default=DEFAULT_THRESHOLD)
+    parser.add_argument('--min-time',
+                        help='Phases and statements quicker than this many seconds in both runs are not compared, '
+                             'as they are mostly noise [%(default)s]',
+                        dest='min_time',
+                        type=float,
+                        default=DEFAULT_MIN_TIME)
+    parser.add_argument('--fail-on-regression',
+                        help='Exit with a non-zero status if anything regressed',
+                        dest='fail_on_regression',
+                        action='store_true')
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def get_comparisons(step_name, baseline_step, step, min_time):
+    # Yields (name, baseline value, current value, unit) for the step as a whole, each of its phases and each of its
+    # SQL statements, matched up by name
+    yield step_name, baseline_step['wall_time'], step['wall_time'], 's'
+    yield step_name + ' peak RSS', baseline_step['peak_rss_kb'] / 1024.0, step['peak_rss_kb'] / 1024.0, 'M'
+
+    for kind, key, label in [('phases', 'name', '{0}'), ('statements', 'statement', 'SQL {0}')]:
+        baseline_times = get_times(baseline_step['report'][kind], key)
+        for name, elapsed in get_times(step['report'][kind], key).items():
+            baseline_elapsed = baseline_times.get(name)
+            if baseline_elapsed is None or max(baseline_elapsed, elapsed) < min_time:
+                continue
+            yield '  ' + label.format(name), baseline_elapsed, elapsed, 's'
+
+
+def get_times(entries, key):
+    times = collections.OrderedDict()
+    for entry in entries:
+        times[entry[key]] = times.get(entry[key], 0.0) + entry['elapsed']
+    return times
+
+
+if __name__ == '__main__':
+    main()
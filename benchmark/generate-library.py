@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import datetime
+import importlib
+import itertools
+import logging
+import os
+import random
+import sys
+from urllib.parse import quote
+
+# Libraries are written with the exporter's plist writer, so the XML benchmarked is escaped and formatted like its
+# output
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+export_to_playlist = importlib.import_module('export-to-playlist')
+
+DEFAULT_TRACKS = '10k'
+DEFAULT_DAYS = 3
+DEFAULT_SEED = 1
+DEFAULT_OUTPUT_DIR = '.'
+DEFAULT_BASE_DATE = datetime.datetime(2019, 3, 1)
+
+TRACK_COUNT_SUFFIXES = {'k': 1000, 'm': 1000000}
+TRACKS_PER_ARTIST = 40
+NEW_TRACKS_PER_DAY = 0.001
+MUSIC_FOLDER = 'file:///Users/stephan/Music/iTunes/iTunes%20Media/'
+MAC_EPOCH = datetime.datetime(1904, 1, 1)
+GENRES = ['Rock', 'Pop', 'Alternative', 'Electronic', 'Hip-Hop/Rap', 'Jazz', 'Classical', 'Soundtrack', 'Metal',
+          'R&B/Soul', 'Folk', 'Country', 'Dance', 'Indie Rock', 'Singer/Songwriter']
+WORDS = ['Love', 'Night', 'Blue', 'Fire', 'Heart', 'Dream', 'Summer', 'Road', 'Light', 'Rain', 'Gold', 'Ghost',
+         'River', 'Echo', 'Wild', 'Star', 'Electric', 'Paper', 'Silver', 'Shadow', 'Ocean', 'Glass', 'Neon', 'Stone',
+         'Sweet', 'Broken', 'Secret', 'Midnight', 'Velvet', 'Thunder', 'Café', 'Señor', 'Über', 'Rock & Roll', '<3']
+
+
+def main(arg_list=None):
+    args = parse_args(arg_list)
+
+    track_count = parse_track_count(args.tracks)
+    for day, file_name in enumerate(generate_libraries(track_count, args.days, args.seed, args.output_dir)):
+        logging.warning("Generated day %s library with %s tracks at location: %s", day, track_count, file_name)
+
+
+def parse_args(arg_list):
+    parser = argparse.ArgumentParser(description='Generate synthetic iTunes Library XML files for benchmarking')
+    parser.add_argument('--tracks', '-t',
+                        help='Number of tracks in the library, e.g. 1k, 10k, 100k or 1m [%(default)s]',
+                        dest='tracks',
+                        default=DEFAULT_TRACKS)
+    parser.add_argument('--days',
+                        help='Number of "next day" variants to generate after the initial library [%(default)s]',
+                        dest='days',
+                        type=int,
+                        default=DEFAULT_DAYS)
+    parser.add_argument('--seed',
+                        help='Random seed, the same seed always generates the same libraries [%(default)s]',
+                        dest='seed',
+                        type=int,
+                        default=DEFAULT_SEED)
+    parser.add_argument('--output-dir', '-o',
+                        help='Directory to write the library files to [%(default)s]',
+                        dest='output_dir',
+                        default=DEFAULT_OUTPUT_DIR)
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def parse_track_count(tracks):
+    tracks = str(tracks).lower()
+    if tracks[-1:] in TRACK_COUNT_SUFFIXES:
+        return int(float(tracks[:-1]) * TRACK_COUNT_SUFFIXES[tracks[-1]])
+    return int(tracks)
+
+
+def get_library_file_name(output_dir, track_count, seed, day):
+    return os.path.join(output_dir, 'library-{0}-seed{1}-day{2}.xml'.format(track_count, seed, day))
+
+
+def generate_libraries(track_count, days=DEFAULT_DAYS, seed=DEFAULT_SEED, output_dir=DEFAULT_OUTPUT_DIR):
+    # Yields the file name of the initial library and each of its next day variants. Files that already exist are
+    # not generated again, as the same arguments always produce the same files.
+    os.makedirs(output_dir, exist_ok=True)
+    catalog = generate_catalog(track_count, seed)
+    plays = [generate_initial_plays(index, seed) for index in range(track_count)]
+
+    for day in range(days + 1):
+        if day > 0:
+            # A few tracks are added to the library each day, as well as the day's plays
+            plays.extend(None for _ in range(max(int(track_count * NEW_TRACKS_PER_DAY), 1)))
+            play_day(plays, seed, day)
+
+        file_name = get_library_file_name(output_dir, track_count, seed, day)
+        if not os.path.exists(file_name):
+            with open(file_name + '.tmp', 'w', encoding='utf-8') as fp:
+                write_library(fp, catalog, plays, seed, DEFAULT_BASE_DATE + datetime.timedelta(days=day))
+            os.replace(file_name + '.tmp', file_name)
+        yield file_name
+
+
+def generate_catalog(track_count, seed):
+    # Artists have Zipf-like popularity, so a few artists have most of the tracks and most artists only have a few,
+    # and each artist's albums are similarly skewed
+    rng = random.Random(seed)
+    artist_count = max(track_count // TRACKS_PER_ARTIST, 1)
+    artists = []
+    for index in range(artist_count):
+        album_count = min(1 + int(rng.paretovariate(1.5)), 30)
+        album_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(album_count)))
+        albums = [{'name': get_title(rng, 3),
+                   'year': rng.randint(1960, 2019),
+                   'genre': rng.choice(GENRES),
+                   'compilation': rng.random() < 0.03}
+                  for _ in range(album_count)]
+        artists.append({'name': get_title(rng, 2) + ' ' + str(index),
+                        'albums': albums,
+                        'album_weights': album_weights})
+    return {'artists': artists,
+            'artist_weights': list(itertools.accumulate(1.0 / (rank + 1) ** 0.8 for rank in range(artist_count)))}
+
+
+def get_title(rng, max_words):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, max_words)))
+
+
+def get_track_random(seed, index, stream):
+    # Each track has its own random streams, so a track is the same in every library generated with the same seed
+    return random.Random((seed * 1000003 + index) * 2 + stream)
+
+
+def generate_initial_plays(index, seed):
+    rng = get_track_random(seed, index, 0)
+    play_count = min(int(rng.paretovariate(0.9)) - 1, 500)
+    if play_count == 0:
+        return None
+    played_at = DEFAULT_BASE_DATE - datetime.timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+    return play_count, played_at
+
+
+def play_day(plays, seed, day):
+    # Tracks that have been played a lot are much more likely to be played again on any given day
+    rng = random.Random(seed * 7919 + day)
+    day_start = DEFAULT_BASE_DATE + datetime.timedelta(days=day - 1)
+    for index, track_plays in enumerate(plays):
+        play_count = track_plays[0] if track_plays is not None else 0
+        if rng.random() < min(0.01 + play_count / 1000.0, 0.5):
+            played_at = day_start + datetime.timedelta(seconds=rng.randint(0, 24 * 3600 - 1))
+            if track_plays is not None:
+                played_at = max(played_at, track_plays[1])
+            plays[index] = (play_count + rng.randint(1, 3), played_at)
+
+
+def generate_track(catalog, index, seed, track_plays):
+    rng = get_track_random(seed, index, 1)
+
+    artist = catalog['artists'][bisect.bisect(catalog['artist_weights'],
+                                              rng.random() * catalog['artist_weights'][-1])]
+    album_index = bisect.bisect(artist['album_weights'], rng.random() * artist['album_weights'][-1])
+    album = artist['albums'][album_index]
+    name = get_title(rng, 4)
+    total_time = rng.randint(90, 600) * 1000 + rng.randint(0, 999)
+    date_added = DEFAULT_BASE_DATE - datetime.timedelta(seconds=rng.randint(0, 10 * 365 * 24 * 3600))
+    kind = rng.random()
+
+    track = {'Track ID': 1000 + index * 2,
+             'Size': total_time * 40 + rng.randint(0, 100000),
+             'Total Time': total_time,
+             'Disc Number': 1,
+             'Disc Count': 1,
+             'Track Number': rng.randint(1, 14),
+             'Track Count': 14,
+             'Year': album['year'],
+             'Date Modified': date_added,
+             'Date Added': date_added,
+             'Bit Rate': rng.choice([128, 192, 256, 320]),
+             'Sample Rate': 44100,
+             'Artwork Count': 1,
+             'Persistent ID': '{0:016X}'.format(rng.getrandbits(64)),
+             'Track Type': 'File',
+             'File Folder Count': 5,
+             'Library Folder Count': 1,
+             'Name': name,
+             'Artist': artist['name'],
+             'Album': album['name'],
+             'Genre': album['genre'],
+             'Kind': 'MPEG audio file'}
+
+    if album['compilation']:
+        track['Album Artist'] = 'Various Artists'
+        track['Compilation'] = True
+    if rng.random() < 0.1:
+        track['Composer'] = get_title(rng, 2)
+    if rng.random() < 0.05:
+        track['Grouping'] = get_title(rng, 2)
+    if rng.random() < 0.05:
+        track['Comments'] = get_title(rng, 6)
+    if rng.random() < 0.15:
+        track['BPM'] = rng.randint(60, 180)
+    if rng.random() < 0.08:
+        track['Loved'] = True
+    if rng.random() < 0.1:
+        track['Skip Count'] = rng.randint(1, 20)
+        track['Skip Date'] = date_added + datetime.timedelta(days=rng.randint(0, 100))
+
+    # A few tracks of each kind that the importer filters out
+    folder = 'Music'
+    if kind < 0.03:
+        track.update({'Genre': 'Podcast', 'Podcast': True, 'Unplayed': True})
+        folder = 'Podcasts'
+    elif kind < 0.04:
+        track.update({'Music Video': True, 'Has Video': True, 'Kind': 'MPEG-4 video file'})
+    elif kind < 0.045:
+        track.update({'Kind': 'Audible file'})
+        folder = 'Audiobooks'
+    elif kind < 0.06:
+        del track['Year']
+
+    track['Location'] = (MUSIC_FOLDER + folder + '/' + quote(artist['name']) + '/' + quote(album['name']) + '/'
+                         + '{0:02d} {1}.mp3'.format(track['Track Number'], quote(name)))
+
+    if track_plays is not None:
+        play_count, played_at = track_plays
+        track['Play Count'] = play_count
+        track['Play Date'] = int((played_at - MAC_EPOCH).total_seconds())
+        track['Play Date UTC'] = played_at
+    return track
+
+
+def write_library(fp, catalog, plays, seed, library_date):
+    fp.write(export_to_playlist.PLIST_HEADER)
+    fp.write('<dict>\n')
+    for key, value in [('Major Version', 1),
+                       ('Minor Version', 1),
+                       ('Date', library_date),
+                       ('Application Version', '12.9.5.5'),
+                       ('Features', 5),
+                       ('Show Content Ratings', True),
+                       ('Music Folder', MUSIC_FOLDER),
+                       ('Library Persistent ID', '{0:016X}'.format(random.Random(seed).getrandbits(64)))]:
+        export_to_playlist.write_plist_item(fp, key, value, 1)
+
+    track_ids = []
+    fp.write('\t<key>Tracks</key>\n')
+    fp.write('\t<dict>\n')
+    for index, track_plays in enumerate(plays):
+        track = generate_track(catalog, index, seed, track_plays)
+        export_to_playlist.write_plist_item(fp, str(track['Track ID']), track, 2)
+        track_ids.append(track['Track ID'])
+    fp.write('\t</dict>\n')
+
+    # The master playlist lists every track, as in a real library
+    fp.write('\t<key>Playlists</key>\n')
+    fp.write('\t<array>\n')
+    master_playlist = {'Name': 'Library',
+                       'Master': True,
+                       'Playlist ID': 1,
+                       'Playlist Persistent ID': '{0:016X}'.format(random.Random(seed + 1).getrandbits(64)),
+                       'Visible': False,
+                       'All Items': True,
+                       'Playlist Items': [{'Track ID': track_id} for track_id in track_ids]}
+    export_to_playlist.write_plist_value(fp, master_playlist, 2)
+    fp.write('\t</array>\n')
+    fp.write('</dict>\n')
+    fp.write(export_to_playlist.PLIST_FOOTER)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import logging
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import time
+
+import psycopg2
+
+generate_library = importlib.import_module('generate-library')
+
+DEFAULT_SIZES = ['1k', '10k', '100k']
+DEFAULT_DAYS = 2
+DEFAULT_SEED = generate_library.DEFAULT_SEED
+DEFAULT_DATABASE_NAME = 'smarter_playlists_benchmark'
+DEFAULT_USER_NAME = 'postgres'
+DEFAULT_PASSWORD = 'postgres'
+DEFAULT_PORT = 5432
+DEFAULT_WORK_DIR = os.path.expanduser('~/.cache/smarter-playlists/benchmark')
+DEFAULT_HISTORY_PLAYS = 1000000
+DEFAULT_RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_SCRIPT = os.path.join(REPOSITORY_DIR, 'import-to-postgres.py')
+EXPORT_SCRIPT = os.path.join(REPOSITORY_DIR, 'export-to-playlist.py')
+
+# The statement that inserts new plays, along with their daily rollup and watermarks
+INGEST_STATEMENT_PREFIX = 'WITH new_play AS ('
+
+# Exported by every run, one cheap and one aggregating over the daily play rollup like the example views
+BENCHMARK_PLAYLISTS = collections.OrderedDict([('Top 500', 'bench_top_500'),
+                                               ('February 2019', 'bench_feb_2019')])
+BENCHMARK_VIEWS = ["CREATE OR REPLACE VIEW bench_top_500 AS "
+                   " SELECT itunes_id, "
+                   "        ROW_NUMBER() OVER (ORDER BY play_count DESC, track_id) AS row_number "
+                   "   FROM track "
+                   "  ORDER BY play_count DESC, track_id "
+                   "  LIMIT 500;",
+                   "CREATE OR REPLACE VIEW bench_feb_2019 AS "
+                   " SELECT playlist_tracks.itunes_id, "
+                   "        ROW_NUMBER() OVER (ORDER BY playlist_tracks.count DESC) AS row_number "
+                   "   FROM (SELECT play_daily.track_id, "
+                   "                track.itunes_id, "
+                   "                SUM(play_daily.plays) AS count, "
+                   "                ROW_NUMBER() OVER (PARTITION BY track.album_id "
+                   "                                   ORDER BY (SUM(play_daily.plays)) DESC) AS album_rows, "
+                   "                ROW_NUMBER() OVER (PARTITION BY track.artist_id "
+                   "                                   ORDER BY (SUM(play_daily.plays)) DESC) AS artist_rows "
+                   "           FROM play_daily "
+                   "           JOIN track USING (track_id) "
+                   "          WHERE play_daily.day >= '2019-02-01'::DATE "
+                   "            AND play_daily.day < '2019-03-01'::DATE "
+                   "          GROUP BY play_daily.track_id, track.itunes_id, track.album_id, track.artist_id) "
+                   "        AS playlist_tracks "
+                   "  WHERE playlist_tracks.album_rows <= 2 "
+                   "    AND playlist_tracks.artist_rows <= 5 "
+                   "  ORDER BY playlist_tracks.count DESC "
+                   "  LIMIT 500;"]
+
+
+def main(arg_list=None):
+    args = parse_args(arg_list)
+
+    results = collections.OrderedDict([('started_at', datetime.datetime.now().isoformat()),
+                                       ('revision', get_revision()),
+                                       ('host', platform.node()),
+                                       ('python', platform.python_version()),
+                                       ('days', args.days),
+                                       ('seed', args.seed),
+                                       ('import_args', args.import_args),
+                                       ('sizes', collections.OrderedDict())])
+
+    if args.ingest_check:
+        size = args.sizes[0]
+        track_count = generate_library.parse_track_count(size)
+        logging.warning("Generating %s track libraries in %s...", track_count, args.work_dir)
+        libraries = list(generate_library.generate_libraries(track_count, 1, args.seed,
+                                                             os.path.join(args.work_dir, 'libraries')))
+        check_ingest(args, size, libraries)
+        if not args.keep_database:
+            drop_database(args.database_name, args.port, args.username, args.password)
+        return
+
+    for size in args.sizes:
+        track_count = generate_library.parse_track_count(size)
+        logging.warning("Generating %s track libraries in %s...", track_count, args.work_dir)
+        libraries = list(generate_library.generate_libraries(track_count, args.days, args.seed,
+                                                             os.path.join(args.work_dir, 'libraries')))
+        results['sizes'][size] = run_benchmark(args, size, libraries)
+
+    if not args.keep_database:
+        drop_database(args.database_name, args.port, args.username, args.password)
+
+    results_file = args.results_file
+    if results_file is None:
+        os.makedirs(DEFAULT_RESULTS_DIR, exist_ok=True)
+        results_file = os.path.join(DEFAULT_RESULTS_DIR,
+                                    datetime.datetime.now().strftime('benchmark-%Y%m%d-%H%M%S.json'))
+    with open(results_file, 'w') as fp:
+        json.dump(results, fp, indent=2)
+        fp.write('\n')
+
+    log_results(results)
+    logging.warning("Results written to %s", results_file)
+
+
+def parse_args(arg_list):
+    parser = argparse.ArgumentParser(description='Benchmark importing and exporting synthetic iTunes libraries')
+    parser.add_argument('sizes',
+                        help='Library sizes to benchmark, e.g. 1k, 10k, 100k or 1m [{0}]'.format(
+                            ' '.join(DEFAULT_SIZES)),
+                        nargs='*',
+                        default=DEFAULT_SIZES)
+    parser.add_argument('--days',
+                        help='Number of "next day" delta imports after the initial import [%(default)s]',
+                        dest='days',
+                        type=int,
+                        default=DEFAULT_DAYS)
+    parser.add_argument('--seed',
+                        help='Random seed of the generated libraries [%(default)s]',
+                        dest='seed',
+                        type=int,
+                        default=DEFAULT_SEED)
+    parser.add_argument('--db', '-d',
+                        help='Name of the disposable postgres database, dropped and recreated for each library size '
+                             '[%(default)s]',
+                        dest='database_name',
+                        default=DEFAULT_DATABASE_NAME)
+    parser.add_argument('--port', '-p',
+                        help='Local database port [%(default)s]',
+                        dest='port',
+                        default=DEFAULT_PORT)
+    parser.add_argument('--user', '-u',
+                        help='Postgres username [%(default)s]',
+                        dest='username',
+                        default=DEFAULT_USER_NAME)
+    parser.add_argument('--pass', '-x',
+                        help='Postgres password [%(default)s]',
+                        dest='password',
+                        default=DEFAULT_PASSWORD)
+    parser.add_argument('--work-dir',
+                        help='Directory for the generated libraries, reports and exported playlists [%(default)s]',
+                        dest='work_dir',
+                        default=DEFAULT_WORK_DIR)
+    parser.add_argument('--results', '-r',
+                        help='Path to write the JSON results to [benchmark/results/benchmark-<timestamp>.json]',
+                        dest='results_file')
+    parser.add_argument('--import-args',
+                        help='Extra arguments passed to every import, e.g. "--workers 4"',
+                        dest='import_args',
+                        default='')
+    parser.add_argument('--ingest-check',
+                        help='Instead of benchmarking, check that ingesting a next day\'s plays reads none of the '
+                             'existing play history, by importing the same delta over a small and a large play table, '
+                             'for the first size given',
+                        dest='ingest_check',
+                        action='store_true')
+    parser.add_argument('--history-plays',
+                        help='Number of older plays added to the play table for the large run of --ingest-check '
+                             '[%(default)s]',
+                        dest='history_plays',
+                        type=int,
+                        default=DEFAULT_HISTORY_PLAYS)
+    parser.add_argument('--keep-database',
+                        help='Leave the database of the last library size in place once finished',
+                        dest='keep_database',
+                        action='store_true')
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def run_benchmark(args, size, libraries):
+    connection_args = ['--db', args.database_name, '--port', str(args.port),
+                       '--user', args.username, '--pass', args.password]
+    step_dir = os.path.join(args.work_dir, 'runs', size)
+    os.makedirs(step_dir, exist_ok=True)
+    cache_file = os.path.join(step_dir, 'library.pickle')
+    steps = collections.OrderedDict()
+
+    reset_database(args.database_name, args.port, args.username, args.password)
+
+    # The first import parses the whole library, each next day's library is then imported as a delta like the
+    # 2-hourly cron job does
+    for day, library_file in enumerate(libraries):
+        step_name = 'import day {0}'.format(day)
+        import_args = (['--library', library_file, '--cache', cache_file] + connection_args
+                       + shlex.split(args.import_args))
+        import_args.append('--force-reparse' if day == 0 else '--delta')
+        steps[step_name] = run_step(step_dir, step_name, IMPORT_SCRIPT, import_args)
+
+    create_views(args.database_name, args.port, args.username, args.password)
+    for playlist_format in ['M3U', 'XML']:
+        step_name = 'export {0}'.format(playlist_format)
+        manifest_file = os.path.join(step_dir, 'manifest-{0}.json'.format(playlist_format))
+        with open(manifest_file, 'w') as fp:
+            json.dump({'format': playlist_format,
+                       'output_dir': os.path.join(step_dir, 'playlists'),
+                       'playlists': BENCHMARK_PLAYLISTS}, fp)
+        steps[step_name] = run_step(step_dir, step_name, EXPORT_SCRIPT, ['--manifest', manifest_file] + connection_args)
+
+    return steps
+
+
+def check_ingest(args, size, libraries):
+    # The next day's delta is imported over the play history of the initial import alone, and again with many older
+    # plays added to it. Ingesting against the watermarks shouldn't read any existing plays either way, so the same
+    # plays are inserted at about the same cost however large the play table has grown.
+    connection_args = ['--db', args.database_name, '--port', str(args.port),
+                       '--user', args.username, '--pass', args.password]
+    step_dir = os.path.join(args.work_dir, 'runs', size, 'ingest-check')
+    os.makedirs(step_dir, exist_ok=True)
+    cache_file = os.path.join(step_dir, 'library.pickle')
+
+    ingests = collections.OrderedDict()
+    for history_plays in [0, args.history_plays]:
+        reset_database(args.database_name, args.port, args.username, args.password)
+        run_step(step_dir, 'import day 0', IMPORT_SCRIPT,
+                 ['--library', libraries[0], '--cache', cache_file, '--force-reparse'] + connection_args)
+        play_count = add_history_plays(args.database_name, args.port, args.username, args.password, history_plays)
+        step = run_step(step_dir, 'import day 1 over {0} plays'.format(play_count), IMPORT_SCRIPT,
+                        ['--library', libraries[1], '--cache', cache_file, '--delta', '--explain'] + connection_args)
+        ingests[play_count] = get_ingest(step['report'])
+
+    logging.warning("%12s %10s %10s %12s", 'play rows', 'inserted', 'elapsed', 'buffers')
+    for play_count, ingest in ingests.items():
+        logging.warning("%12s %10s %9.3fs %12s", play_count, ingest['inserted'], ingest['elapsed'], ingest['buffers'])
+
+    scans = sorted(set(scan for ingest in ingests.values() for scan in ingest['play_scans']))
+    if scans:
+        sys.exit("Ingesting plays read the existing play history: " + ", ".join(scans))
+    if len(set(ingest['inserted'] for ingest in ingests.values())) > 1:
+        sys.exit("Ingesting the same plays over play tables of different sizes inserted different numbers of plays")
+    logging.warning("Ingest check passed, no existing plays were read")
+
+
+def add_history_plays(name, port, user, password, history_plays):
+    # Plays long before any watermark, spread evenly over the tracks. Returns the number of rows in play.
+    conn = psycopg2.connect(host="localhost", port=port, database=name, user=user, password=password)
+    cur = conn.cursor()
+    if history_plays > 0:
+        cur.execute("INSERT INTO play (track_id, played_at) "
+                    "SELECT t.track_id, "
+                    "       TIMESTAMP '2000-01-01' + n * INTERVAL '1 minute' "
+                    "  FROM track t "
+                    " CROSS JOIN generate_series(1, CEIL(%s :: NUMERIC / (SELECT COUNT(*) FROM track)) :: INT) AS n",
+                    [history_plays])
+    cur.execute("ANALYZE play")
+    cur.execute("SELECT COUNT(*) FROM play")
+    play_count = cur.fetchone()[0]
+    conn.commit()
+    conn.close()
+    return play_count
+
+
+def get_ingest(report):
+    # The ingest statement's plays inserted, time, shared buffers and any nodes scanning play, from its EXPLAIN
+    statement = next(entry for entry in report['statements']
+                     if entry['statement'].startswith(INGEST_STATEMENT_PREFIX))
+    plan = statement['plans'][0][0]['Plan']
+    nodes = []
+    pending = [plan]
+    while pending:
+        node = pending.pop()
+        nodes.append(node)
+        pending.extend(node.get('Plans', []))
+    return {'elapsed': statement['elapsed'],
+            'buffers': plan.get('Shared Hit Blocks', 0) + plan.get('Shared Read Blocks', 0),
+            'inserted': sum(node['Actual Rows'] for node in nodes
+                            if node['Node Type'] == 'ModifyTable' and node.get('Relation Name') == 'play'),
+            'play_scans': ['{0} on {1}'.format(node['Node Type'], node['Relation Name']) for node in nodes
+                           if node['Node Type'] != 'ModifyTable' and node.get('Relation Name') == 'play']}
+
+
+def run_step(step_dir, step_name, script, script_args):
+    # Each step runs the script in a process of its own, so its peak memory is its own as well. The script's output
+    # goes to a log file next to its report.
+    file_name = os.path.join(step_dir, step_name.replace(' ', '-'))
+    logging.warning("Running %s...", step_name)
+    start = time.perf_counter()
+    with open(file_name + '.log', 'w') as log_file:
+        returncode = subprocess.call([sys.executable, script] + script_args + ['--report', file_name + '.json'],
+                                     stdout=log_file, stderr=subprocess.STDOUT)
+    wall_time = time.perf_counter() - start
+    if returncode != 0:
+        sys.exit("Benchmark step {0} failed, see {1}.log".format(step_name, file_name))
+
+    with open(file_name + '.json') as fp:
+        report = json.load(fp)
+    return collections.OrderedDict([('wall_time', wall_time),
+                                    ('peak_rss_kb', max(report['peak_rss_kb'], report['peak_child_rss_kb'])),
+                                    ('report', report)])
+
+
+def log_results(results):
+    logging.warning("%-8s %-16s %10s %12s", 'size', 'step', 'wall time', 'peak RSS')
+    for size, steps in results['sizes'].items():
+        for step_name, step in steps.items():
+            logging.warning("%-8s %-16s %9.3fs %9s KB", size, step_name, step['wall_time'], step['peak_rss_kb'])
+
+
+def get_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=REPOSITORY_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def reset_database(name, port, user, password):
+    drop_database(name, port, user, password)
+    conn = open_maintenance_db(port, user, password)
+    conn.cursor().execute("CREATE DATABASE {0} ENCODING 'UTF8' TEMPLATE template0".format(name))
+    conn.close()
+
+
+def drop_database(name, port, user, password):
+    conn = open_maintenance_db(port, user, password)
+    conn.cursor().execute("DROP DATABASE IF EXISTS {0}".format(name))
+    conn.close()
+
+
+def create_views(name, port, user, password):
+    conn = psycopg2.connect(host="localhost", port=port, database=name, user=user, password=password)
+    cur = conn.cursor()
+    for view in BENCHMARK_VIEWS:
+        cur.execute(view)
+    conn.commit()
+    conn.close()
+
+
+def open_maintenance_db(port, user, password):
+    # Databases can only be created and dropped outside of a transaction
+    conn = psycopg2.connect(host="localhost", port=port, database='postgres', user=user, password=password)
+    conn.autocommit = True
+    return conn
+
+
+if __name__ == '__main__':
+    main()
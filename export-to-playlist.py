@@ -2,27 +2,73 @@
 
 import argparse
 import collections
+import concurrent.futures
+import contextlib
 import datetime
+import hashlib
+import itertools
+import json
 import logging
 import os
-import plistlib
 import random
 import re
 import subprocess
 import sys
 import time
-from urllib.parse import unquote
 
-import psycopg2
+# Only needed for the postgres backend
+try:
+    import psycopg2
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+import instrumentation
+import library_sql
+import playlist_rules
+import sqlite_backend
+import track_locations
+
+# Only needed for --engine
+try:
+    import playlist_engine
+except ImportError:
+    playlist_engine = None
 
 DEFAULT_ITUNES_MUSIC_FOLDER = os.path.expanduser('~/Music/iTunes/iTunes Music/')
 DEFAULT_PLAYLIST_NAME = 'Top 2019'
 DEFAULT_VIEW_NAME = 'year_2019'
 DEFAULT_DATABASE_NAME = 'music'
+DEFAULT_SCHEMA_NAME = 'public'
 DEFAULT_USER_NAME = 'postgres'
 DEFAULT_PASSWORD = 'postgres'
 DEFAULT_FORMAT = 'M3U'
-DEFAULT_PORT = 4359
+DEFAULT_PORT = 5432
+DEFAULT_OUTPUT_DIR = '.'
+DEFAULT_WORKERS = 4
+DEFAULT_ITERSIZE = 2000
+DEFAULT_BACKEND = 'postgres'
+DEFAULT_ENGINE_CACHE_FILE_LOCATION = os.path.expanduser('~/.cache/smarter-playlists/playlist-engine.npz')
+
+# Exit status when --skip-unchanged finds nothing to export, so wrapper scripts can skip re-importing into iTunes
+UNCHANGED_EXIT_STATUS = 3
+
+PLIST_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+                '<plist version="1.0">\n')
+PLIST_FOOTER = '</plist>\n'
+
+# The track_detail columns each format is written from
+TRACK_COLUMNS = {'M3U': ['name', 'artist', 'total_time', 'location', 'a.itunes_id'],
+                 'XML': ['itunes_track_id', 'name', 'artist', 'album_artist', 'album', 'grouping', 'genre', 'size',
+                         'total_time', 'track_number', 'year', 'bpm', 'date_added', 'bit_rate', 'sample_rate',
+                         'comments', 'play_count', 'play_date', 'play_date_utc', 'compilation', 'a.itunes_id',
+                         'location']}
+
+# What exporting differs in between backends, besides the dialect of its SQL: which relation a view's rows are read
+# from, how a view's rows are fingerprinted and how rows are streamed without holding them all
+Backend = collections.namedtuple('Backend', ['dialect', 'get_playlist_source', 'fetch_playlist_fingerprint',
+                                             'fetch_rows'])
 
 
 def main(arg_list=None):
@@ -35,68 +81,437 @@ def main(arg_list=None):
     password = args.password
     port = args.port
     playlist_format = args.format
-
-    if playlist_format == "XML":
-        export_as_xml(db_name, password, playlist_name, port, username, view_name)
-    elif playlist_format == "M3U":
-        export_as_m3u(db_name, password, playlist_name, port, username, view_name)
-    else:
+    schema_name = args.schema_name
+    itersize = args.itersize
+    backend = args.backend
+    if backend == 'sqlite':
+        schema_name = sqlite_backend.SCHEMA_NAME
+
+    instrumentation.start('export-to-playlist', args.explain)
+
+    if args.manifest is not None:
+        manifest = json.load(args.manifest)
+        playlist_format = manifest.get('format', playlist_format)
+        output_dir = os.path.expanduser(manifest.get('output_dir', DEFAULT_OUTPUT_DIR))
+        workers = args.workers or manifest.get('workers', DEFAULT_WORKERS)
+        if playlist_format not in EXPORTERS:
+            sys.exit("Unsupported format selected: " + playlist_format)
+        playlists = manifest.get('playlists', {})
+        rules = playlist_rules.load_playlists(manifest.get('rules', []))
+        if rules and backend == 'sqlite' and not args.engine:
+            sys.exit("Playlist rules are only supported by the sqlite backend with --engine")
+        resolver = open_resolver(args, manifest)
+        failed, unchanged = [], []
+        if playlists:
+            failed, unchanged = export_batch(db_name, password, port, username, playlists, playlist_format,
+                                             output_dir, workers, schema_name, itersize,
+                                             skip_unchanged=args.skip_unchanged, backend=backend, resolver=resolver)
+        if rules:
+            rule_failed, rule_unchanged = export_rules(db_name, password, port, username, rules, playlist_format,
+                                                       output_dir, schema_name, itersize, args.skip_unchanged, backend,
+                                                       args.engine_cache if args.engine else None, resolver)
+            failed += rule_failed
+            unchanged += rule_unchanged
+        close_resolver(args, resolver)
+        save_report(args, db_name, port, username, password)
+        if failed:
+            sys.exit("Failed to export playlists: " + ", ".join(failed))
+        if len(unchanged) == len(playlists) + len(rules):
+            sys.exit(UNCHANGED_EXIT_STATUS)
+        return
+
+    if playlist_format not in EXPORTERS:
         sys.exit("Unsupported format selected: " + playlist_format)
+    conn = open_db(db_name, port, username, password, backend)
+    if args.skip_unchanged or args.record_fingerprint:
+        create_fingerprint_table(conn, schema_name)
+    if args.record_fingerprint:
+        record_fingerprint(conn, playlist_name, playlist_format, view_name, schema_name)
+        close_db(conn)
+        return
+    resolver = open_resolver(args)
+    fingerprint_file = get_fingerprint_file(playlist_name, playlist_format) if args.defer_fingerprint else None
+    final_file_name, _ = export_playlist(conn, playlist_name, view_name, playlist_format, schema_name=schema_name,
+                                         itersize=itersize, skip_unchanged=args.skip_unchanged, resolver=resolver,
+                                         fingerprint_file=fingerprint_file)
+    close_db(conn)
+    close_resolver(args, resolver)
+    if final_file_name is None:
+        logging.warning("Playlist %s is unchanged since it was last exported, skipping", playlist_name)
+        save_report(args, db_name, port, username, password)
+        sys.exit(UNCHANGED_EXIT_STATUS)
+    if playlist_format == "M3U" and args.open:
+        subprocess.call(["open", final_file_name])
+        os.remove(final_file_name)
+    save_report(args, db_name, port, username, password)
+
+
+def save_report(args, db_name, port, username, password):
+    report = instrumentation.get_report()
+    instrumentation.log_summary(report)
+    if args.report_file is not None:
+        instrumentation.write_report(report, args.report_file)
+    if args.metrics_table is not None:
+        conn = open_db(db_name, port, username, password)
+        instrumentation.store_report(conn, report, args.metrics_table)
+        close_db(conn)
+
+
+def open_resolver(args, manifest=None):
+    # Relocations given on the command line take precedence over a manifest's, which maps each prefix to its
+    # replacement, and so does checking files
+    relocations = collections.OrderedDict((manifest or {}).get('relocate', {}))
+    relocations.update(args.relocations or [])
+    check_files = args.check_files or (manifest or {}).get('check_files', False)
+    cache = track_locations.read_cache(args.location_cache) if check_files else None
+    return track_locations.LocationResolver(relocations.items(), check_files, args.check_workers, cache)
+
+
+def close_resolver(args, resolver):
+    if resolver.check_files:
+        track_locations.write_cache(resolver.cache, args.location_cache)
+    if args.missing_report is not None:
+        resolver.write_report(args.missing_report)
+
+
+def export_batch(db_name, password, port, username, playlists, playlist_format, output_dir, workers,
+                 schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE, pool=None, skip_unchanged=False,
+                 backend=DEFAULT_BACKEND, resolver=None):
+    # Playlists are independent of each other, so they are queried and written concurrently over a small pool of
+    # connections shared by the whole batch. A pool of at least as many connections as workers that is kept open
+    # between batches can be given instead.
+    os.makedirs(output_dir, exist_ok=True)
+    batch_pool = pool
+    if batch_pool is None:
+        batch_pool = open_pool(db_name, port, username, password, workers, backend)
+    if skip_unchanged:
+        conn = batch_pool.getconn()
+        try:
+            create_fingerprint_table(conn, schema_name)
+        finally:
+            batch_pool.putconn(conn)
+
+    def export_batch_playlist(playlist_name, view_name):
+        start = time.perf_counter()
+        conn = batch_pool.getconn()
+        try:
+            file_name, row_count = export_playlist(conn, playlist_name, view_name, playlist_format, output_dir,
+                                                   schema_name, itersize, skip_unchanged, resolver)
+            conn.commit()
+        finally:
+            batch_pool.putconn(conn)
+        return file_name is not None, row_count, time.perf_counter() - start
+
+    failed = []
+    unchanged = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = collections.OrderedDict((playlist_name,
+                                           executor.submit(export_batch_playlist, playlist_name, view_name))
+                                          for playlist_name, view_name in playlists.items())
+        results = collections.OrderedDict()
+        for playlist_name, future in futures.items():
+            try:
+                results[playlist_name] = future.result()
+            except Exception as e:
+                logging.error("Failed to export playlist %s: %s", playlist_name, e)
+                failed.append(playlist_name)
+    if pool is None:
+        batch_pool.closeall()
+
+    logging.warning("Exported %s of %s playlists to %s:", len(results), len(playlists), output_dir)
+    for playlist_name, (written, row_count, elapsed) in results.items():
+        if not written:
+            unchanged.append(playlist_name)
+        logging.warning("  %-30s %-20s %6s tracks %8.3fs%s", playlist_name, playlists[playlist_name], row_count,
+                        elapsed, '' if written else '  unchanged')
+    return failed, unchanged
+
+
+def export_rules(db_name, password, port, username, playlists, playlist_format, output_dir,
+                 schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE, skip_unchanged=False,
+                 backend=DEFAULT_BACKEND, engine_cache=None, resolver=None):
+    # Playlists are ranked by the database, or in-process by the playlist engine if it has a cache file to use
+    start = time.perf_counter()
+    conn = open_db(db_name, port, username, password, backend)
+    try:
+        if skip_unchanged:
+            create_fingerprint_table(conn, schema_name)
+        if engine_cache is not None:
+            with instrumentation.phase('rules: load engine'):
+                engine = playlist_engine.load_engine(conn, schema_name,
+                                                     ' '.join([backend, db_name, str(port), schema_name]),
+                                                     engine_cache)
+            results = export_ranked(conn, engine, playlists, playlist_format, output_dir, schema_name, itersize,
+                                    skip_unchanged, resolver)
+        else:
+            results = export_family(conn, playlists, playlist_format, output_dir, schema_name, itersize,
+                                    skip_unchanged, resolver)
+        close_db(conn)
+    except Exception as e:
+        conn.close()
+        logging.error("Failed to export playlists %s: %s", ", ".join(playlist.name for playlist in playlists), e)
+        return [playlist.name for playlist in playlists], []
+
+    logging.warning("Exported %s playlists from rules to %s in %.3fs:", len(results), output_dir,
+                    time.perf_counter() - start)
+    unchanged = []
+    for playlist in playlists:
+        if playlist.name not in results:
+            unchanged.append(playlist.name)
+            logging.warning("  %-30s unchanged", playlist.name)
+        else:
+            logging.warning("  %-30s %6s tracks", playlist.name, results[playlist.name])
+    return [], unchanged
+
+
+def export_family(conn, playlists, playlist_format, output_dir=DEFAULT_OUTPUT_DIR, schema_name=DEFAULT_SCHEMA_NAME,
+                  itersize=DEFAULT_ITERSIZE, skip_unchanged=False, resolver=None):
+    # Playlists declared with playlist_rules are all queried at once, their rows arriving one playlist after the other,
+    # so every file is written from a single scan of the play rollup. Returns the number of tracks written to each.
+    os.makedirs(output_dir, exist_ok=True)
+    fingerprints = None
+    if skip_unchanged:
+        with instrumentation.phase('rules: fingerprint') as counts:
+            fingerprints = fetch_family_fingerprints(conn, playlists, schema_name)
+            counts['rows'] = len(playlists)
+            playlists = [playlist for playlist in playlists
+                         if fingerprints[playlist.name] != fetch_stored_fingerprint(
+                             conn, playlist.name, playlist_format, playlist_rules.get_rule_key(playlist), schema_name)]
+
+    results = collections.OrderedDict()
+    if not playlists:
+        return results
+    groups = itertools.groupby(fetch_family_tracks(conn, playlists, playlist_format, schema_name, itersize),
+                               key=lambda row: row[0])
+    group = next(groups, None)
+    for index, playlist in enumerate(playlists):
+        rows = ()
+        if group is not None and group[0] == index:
+            rows = (row[1:] for row in group[1])
+        with instrumentation.phase(playlist.name + ': write') as counts:
+            _, counts['rows'] = EXPORTERS[playlist_format](conn, playlist.name, None, output_dir, schema_name,
+                                                           itersize, rows, resolver)
+        results[playlist.name] = counts['rows']
+        if group is not None and group[0] == index:
+            group = next(groups, None)
+
+        if fingerprints is not None:
+            store_fingerprint(conn, playlist.name, playlist_format, playlist_rules.get_rule_key(playlist),
+                              fingerprints[playlist.name], schema_name)
+    return results
+
+
+def export_ranked(conn, engine, playlists, playlist_format, output_dir=DEFAULT_OUTPUT_DIR,
+                  schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE, skip_unchanged=False, resolver=None):
+    # The same as export_family, with each playlist's tracks ranked by the playlist engine rather than the database,
+    # which then only has to look up the details of the tracks written. Fingerprints are computed the same way, so
+    # switching between the two doesn't rewrite unchanged playlists.
+    os.makedirs(output_dir, exist_ok=True)
+    results = collections.OrderedDict()
+    for playlist in playlists:
+        with instrumentation.phase(playlist.name + ': rank') as counts:
+            itunes_ids = engine.rank(playlist)
+            counts['rows'] = len(itunes_ids)
+
+        fingerprint = None
+        if skip_unchanged:
+            fingerprint = hashlib.md5(','.join('{0}:{1}'.format(itunes_id, row_number)
+                                               for row_number, itunes_id in enumerate(itunes_ids, 1))
+                                      .encode('utf-8')).hexdigest()
+            if fingerprint == fetch_stored_fingerprint(conn, playlist.name, playlist_format,
+                                                       playlist_rules.get_rule_key(playlist), schema_name):
+                continue
+
+        with instrumentation.phase(playlist.name + ': write') as counts:
+            _, counts['rows'] = EXPORTERS[playlist_format](conn, playlist.name, None, output_dir, schema_name,
+                                                           itersize, fetch_ranked_tracks(conn, itunes_ids,
+                                                                                         playlist_format, schema_name,
+                                                                                         itersize),
+                                                           resolver)
+        results[playlist.name] = counts['rows']
+        if fingerprint is not None:
+            store_fingerprint(conn, playlist.name, playlist_format, playlist_rules.get_rule_key(playlist),
+                              fingerprint, schema_name)
+    return results
+
+
+def export_playlist(conn, playlist_name, view_name, playlist_format, output_dir=DEFAULT_OUTPUT_DIR,
+                    schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE, skip_unchanged=False, resolver=None,
+                    fingerprint_file=None):
+    # Returns the file written and the number of tracks in it. With skip_unchanged, no file is written if the view
+    # returns the same tracks in the same order as when the playlist was last exported, which is checked with an
+    # aggregate over the view alone before any track details are fetched. The fingerprint of a playlist written is
+    # stored, or left in fingerprint_file for record_fingerprint to store once the playlist was imported into iTunes.
+    backend = get_backend(conn)
+    source_name = backend.get_playlist_source(conn, view_name, schema_name)
+    fingerprint = None
+    if skip_unchanged:
+        with instrumentation.phase(playlist_name + ': fingerprint') as counts:
+            fingerprint, counts['rows'] = backend.fetch_playlist_fingerprint(conn, source_name)
+            if fingerprint == fetch_stored_fingerprint(conn, playlist_name, playlist_format, view_name, schema_name):
+                return None, counts['rows']
+
+    with instrumentation.phase(playlist_name + ': write') as counts:
+        file_name, counts['rows'] = EXPORTERS[playlist_format](conn, playlist_name, source_name, output_dir,
+                                                               schema_name, itersize, resolver=resolver)
+    if fingerprint is not None:
+        if fingerprint_file is not None:
+            with atomic_open(fingerprint_file, 'w') as fp:
+                fp.write(fingerprint + '\n')
+        else:
+            store_fingerprint(conn, playlist_name, playlist_format, view_name, fingerprint, schema_name)
+    return file_name, counts['rows']
+
+
+def get_fingerprint_file(playlist_name, playlist_format, output_dir=DEFAULT_OUTPUT_DIR):
+    return os.path.join(output_dir, '{0}.{1}.fingerprint'.format(playlist_name, playlist_format.lower()))
+
+
+def record_fingerprint(conn, playlist_name, playlist_format, view_name, schema_name=DEFAULT_SCHEMA_NAME):
+    # Stores the fingerprint of the tracks last exported with --defer-fingerprint, rather than the view's current one,
+    # which an import since could have changed
+    fingerprint_file = get_fingerprint_file(playlist_name, playlist_format)
+    try:
+        with open(fingerprint_file) as fp:
+            fingerprint = fp.read().strip()
+    except FileNotFoundError:
+        sys.exit("No deferred fingerprint found for playlist {0} at {1}".format(playlist_name, fingerprint_file))
+    store_fingerprint(conn, playlist_name, playlist_format, view_name, fingerprint, schema_name)
+    conn.commit()
+    os.remove(fingerprint_file)
+    logging.warning("Recorded the fingerprint of playlist %s", playlist_name)
 
 
-def export_as_m3u(db_name, password, playlist_name, port, username, view_name):
-    base_file_name = playlist_name
-    temp_file_name = base_file_name + ".txt"
-    final_file_name = base_file_name + ".m3u8"
+def get_backend(conn):
+    return BACKENDS['sqlite' if sqlite_backend.is_sqlite(conn) else 'postgres']
 
-    m3u_file = open(temp_file_name, "w+")
-    m3u_file.write("#EXTM3U\n")
 
-    rows = fetch_m3u_tracks(db_name, password, port, username, view_name)
+def get_server_playlist_source(conn, view_name, schema_name=DEFAULT_SCHEMA_NAME):
+    # Views materialized by the import script are read from their materialized view, which is refreshed as needed
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", [schema_name + '.playlist_watermark'])
+        if not cur.fetchone()[0]:
+            return view_name
+        cur.execute("SELECT materialized_view "
+                    "  FROM {0}.playlist_watermark "
+                    " WHERE view_name = %s"
+                    .format(schema_name),
+                    [view_name])
+        row = cur.fetchone()
+        return row[0] if row is not None else view_name
 
-    for row in rows:
-        if row[3] is None:
-            logging.warning("No file location found for %s by %s", row[0], row[1])
-            continue
 
-        track_name = row[0]
-        artist_name = row[1]
-        time_in_seconds = int(round(float(row[2]) / 1000, 0))
-        file_location = unquote(row[3]).replace("file://", "")
+def create_fingerprint_table(conn, schema_name=DEFAULT_SCHEMA_NAME):
+    cur = conn.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS {0}.playlist_fingerprint ("
+                "playlist_name TEXT NOT NULL, "
+                "playlist_format TEXT NOT NULL, "
+                "view_name TEXT NOT NULL, "
+                "fingerprint TEXT NOT NULL, "
+                "exported_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+                "PRIMARY KEY (playlist_name, playlist_format));"
+                .format(schema_name))
+    cur.close()
+    conn.commit()
 
-        m3u_file.write("#EXTINF:" + str(time_in_seconds) + "," + track_name + " - " + artist_name + "\n")
-        m3u_file.write(file_location + "\n")
 
-    m3u_file.close()
-    base = os.path.splitext(temp_file_name)[0]
-    os.rename(temp_file_name, base + ".m3u8")
+def fetch_server_playlist_fingerprint(conn, view_name):
+    # Returns an md5 of the view's ordered (itunes_id, row_number) pairs and the number of them
+    with conn.cursor() as cur:
+        cur.execute("SELECT md5(COALESCE(string_agg(itunes_id || ':' || row_number, ',' "
+                    "                               ORDER BY row_number, itunes_id), '')),"
+                    "       COUNT(*) "
+                    "  FROM {0}"
+                    .format(view_name))
+        return cur.fetchone()
+
+
+def fetch_family_fingerprints(conn, playlists, schema_name=DEFAULT_SCHEMA_NAME):
+    # The fingerprint of each playlist as the postgres backend computes a view's, from one aggregate over the family
+    fingerprints = collections.OrderedDict((playlist.name, hashlib.md5(b'').hexdigest()) for playlist in playlists)
+    with conn.cursor() as cur:
+        cur.execute("SELECT playlist, "
+                    "       md5(string_agg(itunes_id || ':' || row_number, ',' ORDER BY row_number, itunes_id)) "
+                    "  FROM ({0}) AS family "
+                    " GROUP BY playlist"
+                    .format(playlist_rules.get_family_sql(playlists, schema_name)))
+        for index, fingerprint in cur.fetchall():
+            fingerprints[playlists[index].name] = fingerprint
+    return fingerprints
+
+
+def fetch_stored_fingerprint(conn, playlist_name, playlist_format, view_name, schema_name=DEFAULT_SCHEMA_NAME):
+    cur = conn.cursor()
+    cur.execute("SELECT fingerprint "
+                "  FROM {0}.playlist_fingerprint "
+                " WHERE playlist_name = {1} "
+                "   AND playlist_format = {1} "
+                "   AND view_name = {1}"
+                .format(schema_name, get_backend(conn).dialect.placeholder),
+                [playlist_name, playlist_format, view_name])
+    row = cur.fetchone()
+    cur.close()
+    return row[0] if row is not None else None
 
-    subprocess.call(["open", final_file_name])
 
-    os.remove(final_file_name)
+def store_fingerprint(conn, playlist_name, playlist_format, view_name, fingerprint, schema_name=DEFAULT_SCHEMA_NAME):
+    cur = conn.cursor()
+    cur.execute("INSERT INTO {0}.playlist_fingerprint (playlist_name, playlist_format, view_name, fingerprint) "
+                "VALUES ({1}, {1}, {1}, {1}) "
+                "ON CONFLICT (playlist_name, playlist_format) DO UPDATE "
+                "   SET view_name = EXCLUDED.view_name, "
+                "       fingerprint = EXCLUDED.fingerprint, "
+                "       exported_at = EXCLUDED.exported_at;"
+                .format(schema_name, get_backend(conn).dialect.placeholder),
+                [playlist_name, playlist_format, view_name, fingerprint])
+    cur.close()
 
 
-def fetch_m3u_tracks(db_name, password, port, username, view_name):
-    conn = psycopg2.connect(host="localhost", database=db_name, port=port, user=username, password=password)
-    cur = conn.cursor()
+def export_as_m3u(conn, playlist_name, view_name, output_dir=DEFAULT_OUTPUT_DIR, schema_name=DEFAULT_SCHEMA_NAME,
+                  itersize=DEFAULT_ITERSIZE, rows=None, resolver=None):
+    if resolver is None:
+        resolver = track_locations.LocationResolver()
+    final_file_name = os.path.join(output_dir, playlist_name + ".m3u8")
+    row_count = 0
 
-    cur.execute("SELECT name,"
-                "       artist,"
-                "       total_time,"
-                "       location "
-                "  FROM itunes.itunes a "
-                "  JOIN {0} b ON (a.persistent_id = b.itunes_id)"
-                " ORDER BY row_number ASC "
-                .format(view_name))
+    # Lines are written as rows arrive from the server, into a temp file that only replaces the playlist once complete
+    with atomic_open(final_file_name, "w") as m3u_file:
+        m3u_file.write("#EXTM3U\n")
 
-    rows = cur.fetchall()
-    conn.commit()
-    cur.close()
-    conn.close()
-    return rows
+        if rows is None:
+            rows = fetch_m3u_tracks(conn, view_name, schema_name, itersize)
+        for row, file_location in resolver.resolve(playlist_name,
+                                                   instrumentation.iterate(playlist_name + ': query', rows),
+                                                   TRACK_COLUMNS['M3U'], itersize):
+            if file_location is None:
+                continue
+            row_count += 1
+
+            track_name = row[0]
+            artist_name = row[1]
+            time_in_seconds = int(round(float(row[2]) / 1000, 0))
+
+            m3u_file.write("#EXTINF:" + str(time_in_seconds) + "," + track_name + " - " + artist_name + "\n")
+            m3u_file.write(file_location + "\n")
+
+    resolver.log_missing(playlist_name)
+    return final_file_name, row_count
+
+
+def fetch_m3u_tracks(conn, view_name, schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE):
+    return get_backend(conn).fetch_rows(conn,
+                                        "SELECT {2} "
+                                        "  FROM {1}.track_detail a "
+                                        "  JOIN {0} b ON (a.itunes_id = b.itunes_id)"
+                                        " ORDER BY row_number ASC "
+                                        .format(view_name, schema_name, ', '.join(TRACK_COLUMNS['M3U'])),
+                                        itersize)
 
 
-def export_as_xml(db_name, password, playlist_name, port, username, view_name):
+def export_as_xml(conn, playlist_name, view_name, output_dir=DEFAULT_OUTPUT_DIR, schema_name=DEFAULT_SCHEMA_NAME,
+                  itersize=DEFAULT_ITERSIZE, rows=None, resolver=None):
+    if resolver is None:
+        resolver = track_locations.LocationResolver()
     # FIXME Don't hardcode library details
     plist_dict = collections.OrderedDict([('Major Version', 1),
                                           ('Minor Version', 1),
@@ -106,119 +521,226 @@ def export_as_xml(db_name, password, playlist_name, port, username, view_name):
                                           ('Application Version', '12.1.2.27'),
                                           ('Music Folder', 'file:///Users/stephan/Music/iTunes/iTunes%20Media/'),
                                           ('Library Persistent ID', '23D7636E9EB97DA0')])
-    conn = psycopg2.connect(host="localhost", database=db_name, port=port, user=username, password=password)
-    cur = conn.cursor()
+    qualified_playlist_name = os.path.join(output_dir, playlist_name + '.xml')
+    track_ids = []
+
+    # The plist is written incrementally, each track as its row arrives, so only the track ids are kept around to
+    # build the playlist items at the end
+    with atomic_open(qualified_playlist_name, 'w', encoding='utf-8') as fp:
+        fp.write(PLIST_HEADER)
+        fp.write('<dict>\n')
+        for key, value in plist_dict.items():
+            write_plist_item(fp, key, value, 1)
+
+        # The Tracks dict is only opened once its first track arrives, so an empty one is written as plistlib would
+        fp.write('\t<key>Tracks</key>\n')
+        if rows is None:
+            rows = fetch_xml_tracks(conn, view_name, schema_name, itersize)
+        for row, path in resolver.resolve(playlist_name, instrumentation.iterate(playlist_name + ': query', rows),
+                                          TRACK_COLUMNS['XML'], itersize):
+            # Tracks without a location are still listed, as they always were, but not those whose file is missing
+            if path is None and row[21] is not None:
+                continue
+            track_id = row[0]
+            name = escape_xml_illegal_chars(row[1])
+            artist = escape_xml_illegal_chars(row[2])
+            album_artist = escape_xml_illegal_chars(row[3])
+            album = escape_xml_illegal_chars(row[4])
+            grouping = escape_xml_illegal_chars(row[5])
+            genre = escape_xml_illegal_chars(row[6])
+            size = row[7]
+            total_time = row[8]
+            track_number = row[9]
+            year = row[10]
+            bpm = row[11]
+            date_added = row[12]
+            bit_rate = row[13]
+            sample_rate = row[14]
+            comments = escape_xml_illegal_chars(row[15])
+            play_count = row[16]
+            play_date = row[17]
+            play_date_utc = row[18]
+            compilation = bool(row[19])
+            persistent_id = row[20]
+            location = track_locations.get_location(row[21], path) if path is not None else None
+
+            track_dict = {'Track ID': track_id,
+                          'Name': name,
+                          'Artist': artist,
+                          'Album Artist': album_artist,
+                          'Album': album,
+                          'Grouping': grouping,
+                          'Genre': genre,
+                          'Size': size,
+                          'Total Time': total_time,
+                          'Track Number': track_number,
+                          'Year': year,
+                          'BPM': bpm,
+                          'Bit Rate': bit_rate,
+                          'Sample Rate': sample_rate,
+                          'Comments': comments,
+                          'Play Count': play_count,
+                          'Compilation': compilation,
+                          'Persistent ID': persistent_id,
+                          'Location': location,
+                          'Kind': 'MPEG audio file',
+                          'Date Added': date_added,
+                          'Play Date': play_date,
+                          'Play Date UTC': play_date_utc}
+
+            track_dict = dict((k, v) for k, v in track_dict.items() if v is not None)
+            if not track_ids:
+                fp.write('\t<dict>\n')
+            write_plist_item(fp, str(track_id), track_dict, 2)
+            track_ids.append(int(track_id))
+        if track_ids:
+            fp.write('\t</dict>\n')
+        else:
+            write_plist_value(fp, {}, 1)
+
+        logging.info("Generating 'master' library hidden playlist...")
+        playlist_id = random.randint(100000, 999999)
+        hexdigits = "0123456789ABCDEF"
+        playlist_persistent_id = "".join([hexdigits[random.randint(0, 0xF)] for _ in range(16)])
+        logging.warning(playlist_persistent_id)
+        playlist = {'Name': playlist_name,
+                    'Playlist ID': playlist_id,
+                    'All Items': True,
+                    'Playlist Items': [{'Track ID': track_id} for track_id in track_ids]}
+        write_plist_item(fp, 'Playlists', [playlist], 1)
+        fp.write('</dict>\n')
+        fp.write(PLIST_FOOTER)
+
+    resolver.log_missing(playlist_name)
+    return qualified_playlist_name, len(track_ids)
+
+
+def fetch_xml_tracks(conn, view_name, schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE):
+    return get_backend(conn).fetch_rows(conn,
+                                        "SELECT {2} "
+                                        "  FROM {1}.track_detail a "
+                                        "  JOIN {0} b ON (a.itunes_id = b.itunes_id)"
+                                        " ORDER BY row_number "
+                                        .format(view_name, schema_name, ', '.join(TRACK_COLUMNS['XML'])),
+                                        itersize)
+
+
+def fetch_family_tracks(conn, playlists, playlist_format, schema_name=DEFAULT_SCHEMA_NAME, itersize=DEFAULT_ITERSIZE):
+    # The tracks of every playlist in turn, each row starting with the playlist's index
+    return get_backend(conn).fetch_rows(conn,
+                                        "SELECT b.playlist, {2} "
+                                        "  FROM {1}.track_detail a "
+                                        "  JOIN ({0}) b ON (a.itunes_id = b.itunes_id)"
+                                        " ORDER BY b.playlist, b.row_number "
+                                        .format(playlist_rules.get_family_sql(playlists, schema_name), schema_name,
+                                                ', '.join(TRACK_COLUMNS[playlist_format])),
+                                        itersize)
+
+
+def fetch_ranked_tracks(conn, itunes_ids, playlist_format, schema_name=DEFAULT_SCHEMA_NAME,
+                        itersize=DEFAULT_ITERSIZE):
+    # The details of the given tracks, in the order given, looked up itersize tracks at a time
+    placeholder = get_backend(conn).dialect.placeholder
+    for offset in range(0, len(itunes_ids), itersize):
+        batch = itunes_ids[offset:offset + itersize]
+        cur = conn.cursor()
+        cur.execute("SELECT a.itunes_id, {2} "
+                    "  FROM {0}.track_detail a "
+                    " WHERE a.itunes_id IN ({1})"
+                    .format(schema_name, ', '.join([placeholder] * len(batch)),
+                            ', '.join(TRACK_COLUMNS[playlist_format])),
+                    batch)
+        rows = {row[0]: row[1:] for row in cur.fetchall()}
+        cur.close()
+        for itunes_id in batch:
+            if itunes_id in rows:
+                yield rows[itunes_id]
+
+
+def fetch_server_rows(conn, query, itersize=DEFAULT_ITERSIZE):
+    # A named cursor keeps the result set on the server, which sends it over in batches of itersize rows
+    cur = conn.cursor(name='smarter_playlists_export')
+    cur.itersize = itersize
+    try:
+        cur.execute(query)
+        yield from cur
+    finally:
+        cur.close()
+
+
+def write_plist_item(fp, key, value, depth):
+    fp.write('\t' * depth + '<key>' + escape_plist_string(key) + '</key>\n')
+    write_plist_value(fp, value, depth)
+
+
+def write_plist_value(fp, value, depth):
+    # Mirrors the output of plistlib.dump, one value at a time
+    indent = '\t' * depth
+    if isinstance(value, dict):
+        if not value:
+            fp.write(indent + '<dict/>\n')
+            return
+        fp.write(indent + '<dict>\n')
+        for key, item in value.items():
+            write_plist_item(fp, key, item, depth + 1)
+        fp.write(indent + '</dict>\n')
+    elif isinstance(value, (list, tuple)):
+        if not value:
+            fp.write(indent + '<array/>\n')
+            return
+        fp.write(indent + '<array>\n')
+        for item in value:
+            write_plist_value(fp, item, depth + 1)
+        fp.write(indent + '</array>\n')
+    elif isinstance(value, str):
+        fp.write(indent + '<string>' + escape_plist_string(value) + '</string>\n')
+    elif isinstance(value, bool):
+        fp.write(indent + ('<true/>\n' if value else '<false/>\n'))
+    elif isinstance(value, int):
+        fp.write(indent + '<integer>' + str(value) + '</integer>\n')
+    elif isinstance(value, float):
+        fp.write(indent + '<real>' + repr(value) + '</real>\n')
+    elif isinstance(value, datetime.datetime):
+        fp.write(indent + '<date>' + value.strftime('%Y-%m-%dT%H:%M:%SZ') + '</date>\n')
+    else:
+        raise TypeError("Unsupported type: " + type(value).__name__)
 
-    cur.execute("SELECT track_id,"
-                "       name,"
-                "       artist,"
-                "       album_artist,"
-                "       album,"
-                "       grouping,"
-                "       genre,"
-                "       size,"
-                "       total_time,"
-                "       track_number,"
-                "       year,"
-                "       bpm,"
-                "       date_added,"
-                "       bit_rate,"
-                "       sample_rate,"
-                "       comments,"
-                "       play_count,"
-                "       play_date,"
-                "       play_date_utc,"
-                "       compilation,"
-                "       persistent_id,"
-                "       location "
-                "  FROM itunes.itunes a "
-                "  JOIN {0} b ON (a.persistent_id = b.itunes_id)"
-                " ORDER BY row_number "
-                .format(view_name))
-    rows = cur.fetchall()
-    logging.warning("Rows returned by query retrieved")
-    itunes_track = collections.OrderedDict()
-    for row in rows:
-        track_id = row[0]
-        name = escape_xml_illegal_chars(row[1])
-        artist = escape_xml_illegal_chars(row[2])
-        album_artist = escape_xml_illegal_chars(row[3])
-        album = escape_xml_illegal_chars(row[4])
-        grouping = escape_xml_illegal_chars(row[5])
-        genre = escape_xml_illegal_chars(row[6])
-        size = row[7]
-        total_time = row[8]
-        track_number = row[9]
-        year = row[10]
-        bpm = row[11]
-        date_added = row[12]
-        bit_rate = row[13]
-        sample_rate = row[14]
-        comments = escape_xml_illegal_chars(row[15])
-        play_count = row[16]
-        play_date = row[17]
-        play_date_utc = row[18]
-        compilation = bool(row[19])
-        persistent_id = row[20]
-        location = row[21]
-
-        track_dict = {'Track ID': track_id,
-                      'Name': name,
-                      'Artist': artist,
-                      'Album Artist': album_artist,
-                      'Album': album,
-                      'Grouping': grouping,
-                      'Genre': genre,
-                      'Size': size,
-                      'Total Time': total_time,
-                      'Track Number': track_number,
-                      'Year': year,
-                      'BPM': bpm,
-                      'Bit Rate': bit_rate,
-                      'Sample Rate': sample_rate,
-                      'Comments': comments,
-                      'Play Count': play_count,
-                      'Compilation': compilation,
-                      'Persistent ID': persistent_id,
-                      'Location': location,
-                      'Kind': 'MPEG audio file',
-                      'Date Added': date_added,
-                      'Play Date': play_date,
-                      'Play Date UTC': play_date_utc}
-
-        track_dict = dict((k, v) for k, v in track_dict.items() if v is not None)
-        itunes_track[str(track_id)] = track_dict
-    conn.commit()
-    cur.close()
-    conn.close()
-    plist_dict['Tracks'] = itunes_track
-    playlist_array = []
-    logging.info("Generating 'master' library hidden playlist...")
-    playlist_id = random.randint(100000, 999999)
-    hexdigits = "0123456789ABCDEF"
-    playlist_persistent_id = "".join([hexdigits[random.randint(0, 0xF)] for _ in range(16)])
-    playlist_items = []
-    logging.warning(playlist_persistent_id)
-    for x in plist_dict['Tracks']:
-        playlist_track_dict = {'Track ID': int(x)}
-        playlist_items.append(playlist_track_dict)
-    playlist = {'Name': playlist_name,
-                'Playlist ID': playlist_id,
-                'All Items': True,
-                'Playlist Items': playlist_items}
-    playlist_array.append(playlist)
-    plist_dict['Playlists'] = playlist_array
-    qualified_playlist_name = playlist_name + '.xml'
-    with open(qualified_playlist_name, 'wb') as fp:
-        plistlib.dump(plist_dict, fp, sort_keys=False)
+
+def escape_plist_string(val):
+    val = val.replace('\r\n', '\n').replace('\r', '\n')
+    return val.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+@contextlib.contextmanager
+def atomic_open(file_name, mode, encoding=None):
+    temp_file_name = "{0}.{1}.tmp".format(file_name, os.getpid())
+    try:
+        with open(temp_file_name, mode, encoding=encoding) as fp:
+            yield fp
+        os.replace(temp_file_name, file_name)
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
 
 
 def parse_args(arg_list):
     parser = argparse.ArgumentParser()
+    parser.add_argument('--backend',
+                        help='Database the music data was imported to, a postgres server or an SQLite database file '
+                             '[%(default)s]',
+                        dest='backend',
+                        choices=['postgres', 'sqlite'],
+                        default=DEFAULT_BACKEND)
     parser.add_argument('--db', '-d',
-                        help='Name of postgres database [%(default)s]',
+                        help='Name of postgres database, or path of the SQLite database file, with {0} added if it '
+                             'has no extension [%(default)s]'.format(sqlite_backend.DEFAULT_SUFFIX),
                         dest='database_name',
                         default=DEFAULT_DATABASE_NAME)
+    parser.add_argument('--schema', '-s',
+                        help='Name of database schema the music data was imported to, unused by the sqlite backend '
+                             '[%(default)s]',
+                        dest='schema_name',
+                        default=DEFAULT_SCHEMA_NAME)
     parser.add_argument('--name', '-n',
                         help='Playlist name [%(default)s]',
                         dest='playlist_name',
@@ -243,10 +765,121 @@ def parse_args(arg_list):
                         help='Playlist file format [%(default)s]',
                         dest='format',
                         default=DEFAULT_FORMAT)
+    parser.add_argument('--manifest', '-m',
+                        help='JSON manifest of playlist names and views to export in one batch',
+                        dest='manifest',
+                        type=argparse.FileType('r'))
+    parser.add_argument('--workers', '-w',
+                        help='Number of playlists exported concurrently in a batch [{0}]'.format(DEFAULT_WORKERS),
+                        dest='workers',
+                        type=int)
+    parser.add_argument('--itersize',
+                        help='Number of rows fetched from the server at a time [%(default)s]',
+                        dest='itersize',
+                        type=int,
+                        default=DEFAULT_ITERSIZE)
+    parser.add_argument('--engine',
+                        help='Rank the playlists of a manifest\'s rules in-process, from a copy of the tracks and '
+                             'daily plays cached on disk, rather than in the database',
+                        dest='engine',
+                        action='store_true')
+    parser.add_argument('--engine-cache',
+                        help='Path to the playlist engine\'s cache of tracks and daily plays [%(default)s]',
+                        dest='engine_cache',
+                        default=DEFAULT_ENGINE_CACHE_FILE_LOCATION)
+    parser.add_argument('--relocate',
+                        help='Replace the FROM prefix of track locations with TO in the playlists exported, e.g. for '
+                             'a library mounted elsewhere or synced to a device. Can be given more than once.',
+                        dest='relocations',
+                        nargs=2,
+                        metavar=('FROM', 'TO'),
+                        action='append')
+    parser.add_argument('--check-files',
+                        help='Leave tracks whose files are missing, after relocation, out of the playlists exported',
+                        dest='check_files',
+                        action='store_true')
+    parser.add_argument('--check-workers',
+                        help='Number of files checked concurrently [%(default)s]',
+                        dest='check_workers',
+                        type=int,
+                        default=track_locations.DEFAULT_WORKERS)
+    parser.add_argument('--location-cache',
+                        help='Path to the cache of the files found by --check-files [%(default)s]',
+                        dest='location_cache',
+                        default=track_locations.DEFAULT_CACHE_FILE_LOCATION)
+    parser.add_argument('--missing-report',
+                        help='Path to write a JSON report of the tracks without a file to, by playlist',
+                        dest='missing_report')
+    parser.add_argument('--skip-unchanged',
+                        help='Only export playlists whose views returned different tracks, or the same tracks in a '
+                             'different order, when they were last exported with this option. Exits with status '
+                             '{0} if no playlist was exported.'.format(UNCHANGED_EXIT_STATUS),
+                        dest='skip_unchanged',
+                        action='store_true')
+    parser.add_argument('--defer-fingerprint',
+                        help='With --skip-unchanged, leave the fingerprint of a playlist exported in a .fingerprint '
+                             'file next to it rather than storing it, for --record-fingerprint to store once the '
+                             'playlist was imported into iTunes',
+                        dest='defer_fingerprint',
+                        action='store_true')
+    parser.add_argument('--record-fingerprint',
+                        help='Store the fingerprint --defer-fingerprint left for the playlist, exporting nothing',
+                        dest='record_fingerprint',
+                        action='store_true')
+    parser.add_argument('--no-open',
+                        help='Leave the exported M3U playlist in place rather than opening it in iTunes and '
+                             'removing it',
+                        dest='open',
+                        action='store_false')
+    parser.add_argument('--explain',
+                        help='Capture EXPLAIN (ANALYZE, BUFFERS) of each export query in the report. Queries are run '
+                             'twice.',
+                        dest='explain',
+                        action='store_true')
+    parser.add_argument('--report',
+                        help='Path to write a JSON report of the time and rows taken by each export to',
+                        dest='report_file')
+    parser.add_argument('--metrics-table',
+                        help='Table to append the JSON report to, created if it does not exist',
+                        dest='metrics_table')
     args = parser.parse_args(args=arg_list)
+
+    if args.backend == 'sqlite':
+        unsupported = [option for option, value in (('--explain', args.explain),
+                                                    ('--metrics-table', args.metrics_table))
+                       if value]
+        if unsupported:
+            parser.error("not supported by the sqlite backend: " + ", ".join(unsupported))
+    elif psycopg2 is None:
+        parser.error("the postgres backend needs psycopg2, which is not installed")
+    if args.engine and playlist_engine is None:
+        parser.error("--engine needs numpy, which is not installed")
+    if args.defer_fingerprint and not args.skip_unchanged:
+        parser.error("--defer-fingerprint needs --skip-unchanged")
+    if args.manifest is not None and (args.defer_fingerprint or args.record_fingerprint):
+        parser.error("--defer-fingerprint and --record-fingerprint only apply to a single playlist, not a manifest")
     return args
 
 
+def open_db(name, port, user, password, backend=DEFAULT_BACKEND):
+    if backend == 'sqlite':
+        return sqlite_backend.open_db(sqlite_backend.get_database_file(name))
+    return psycopg2.connect(host="localhost", port=port, database=name, user=user, password=password,
+                            cursor_factory=instrumentation.InstrumentedCursor)
+
+
+def close_db(conn):
+    conn.commit()
+    conn.close()
+
+
+def open_pool(name, port, user, password, size, backend=DEFAULT_BACKEND):
+    if backend == 'sqlite':
+        return sqlite_backend.ConnectionPool(sqlite_backend.get_database_file(name), size)
+    return psycopg2.pool.ThreadedConnectionPool(1, size, host="localhost", database=name, port=port, user=user,
+                                                password=password, cursor_factory=instrumentation.InstrumentedCursor)
+
+
 def escape_xml_illegal_chars(val, replacement='?'):
     _illegal_xml_chars_RE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]')
 
@@ -256,5 +889,13 @@ def escape_xml_illegal_chars(val, replacement='?'):
         return None
 
 
+EXPORTERS = {'M3U': export_as_m3u,
+             'XML': export_as_xml}
+
+BACKENDS = {'postgres': Backend(library_sql.POSTGRES, get_server_playlist_source, fetch_server_playlist_fingerprint,
+                                fetch_server_rows),
+            'sqlite': Backend(library_sql.SQLITE, sqlite_backend.get_playlist_source,
+                              sqlite_backend.fetch_playlist_fingerprint, sqlite_backend.fetch_rows)}
+
 if __name__ == '__main__':
     main()
@@ -1,70 +1,177 @@
 #!/usr/bin/env python3
 
 import argparse
+import base64
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import hashlib
+import io
+import itertools
 import logging
-import plistlib
+import os
+import pickle
+import re
+import struct
+import sys
+from xml.etree import ElementTree
 
-import psycopg2
+# Only needed for the postgres backend
+try:
+    import psycopg2
+    import psycopg2.extras
+    import psycopg2.pool
+except ImportError:
+    psycopg2 = None
+
+import instrumentation
+import library_sql
+import sqlite_backend
 
 DEFAULT_LIBRARY_FILE_LOCATION = '/Users/stephan/Music/iTunes/iTunes Music Library.xml'
+DEFAULT_CACHE_FILE_LOCATION = os.path.expanduser('~/.cache/smarter-playlists/library.pickle')
 DEFAULT_DATABASE_NAME = 'music'
 DEFAULT_SCHEMA_NAME = 'public'
 DEFAULT_USER_NAME = 'postgres'
 DEFAULT_PASSWORD = 'postgres'
 DEFAULT_PORT = 5432
+DEFAULT_STAGING_METHOD = 'copy'
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_WORKERS = 1
+DEFAULT_BACKEND = 'postgres'
 
 TEMPORARY_TABLE_NAME = 'itunes'
 TEMPORARY_SCHEMA_NAME = 'itunes'
+TEMPORARY_BUILD_SCHEMA_NAME = 'itunes_build'
+TEMPORARY_OLD_SCHEMA_NAME = 'itunes_old'
+TEMPORARY_DELTA_TABLE_NAME = 'itunes_delta'
+FINGERPRINT_COLUMN_NAME = 'import_fingerprint'
 
+# Staging columns kept, with proper types, for the exporters. Keyed by their staging name.
+TRACK_DETAIL_COLUMNS = collections.OrderedDict([('persistent_id', ('itunes_id', 'VARCHAR(16)')),
+                                                ('track_id', ('itunes_track_id', 'INT')),
+                                                ('name', ('name', 'TEXT')),
+                                                ('artist', ('artist', 'TEXT')),
+                                                ('album_artist', ('album_artist', 'TEXT')),
+                                                ('album', ('album', 'TEXT')),
+                                                ('grouping', ('grouping', 'TEXT')),
+                                                ('genre', ('genre', 'TEXT')),
+                                                ('size', ('size', 'BIGINT')),
+                                                ('total_time', ('total_time', 'BIGINT')),
+                                                ('track_number', ('track_number', 'INT')),
+                                                ('year', ('year', 'INT')),
+                                                ('bpm', ('bpm', 'INT')),
+                                                ('date_added', ('date_added', 'TIMESTAMP')),
+                                                ('bit_rate', ('bit_rate', 'INT')),
+                                                ('sample_rate', ('sample_rate', 'INT')),
+                                                ('comments', ('comments', 'TEXT')),
+                                                ('play_count', ('play_count', 'INT')),
+                                                ('play_date', ('play_date', 'BIGINT')),
+                                                ('play_date_utc', ('play_date_utc', 'TIMESTAMP')),
+                                                ('compilation', ('compilation', 'BOOLEAN')),
+                                                ('location', ('location', 'TEXT'))])
 
-def main(arg_list=None):
-    args = parse_args(arg_list)
-
-    library_xml = args.library_xml
-    db_name = args.database_name
-    schema_name = args.schema_name
-    port = args.port
-    username = args.username
-    password = args.password
+# Staging columns are typed from the plist values of their key, except for those the normalisation SQL relies on,
+# which always have these types. Types are postgres' own names for them, as reported by pg_type.
+STAGING_COLUMN_TYPES = collections.OrderedDict([('persistent_id', 'text'),
+                                                ('track_id', 'int4'),
+                                                ('name', 'text'),
+                                                ('artist', 'text'),
+                                                ('album_artist', 'text'),
+                                                ('album', 'text'),
+                                                ('grouping', 'text'),
+                                                ('genre', 'text'),
+                                                ('size', 'int8'),
+                                                ('total_time', 'int8'),
+                                                ('track_number', 'int4'),
+                                                ('year', 'int4'),
+                                                ('bpm', 'int4'),
+                                                ('date_added', 'timestamp'),
+                                                ('bit_rate', 'int4'),
+                                                ('sample_rate', 'int4'),
+                                                ('comments', 'text'),
+                                                ('play_count', 'int4'),
+                                                ('play_date', 'int8'),
+                                                ('play_date_utc', 'timestamp'),
+                                                ('compilation', 'bool'),
+                                                ('loved', 'bool'),
+                                                ('location', 'text'),
+                                                (FINGERPRINT_COLUMN_NAME, 'text')])
+PLIST_VALUE_TYPES = {bool: 'bool',
+                     int: 'int8',
+                     float: 'float8',
+                     datetime.datetime: 'timestamp',
+                     bytes: 'bytea',
+                     str: 'text'}
+BINARY_COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('!h', -1)
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
 
-    logging.warning("Connecting to database %s on port %s with username %s. Importing data to schema %s",
-                    db_name, port, username, schema_name)
+# Indexes the playlist views' filters and joins rely on, with the table and column each leads with. The schema
+# migrations create them and --index-report checks for them.
+VIEW_INDEXES = collections.OrderedDict([('idx_play_daily_day', ('play_daily', 'day')),
+                                        ('idx_play_played_at', ('play', 'played_at')),
+                                        ('idx_track_album_id', ('track', 'album_id')),
+                                        ('idx_track_artist_id', ('track', 'artist_id'))])
 
-    logging.warning("Parsing library file at location: %s", library_xml.name)
 
-    library = plistlib.load(library_xml)
+def main(arg_list=None):
+    args = parse_args(arg_list)
 
-    logging.warning("Extracting track data from library file...")
-    tracks_table, tracks = process_tracks(library)
+    if args.rebuild_rollup:
+        conn, cur = open_db(args.database_name, args.port, args.username, args.password, args.backend)
+        if args.backend == 'sqlite':
+            logging.warning("Rebuilding daily play rollup in %s...", sqlite_backend.get_database_file(args.database_name))
+            migrate_sqlite_schema(cur)
+            sqlite_backend.rebuild_play_daily(cur)
+        else:
+            logging.warning("Rebuilding daily play rollup in schema %s...", args.schema_name)
+            migrate_schema(cur, args.schema_name)
+            rebuild_play_daily(cur, args.schema_name)
+        close_db(conn, cur)
+        return
 
-    # Import data 'as-is' to postgres
-    conn, cur = open_db(db_name, port, username, password)
-    logging.warning("Importing data into temp schema...")
-    import_itunes_data(cur, tracks, tracks_table)
-    close_db(conn, cur)
+    if args.materialize is not None or args.dematerialize is not None:
+        conn, cur = open_db(args.database_name, args.port, args.username, args.password, args.backend)
+        migrate_schema(cur, args.schema_name)
+        if args.dematerialize is not None:
+            logging.warning("Dropping materialized playlist %s...", args.dematerialize)
+            dematerialize_playlist(cur, args.schema_name, args.dematerialize)
+        if args.materialize is not None:
+            logging.warning("Materializing playlist %s...", args.materialize)
+            materialized_view = materialize_playlist(cur, args.schema_name, args.materialize, args.period)
+            logging.warning("Playlist %s is materialized as %s and refreshed by each import", args.materialize,
+                            materialized_view)
+        close_db(conn, cur)
+        return
 
-    # Create normalised data structure
-    conn, cur = open_db(db_name, port, username, password)
-    logging.warning("Creating the new tables...")
-    create_normalised_tables(cur, schema_name)
-    close_db(conn, cur)
+    if args.index_report:
+        conn, cur = open_db(args.database_name, args.port, args.username, args.password, args.backend)
+        log_index_report(cur, args.schema_name)
+        close_db(conn, cur)
+        return
 
-    # Migrate data over to new structure
-    conn, cur = open_db(db_name, port, username, password)
-    logging.warning("Migrating data to new tables...")
-    normalise_data(cur, schema_name)
-    close_db(conn, cur)
+    if not os.path.isfile(args.library_file):
+        sys.exit("Library file not found at location: " + args.library_file)
+    import_library(args)
 
 
 def parse_args(arg_list):
     parser = argparse.ArgumentParser()
     parser.add_argument('--library',
-                        help='Path to XML library file',
-                        dest='library_xml',
-                        type=argparse.FileType('rb'),
+                        help='Path to XML library file [%(default)s]',
+                        dest='library_file',
                         default=DEFAULT_LIBRARY_FILE_LOCATION)
+    parser.add_argument('--backend',
+                        help='Database to import to, a postgres server or an SQLite database file that needs no '
+                             'server [%(default)s]',
+                        dest='backend',
+                        choices=['postgres', 'sqlite'],
+                        default=DEFAULT_BACKEND)
     parser.add_argument('--db', '-d',
-                        help='Name of postgres database [%(default)s]',
+                        help='Name of postgres database, or path of the SQLite database file, with {0} added if it '
+                             'has no extension [%(default)s]'.format(sqlite_backend.DEFAULT_SUFFIX),
                         dest='database_name',
                         default=DEFAULT_DATABASE_NAME)
     parser.add_argument('--port', '-p',
@@ -83,22 +190,670 @@ def parse_args(arg_list):
                         help='Postgres password [%(default)s]',
                         dest='password',
                         default=DEFAULT_PASSWORD)
+    parser.add_argument('--staging-method',
+                        help='How tracks are loaded into the staging table, COPY or batched INSERTs [%(default)s]',
+                        dest='staging_method',
+                        choices=['copy', 'values'],
+                        default=DEFAULT_STAGING_METHOD)
+    parser.add_argument('--batch-size',
+                        help='Number of tracks loaded into the staging table per round trip [%(default)s]',
+                        dest='batch_size',
+                        type=int,
+                        default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--delta',
+                        help='Only stage and migrate tracks that changed since the last import',
+                        dest='delta',
+                        action='store_true')
+    parser.add_argument('--cache',
+                        help='Path to the cache of parsed library tracks [%(default)s]',
+                        dest='cache_file',
+                        default=DEFAULT_CACHE_FILE_LOCATION)
+    parser.add_argument('--force-reparse',
+                        help='Parse the library file even if it is unchanged since the last import',
+                        dest='force_reparse',
+                        action='store_true')
+    parser.add_argument('--skip-if-unchanged',
+                        help='Exit without importing if the library file is unchanged since the last import',
+                        dest='skip_if_unchanged',
+                        action='store_true')
+    parser.add_argument('--rebuild-rollup',
+                        help='Rebuild the play_daily rollup from the full play history and exit',
+                        dest='rebuild_rollup',
+                        action='store_true')
+    parser.add_argument('--index-report',
+                        help='Report the playlist views that read a table by a column the schema is missing an '
+                             'index on, and exit',
+                        dest='index_report',
+                        action='store_true')
+    parser.add_argument('--partition-play',
+                        help='Range partition the play table by month or year, migrating an existing play table',
+                        dest='partition_play',
+                        choices=['month', 'year'])
+    parser.add_argument('--materialize',
+                        help='Keep the rows of a playlist view in a materialized view that exports read instead, '
+                             'refreshed by each import that changed the data it depends on, and exit',
+                        dest='materialize')
+    parser.add_argument('--period',
+                        help='Dates a materialized playlist counts plays between, e.g. 2019-01-01 2019-02-01. It is '
+                             'only refreshed for plays around that period and never again once it has passed.',
+                        dest='period',
+                        nargs=2,
+                        metavar=('START', 'END'),
+                        type=datetime.date.fromisoformat)
+    parser.add_argument('--dematerialize',
+                        help='Drop the materialized view of a playlist view, so exports read the view itself again, '
+                             'and exit',
+                        dest='dematerialize')
+    parser.add_argument('--workers', '-w',
+                        help='Number of connections loading the staging table of a full import concurrently '
+                             '[%(default)s]',
+                        dest='workers',
+                        type=int,
+                        default=DEFAULT_WORKERS)
+    parser.add_argument('--explain',
+                        help='Capture EXPLAIN (ANALYZE, BUFFERS) of each SQL statement in the report. Statements are '
+                             'run twice, once inside a savepoint that is rolled back.',
+                        dest='explain',
+                        action='store_true')
+    parser.add_argument('--report',
+                        help='Path to write a JSON report of the time, rows and memory taken by each phase to',
+                        dest='report_file')
+    parser.add_argument('--metrics-table',
+                        help='Table to append the JSON report to, created if it does not exist',
+                        dest='metrics_table')
     args = parser.parse_args(arg_list)
+
+    if args.backend == 'sqlite':
+        unsupported = [option for option, value in (('--partition-play', args.partition_play),
+                                                    ('--materialize', args.materialize),
+                                                    ('--dematerialize', args.dematerialize),
+                                                    ('--explain', args.explain),
+                                                    ('--metrics-table', args.metrics_table),
+                                                    ('--index-report', args.index_report))
+                       if value]
+        if unsupported:
+            parser.error("not supported by the sqlite backend: " + ", ".join(unsupported))
+    elif psycopg2 is None:
+        parser.error("the postgres backend needs psycopg2, which is not installed")
     return args
 
 
-def import_itunes_data(db, tracks, tracks_table):
-    db.execute("DROP SCHEMA IF EXISTS itunes CASCADE")
-    db.execute("CREATE SCHEMA itunes")
-    db.execute("DROP TABLE IF EXISTS {0}.{1}".format(TEMPORARY_SCHEMA_NAME, TEMPORARY_TABLE_NAME))
-    db.execute(tracks_table)
-    db.execute("CREATE UNIQUE INDEX idx_itunes_itunes_id ON itunes.itunes (persistent_id);")
+def import_library(args, shared_conn=None):
+    # Imports the library file with the given import options, returning the number of new or changed tracks staged.
+    # Each step runs in a transaction of its own, on a connection of its own unless one to share between them is given.
+    # The file is only opened here, so the maintenance modes work without one.
+    with open(args.library_file, 'rb') as library_xml:
+        return import_library_xml(args, library_xml, shared_conn)
+
+
+def import_library_xml(args, library_xml, shared_conn=None):
+    db_name = args.database_name
+    schema_name = args.schema_name
+    port = args.port
+    username = args.username
+    batch_size = args.batch_size
+    cache_file = args.cache_file
+
+    instrumentation.start('import-to-postgres', args.explain)
+
+    # The filtered tracks of the last successfully imported library file are cached, keyed by its identity and the
+    # database they were imported to, so the same file is still imported into any other database
+    with instrumentation.phase('identify library'):
+        library_identity = get_library_identity(library_xml) + get_import_target(args)
+    cached = not args.force_reparse and read_cached_identity(cache_file) == library_identity
+
+    if cached and args.skip_if_unchanged:
+        logging.warning("Library file at location %s is unchanged since the last import, skipping", library_xml.name)
+        return 0
+
+    if args.backend == 'sqlite':
+        logging.warning("Importing data to SQLite database file %s", sqlite_backend.get_database_file(db_name))
+    else:
+        logging.warning("Connecting to database %s on port %s with username %s. Importing data to schema %s",
+                        db_name, port, username, schema_name)
+
+    if cached:
+        logging.warning("Library file is unchanged, reading tracks from cache at location: %s", cache_file)
+        tracks = instrumentation.iterate('read cache', read_cached_tracks(cache_file))
+    else:
+        logging.warning("Parsing library file at location: %s", library_xml.name)
+        tracks = instrumentation.iterate('parse', iter_library_tracks(library_xml))
+        tracks = instrumentation.iterate('filter', process_tracks(tracks))
+        tracks = instrumentation.iterate('write cache',
+                                         write_cached_tracks(tracks, cache_file, library_identity, batch_size))
+
+    tracks = instrumentation.iterate('fingerprint', fingerprint_tracks(tracks))
+
+    if args.backend == 'sqlite':
+        changed = import_tracks_sqlite(args, tracks, shared_conn)
+    else:
+        changed = import_tracks(args, tracks, shared_conn)
+
+    if not cached:
+        commit_cached_tracks(cache_file)
+
+    report = instrumentation.get_report()
+    instrumentation.log_summary(report)
+    if args.report_file is not None:
+        instrumentation.write_report(report, args.report_file)
+    if args.metrics_table is not None:
+        with transaction(args, shared_conn) as (conn, cur):
+            instrumentation.store_report(conn, report, args.metrics_table)
+    return changed
+
+
+def import_tracks(args, tracks, shared_conn=None):
+    db_name = args.database_name
+    schema_name = args.schema_name
+    port = args.port
+    username = args.username
+    password = args.password
+    staging_method = args.staging_method
+    batch_size = args.batch_size
+    workers = args.workers
+
+    # Create normalised data structure, unless it is already up to date
+    with transaction(args, shared_conn) as (conn, cur):
+        with instrumentation.phase('create tables'):
+            if not schema_is_current(cur, schema_name):
+                logging.warning("Creating the new tables...")
+                migrate_schema(cur, schema_name, args.partition_play)
+            play_partitioning = get_play_partitioning(cur, schema_name, args.partition_play)
+            if args.partition_play is not None and play_partitioning is None:
+                logging.warning("Migrating play table to partitions by %s...", args.partition_play)
+                migrate_play_partitions(cur, schema_name, args.partition_play)
+                play_partitioning = args.partition_play
+            delta = (args.delta and staging_table_populated(cur) and staging_table_typed(cur)
+                     and track_details_exist(cur, schema_name))
+            fingerprints = fetch_track_fingerprints(cur, schema_name) if delta else None
+
+    if delta:
+        # Only tracks whose fingerprint changed since the last run are staged and merged, all in one transaction so
+        # the stored fingerprints never get ahead of the normalised tables
+        with transaction(args, shared_conn) as (conn, cur):
+            logging.warning("Importing changed tracks into temp schema...")
+            with instrumentation.phase('stage') as counts:
+                changed_tracks = instrumentation.iterate('filter changed', filter_changed_tracks(tracks, fingerprints))
+                counts['rows'] = changed = import_itunes_delta(cur, changed_tracks, staging_method, batch_size)
+            logging.warning("%s new or changed tracks found", changed)
+            if changed:
+                logging.warning("Migrating changed tracks to new tables...")
+                with instrumentation.phase('normalise'):
+                    normalise_data(cur, schema_name, TEMPORARY_DELTA_TABLE_NAME, play_partitioning)
+    else:
+        # Import data 'as-is' to postgres, one batch at a time as it is parsed
+        loader_pool = None
+        if workers > 1:
+            loader_pool = psycopg2.pool.ThreadedConnectionPool(1, workers, host="localhost", database=db_name,
+                                                               port=port, user=username, password=password,
+                                                               cursor_factory=instrumentation.InstrumentedCursor)
+        try:
+            with transaction(args, shared_conn) as (conn, cur):
+                logging.warning("Importing data into temp schema...")
+                with instrumentation.phase('stage') as counts:
+                    counts['rows'] = changed = import_itunes_data(conn, cur, tracks, staging_method, batch_size,
+                                                                  loader_pool, workers)
+        finally:
+            if loader_pool is not None:
+                loader_pool.closeall()
+
+        with transaction(args, shared_conn) as (conn, cur):
+            logging.warning("Swapping in the new temp schema...")
+            with instrumentation.phase('swap'):
+                swap_staging_schema(conn, cur)
+
+        # Migrate data over to new structure
+        with transaction(args, shared_conn) as (conn, cur):
+            logging.warning("Migrating data to new tables...")
+            with instrumentation.phase('normalise'):
+                normalise_data(cur, schema_name, play_partitioning=play_partitioning)
+    return changed
+
+
+def import_tracks_sqlite(args, tracks, shared_conn=None):
+    # The database file is written in a single transaction, staging and all, while exports can keep reading it
+    with transaction(args, shared_conn) as (conn, cur):
+        with instrumentation.phase('create tables'):
+            migrate_sqlite_schema(cur)
+            delta = args.delta and sqlite_backend.track_details_exist(cur)
+            fingerprints = sqlite_backend.fetch_track_fingerprints(cur) if delta else None
+
+        if delta:
+            tracks = instrumentation.iterate('filter changed', filter_changed_tracks(tracks, fingerprints))
+        logging.warning("Importing %s into temp table...", "changed tracks" if delta else "data")
+        with instrumentation.phase('stage') as counts:
+            counts['rows'] = changed = sqlite_backend.stage_tracks(cur, tracks, STAGING_COLUMN_TYPES, args.batch_size)
+        logging.warning("%s new or changed tracks found", changed)
+        if changed:
+            logging.warning("Migrating data to new tables...")
+            with instrumentation.phase('normalise'):
+                sqlite_backend.normalise_data(cur, TRACK_DETAIL_COLUMNS, FINGERPRINT_COLUMN_NAME)
+    return changed
+
+
+def import_itunes_data(conn, db, tracks, staging_method=DEFAULT_STAGING_METHOD, batch_size=DEFAULT_BATCH_SIZE,
+                       loader_pool=None, workers=DEFAULT_WORKERS):
+    # Staging data is built in a schema of its own that swap_staging_schema later moves into place, so nothing reading
+    # the current staging data is blocked while the import runs. The staging table can always be rebuilt from the
+    # library, so it is UNLOGGED to skip the write-ahead log.
+    db.execute("DROP SCHEMA IF EXISTS {0} CASCADE".format(TEMPORARY_BUILD_SCHEMA_NAME))
+    db.execute("CREATE SCHEMA {0}".format(TEMPORARY_BUILD_SCHEMA_NAME))
+    db.execute("CREATE UNLOGGED TABLE IF NOT EXISTS {0}.{1} ({2})"
+               .format(TEMPORARY_BUILD_SCHEMA_NAME,
+                       TEMPORARY_TABLE_NAME,
+                       ', '.join(key + ' ' + column_type for key, column_type in STAGING_COLUMN_TYPES.items())))
+    column_types = collections.OrderedDict(STAGING_COLUMN_TYPES)
+
+    if loader_pool is None:
+        staged = stage_tracks(db, tracks, [TEMPORARY_TABLE_NAME], column_types, staging_method, batch_size,
+                              TEMPORARY_BUILD_SCHEMA_NAME)
+    else:
+        # The loaders' connections can only see the staging table once it is committed. Nothing else reads the build
+        # schema until it is swapped into place, so this is safe.
+        conn.commit()
+        staged = stage_tracks_parallel(conn, db, loader_pool, workers, tracks, column_types, staging_method,
+                                       batch_size, TEMPORARY_BUILD_SCHEMA_NAME)
+
+    db.execute("CREATE UNIQUE INDEX idx_itunes_itunes_id ON {0}.{1} (persistent_id);"
+               .format(TEMPORARY_BUILD_SCHEMA_NAME, TEMPORARY_TABLE_NAME))
+    return staged
+
+
+def swap_staging_schema(conn, cur):
+    # Renaming schemas only touches the catalog, so the swap is a short transaction that never waits on queries
+    # reading the old staging table. They keep reading it until it is dropped, which only the importer waits for.
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE".format(TEMPORARY_OLD_SCHEMA_NAME))
+    if schema_exists(cur, TEMPORARY_SCHEMA_NAME):
+        cur.execute("ALTER SCHEMA {0} RENAME TO {1}".format(TEMPORARY_SCHEMA_NAME, TEMPORARY_OLD_SCHEMA_NAME))
+    cur.execute("ALTER SCHEMA {0} RENAME TO {1}".format(TEMPORARY_BUILD_SCHEMA_NAME, TEMPORARY_SCHEMA_NAME))
+    conn.commit()
+
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE".format(TEMPORARY_OLD_SCHEMA_NAME))
+
+
+def schema_exists(db, schema_name):
+    db.execute("SELECT EXISTS (SELECT FROM pg_namespace WHERE nspname = %s)", [schema_name])
+    return db.fetchone()[0]
+
+
+def import_itunes_delta(db, tracks, staging_method=DEFAULT_STAGING_METHOD, batch_size=DEFAULT_BATCH_SIZE):
+    db.execute("DROP TABLE IF EXISTS {0}.{1}".format(TEMPORARY_SCHEMA_NAME, TEMPORARY_DELTA_TABLE_NAME))
+    db.execute("CREATE UNLOGGED TABLE {0}.{1} (LIKE {0}.{2})".format(TEMPORARY_SCHEMA_NAME,
+                                                                   TEMPORARY_DELTA_TABLE_NAME,
+                                                                   TEMPORARY_TABLE_NAME))
+
+    # New keys are added to the full staging table as well, so the two can be merged column for column
+    column_types = get_staging_column_types(db, TEMPORARY_TABLE_NAME)
+    staged = stage_tracks(db, tracks, [TEMPORARY_DELTA_TABLE_NAME, TEMPORARY_TABLE_NAME], column_types,
+                          staging_method, batch_size)
+
+    columns = ', '.join(get_staging_column_types(db, TEMPORARY_DELTA_TABLE_NAME))
+    db.execute("DELETE FROM {0}.{1} i "
+               " USING {0}.{2} d "
+               " WHERE i.persistent_id = d.persistent_id;"
+               .format(TEMPORARY_SCHEMA_NAME, TEMPORARY_TABLE_NAME, TEMPORARY_DELTA_TABLE_NAME))
+    db.execute("INSERT INTO {0}.{1} ({3}) "
+               "SELECT {3} "
+               "  FROM {0}.{2};"
+               .format(TEMPORARY_SCHEMA_NAME, TEMPORARY_TABLE_NAME, TEMPORARY_DELTA_TABLE_NAME, columns))
+    return staged
+
+
+def stage_tracks(db, tracks, table_names, column_types, staging_method, batch_size,
+                 schema_name=TEMPORARY_SCHEMA_NAME):
+    # The full set of keys isn't known until the last track has been parsed, so columns are added as they appear
+    # and each batch is loaded over the union of the keys of its own tracks
+    staged = 0
+    for batch in batched(tracks, batch_size):
+        batch_types, new_types, widened_keys = get_staging_column_changes(batch, column_types)
+        alter_staging_columns(db, new_types, widened_keys, table_names, column_types, schema_name)
+
+        load_types = collections.OrderedDict((key, column_types[key]) for key in batch_types)
+        if staging_method == 'copy':
+            copy_tracks(db, batch, load_types, table_names[0], schema_name)
+        else:
+            insert_tracks(db, batch, load_types, table_names[0], schema_name)
+        staged += len(batch)
+    return staged
+
+
+def stage_tracks_parallel(conn, db, loader_pool, workers, tracks, column_types, staging_method, batch_size,
+                          schema_name=TEMPORARY_SCHEMA_NAME):
+    # Batches are loaded concurrently by a pool of connections, each committing its own batches. New columns are
+    # still added by the main connection and committed straight away, before any batch that needs them is loaded.
+    def load_batch(batch, load_types):
+        loader_conn = loader_pool.getconn()
+        try:
+            with loader_conn.cursor() as loader_cur:
+                if staging_method == 'copy':
+                    copy_tracks(loader_cur, batch, load_types, TEMPORARY_TABLE_NAME, schema_name)
+                else:
+                    insert_tracks(loader_cur, batch, load_types, TEMPORARY_TABLE_NAME, schema_name)
+            loader_conn.commit()
+        except Exception:
+            loader_conn.rollback()
+            raise
+        finally:
+            loader_pool.putconn(loader_conn)
+        return len(batch)
+
+    staged = 0
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in batched(tracks, batch_size):
+            batch_types, new_types, widened_keys = get_staging_column_changes(batch, column_types)
+            if widened_keys:
+                # Batches already handed to the loaders were encoded for the column types before widening
+                while pending:
+                    staged += pending.popleft().result()
+            if new_types or widened_keys:
+                alter_staging_columns(db, new_types, widened_keys, [TEMPORARY_TABLE_NAME], column_types, schema_name)
+                conn.commit()
+
+            load_types = collections.OrderedDict((key, column_types[key]) for key in batch_types)
+            pending.append(executor.submit(load_batch, batch, load_types))
+            if len(pending) > workers:
+                staged += pending.popleft().result()
+        while pending:
+            staged += pending.popleft().result()
+    return staged
+
+
+def staging_table_populated(db):
+    # The staging table is UNLOGGED, so it comes back empty after a database crash
+    db.execute("SELECT to_regclass('{0}.{1}') IS NOT NULL".format(TEMPORARY_SCHEMA_NAME, TEMPORARY_TABLE_NAME))
+    if not db.fetchone()[0]:
+        return False
+    db.execute("SELECT EXISTS (SELECT FROM {0}.{1})".format(TEMPORARY_SCHEMA_NAME, TEMPORARY_TABLE_NAME))
+    return db.fetchone()[0]
+
+
+def staging_table_typed(db):
+    # Staging tables from before column types were inferred have nothing but TEXT columns
+    column_types = get_staging_column_types(db, TEMPORARY_TABLE_NAME)
+    return all(column_types.get(key) == column_type for key, column_type in STAGING_COLUMN_TYPES.items())
+
+
+def get_staging_column_types(db, table_name, schema_name=TEMPORARY_SCHEMA_NAME):
+    db.execute("SELECT attname, "
+               "       typname "
+               "  FROM pg_attribute "
+               "  JOIN pg_type ON (pg_type.oid = atttypid) "
+               " WHERE attrelid = %s :: REGCLASS "
+               "   AND attnum > 0 "
+               "   AND NOT attisdropped "
+               " ORDER BY attnum",
+               [schema_name + '.' + table_name])
+    return collections.OrderedDict(db.fetchall())
+
+
+def track_details_exist(db, schema_name):
+    db.execute("SELECT EXISTS (SELECT FROM {0}.track_detail)".format(schema_name))
+    return db.fetchone()[0]
+
+
+def fetch_track_fingerprints(db, schema_name):
+    db.execute("SELECT itunes_id, fingerprint FROM {0}.track_fingerprint".format(schema_name))
+    return dict(db.fetchall())
+
+
+def get_staging_column_changes(tracks, column_types):
+    # Each key's column is typed from the plist types of its values. A key whose values don't agree on a type is
+    # staged as text, widening its column if it was created with another type for an earlier batch.
+    batch_types = collections.OrderedDict()
+    for track in tracks:
+        for key, value in track.items():
+            value_type = STAGING_COLUMN_TYPES.get(key) or PLIST_VALUE_TYPES.get(type(value), 'text')
+            if batch_types.setdefault(key, value_type) != value_type:
+                batch_types[key] = 'text'
+
+    new_types = collections.OrderedDict((key, column_type) for key, column_type in batch_types.items()
+                                        if key not in column_types)
+    widened_keys = [key for key, column_type in batch_types.items()
+                    if key in column_types and key not in STAGING_COLUMN_TYPES
+                    and column_types[key] not in (column_type, 'text')]
+    return batch_types, new_types, widened_keys
+
+
+def alter_staging_columns(db, new_types, widened_keys, table_names, column_types, schema_name=TEMPORARY_SCHEMA_NAME):
+    for table_name in table_names:
+        if new_types:
+            add_staging_columns(db, new_types, table_name, schema_name)
+        if widened_keys:
+            db.execute("ALTER TABLE {0}.{1} {2}"
+                       .format(schema_name,
+                               table_name,
+                               ', '.join("ALTER COLUMN {0} TYPE TEXT USING {0} :: TEXT".format(key)
+                                         for key in widened_keys)))
+    column_types.update(new_types)
+    column_types.update((key, 'text') for key in widened_keys)
+
+
+def add_staging_columns(db, column_types, table_name=TEMPORARY_TABLE_NAME, schema_name=TEMPORARY_SCHEMA_NAME):
+    db.execute("ALTER TABLE {0}.{1} {2}".format(schema_name,
+                                               table_name,
+                                               ', '.join("ADD COLUMN " + key + " " + column_type
+                                                         for key, column_type in column_types.items())))
+
+
+def copy_tracks(db, tracks, column_types, table_name=TEMPORARY_TABLE_NAME, schema_name=TEMPORARY_SCHEMA_NAME):
+    # Tracks are sent in COPY's binary format, so the server has no text to parse into the typed columns
+    field_count = struct.pack('!h', len(column_types))
+    buffer = io.BytesIO()
+    buffer.write(BINARY_COPY_HEADER)
+    for track in tracks:
+        buffer.write(field_count)
+        for key, column_type in column_types.items():
+            value = track.get(key)
+            if value is None:
+                buffer.write(struct.pack('!i', -1))
+            else:
+                value = get_binary_value(value, column_type)
+                buffer.write(struct.pack('!i', len(value)))
+                buffer.write(value)
+    buffer.write(BINARY_COPY_TRAILER)
+    buffer.seek(0)
+
+    db.copy_expert("COPY {0}.{1} ({2}) FROM STDIN WITH (FORMAT binary)".format(schema_name,
+                                                                               table_name,
+                                                                               ', '.join(column_types)),
+                   buffer)
+
+
+def insert_tracks(db, tracks, column_types, table_name=TEMPORARY_TABLE_NAME, schema_name=TEMPORARY_SCHEMA_NAME):
+    text_keys = set(key for key, column_type in column_types.items() if column_type == 'text')
+    psycopg2.extras.execute_values(db,
+                                   "INSERT INTO {0}.{1} ({2}) VALUES %s".format(schema_name,
+                                                                                table_name,
+                                                                                ', '.join(column_types)),
+                                   [[get_text_value(track.get(key)) if key in text_keys else track.get(key)
+                                     for key in column_types] for track in tracks],
+                                   page_size=len(tracks))
+
+
+def get_binary_value(value, column_type):
+    if column_type == 'bool':
+        return b'\x01' if value else b'\x00'
+    if column_type == 'int4':
+        return struct.pack('!i', int(value))
+    if column_type == 'int8':
+        return struct.pack('!q', int(value))
+    if column_type == 'float8':
+        return struct.pack('!d', float(value))
+    if column_type == 'timestamp':
+        return struct.pack('!q', (value - POSTGRES_EPOCH) // datetime.timedelta(microseconds=1))
+    if column_type == 'bytea':
+        return value
+    if column_type in ('text', 'varchar', 'bpchar'):
+        return get_text_value(value).encode('utf-8')
+    raise ValueError("Unsupported staging column type: " + column_type)
+
+
+def get_text_value(value):
+    # Values are rendered the same way postgres would cast them to TEXT, so widening a typed column to TEXT and
+    # loading a value straight into a TEXT column agree
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, bytes):
+        return '\\x' + value.hex()
+    return str(value)
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def schema_is_current(db, schema_name):
+    # Two catalog lookups, so imports of an up to date schema run no DDL at all
+    db.execute("SELECT to_regclass(%s) IS NOT NULL", [schema_name + '.schema_version'])
+    if not db.fetchone()[0]:
+        return False
+    return get_schema_version(db, schema_name) >= SCHEMA_MIGRATIONS[-1][0]
+
+
+def get_schema_version(db, schema_name):
+    db.execute("SELECT COALESCE(MAX(version), 0) FROM {0}.schema_version".format(schema_name))
+    return db.fetchone()[0]
 
-    for query in tracks:
-        db.execute(query[0], list(query[1]))
 
+def migrate_schema(db, schema_name, play_partitioning=None):
+    # Applies the migrations newer than the schema's version in order, recording each one. Schemas from before
+    # versioning start at version 0, every migration being safe to run against a schema that already has its changes.
+    db.execute("CREATE SCHEMA IF NOT EXISTS {0}".format(schema_name))
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.schema_version ("
+               "version INT NOT NULL,"
+               "description TEXT NOT NULL,"
+               "migrated_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,"
+               "CONSTRAINT pk_schema_version PRIMARY KEY (version)"
+               ");"
+               .format(schema_name))
+    # Concurrent imports wait here for the first one to finish migrating
+    db.execute("LOCK TABLE {0}.schema_version IN SHARE ROW EXCLUSIVE MODE".format(schema_name))
+    version = get_schema_version(db, schema_name)
+
+    for migration_version, description, migrate in SCHEMA_MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logging.warning("Migrating schema %s to version %s: %s", schema_name, migration_version, description)
+        migrate(db, schema_name, play_partitioning)
+        db.execute("INSERT INTO {0}.schema_version (version, description) VALUES (%s, %s);".format(schema_name),
+                   [migration_version, description])
+
+
+def migrate_sqlite_schema(db):
+    if not sqlite_backend.schema_is_current(db):
+        logging.warning("Creating the new tables...")
+        sqlite_backend.migrate_schema(db, TRACK_DETAIL_COLUMNS)
+
+
+def create_view_indexes(db, schema_name, index_names):
+    for index_name in index_names:
+        table_name, column = VIEW_INDEXES[index_name]
+        db.execute("CREATE INDEX IF NOT EXISTS {1} ON {0}.{2} ({3});".format(schema_name, index_name, table_name,
+                                                                           column))
+
+
+def add_play_index(db, schema_name, play_partitioning=None):
+    # Views counting plays in a period filter play by played_at, which uk_play_track_play_at doesn't lead with
+    create_view_indexes(db, schema_name, ['idx_play_played_at'])
+
+
+def add_track_indexes(db, schema_name, play_partitioning=None):
+    # Views join track to album and artist, which uk_track_artist_album doesn't lead with either
+    create_view_indexes(db, schema_name, ['idx_track_album_id', 'idx_track_artist_id'])
+
+
+def drop_duplicate_track_index(db, schema_name, play_partitioning=None):
+    # uk_track_itunes_id is already a unique index on itunes_id, this one only slowed down writes to track
+    db.execute("DROP INDEX IF EXISTS {0}.idx_track_itunes_id".format(schema_name))
+
+
+def add_play_daily_index(db, schema_name, play_partitioning=None):
+    # Views counting plays in a period filter the daily rollup by day, which pk_play_daily doesn't lead with
+    create_view_indexes(db, schema_name, ['idx_play_daily_day'])
+
+
+def log_index_report(db, schema_name):
+    # A view would benefit from a missing index if it reads the index's column and its plan scans the index's table
+    # sequentially as things are
+    missing = [(index_name, table_name, column)
+               for index_name, (table_name, column) in VIEW_INDEXES.items()
+               if not index_exists(db, schema_name, table_name, column)]
+    if not missing:
+        logging.warning("Schema %s has every index the playlist views rely on", schema_name)
+        return
+
+    scanned_tables = {}
+    for index_name, table_name, column in missing:
+        views = []
+        for view_name in get_column_views(db, schema_name, table_name, column):
+            # Each view is only explained once, however many missing indexes it reads the columns of
+            if view_name not in scanned_tables:
+                scanned_tables[view_name] = get_scanned_tables(db, view_name)
+            if table_name in scanned_tables[view_name]:
+                views.append(view_name)
+        logging.warning("Index %s on %s.%s (%s) is missing, %s", index_name, schema_name, table_name, column,
+                        "which would benefit views: " + ", ".join(views) if views else "but no view would benefit")
+    if not schema_is_current(db, schema_name):
+        logging.warning("Importing migrates schema %s to version %d, adding them", schema_name,
+                        SCHEMA_MIGRATIONS[-1][0])
+
+
+def index_exists(db, schema_name, table_name, column):
+    db.execute("SELECT EXISTS (SELECT "
+               "                 FROM pg_index i "
+               "                 JOIN pg_attribute a ON (a.attrelid = i.indrelid "
+               "                                         AND a.attnum = i.indkey[0]) "
+               "                WHERE i.indrelid = to_regclass(%s) "
+               "                  AND a.attname = %s)",
+               [schema_name + '.' + table_name, column])
+    return db.fetchone()[0]
+
+
+def get_column_views(db, schema_name, table_name, column):
+    # Views record a dependency on each table column they read
+    db.execute("SELECT DISTINCT v.oid :: REGCLASS :: TEXT "
+               "  FROM pg_depend d "
+               "  JOIN pg_rewrite r ON (r.oid = d.objid) "
+               "  JOIN pg_class v ON (v.oid = r.ev_class) "
+               "  JOIN pg_attribute a ON (a.attrelid = d.refobjid "
+               "                          AND a.attnum = d.refobjsubid) "
+               " WHERE d.refobjid = to_regclass(%s) "
+               "   AND a.attname = %s "
+               "   AND v.oid <> d.refobjid "
+               "   AND v.relkind = 'v' "
+               " ORDER BY 1",
+               [schema_name + '.' + table_name, column])
+    return [row[0] for row in db.fetchall()]
 
-def create_normalised_tables(db, schema_name):
+
+def get_scanned_tables(db, view_name):
+    # The tables the view's plan reads with a sequential scan, partitions counting as their partitioned table
+    db.execute("EXPLAIN (FORMAT JSON) SELECT * FROM {0}".format(view_name))
+    nodes = [db.fetchone()[0][0]['Plan']]
+    relations = set()
+    while nodes:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        if node['Node Type'] == 'Seq Scan':
+            relations.add(node['Relation Name'])
+    db.execute("SELECT c.relname, "
+               "       COALESCE(p.relname, c.relname) "
+               "  FROM pg_class c "
+               "  LEFT JOIN pg_inherits i ON (i.inhrelid = c.oid) "
+               "  LEFT JOIN pg_class p ON (p.oid = i.inhparent) "
+               " WHERE c.relname = ANY(%s)",
+               [list(relations)])
+    return {table_name for _, table_name in db.fetchall()}
+
+
+def create_normalised_tables(db, schema_name, play_partitioning=None):
     db.execute("CREATE SCHEMA IF NOT EXISTS {0}".format(schema_name))
 
     db.execute("CREATE TABLE IF NOT EXISTS {0}.artist ("
@@ -143,159 +898,410 @@ def create_normalised_tables(db, schema_name):
                "CONSTRAINT uk_track_itunes_id UNIQUE (itunes_id));"
                .format(schema_name))
 
-    db.execute("CREATE TABLE IF NOT EXISTS {0}.play ("
-               "play_id BIGINT GENERATED BY DEFAULT AS IDENTITY,"
-               "track_id BIGINT,"
+    db.execute(get_play_table_definition(schema_name, play_partitioning))
+
+    # Everything the exporters need, with a primary key covering the fields an M3U playlist is written from
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.track_detail ({1}, "
+               "CONSTRAINT pk_track_detail PRIMARY KEY (itunes_id) INCLUDE (name, artist, total_time, location)"
+               ");"
+               .format(schema_name, ', '.join(column + ' ' + column_type
+                                             for column, column_type in TRACK_DETAIL_COLUMNS.values())))
+
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.play_daily ("
+               "track_id BIGINT NOT NULL,"
+               "day DATE NOT NULL,"
+               "plays INT NOT NULL,"
+               "CONSTRAINT pk_play_daily PRIMARY KEY (track_id, day),"
+               "CONSTRAINT fk_play_daily_track_id FOREIGN KEY (track_id) REFERENCES {0}.track (track_id),"
+               "CONSTRAINT ck_play_daily_plays CHECK (plays > 0)"
+               ");"
+               .format(schema_name))
+
+    # Seed the rollup from any play history that predates it. The check is evaluated once, so this is free otherwise.
+    db.execute("INSERT INTO {0}.play_daily (track_id, day, plays) "
+               "SELECT track_id, "
+               "       played_at :: DATE, "
+               "       COUNT(*) "
+               "  FROM {0}.play "
+               " WHERE NOT EXISTS (SELECT FROM {0}.play_daily) "
+               " GROUP BY track_id, played_at :: DATE;"
+               .format(schema_name))
+
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.play_watermark ("
+               "track_id BIGINT NOT NULL,"
                "played_at TIMESTAMP NOT NULL,"
-               "CONSTRAINT pk_play PRIMARY KEY (play_id),"
-               "CONSTRAINT fk_play_track_id FOREIGN KEY (track_id) REFERENCES {0}.track (track_id),"
-               "CONSTRAINT uk_play_track_play_at UNIQUE (track_id, played_at)"
+               "CONSTRAINT pk_play_watermark PRIMARY KEY (track_id),"
+               "CONSTRAINT fk_play_watermark_track_id FOREIGN KEY (track_id) REFERENCES {0}.track (track_id)"
                ");"
                .format(schema_name))
 
-    db.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_track_itunes_id ON {0}.track (itunes_id);".format(schema_name))
+    db.execute("INSERT INTO {0}.play_watermark (track_id, played_at) "
+               "SELECT track_id, "
+               "       MAX(played_at) "
+               "  FROM {0}.play "
+               " WHERE track_id IS NOT NULL "
+               "   AND NOT EXISTS (SELECT FROM {0}.play_watermark) "
+               " GROUP BY track_id;"
+               .format(schema_name))
 
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.track_fingerprint ("
+               "itunes_id VARCHAR(16) NOT NULL,"
+               "fingerprint CHAR(40) NOT NULL,"
+               "CONSTRAINT pk_track_fingerprint PRIMARY KEY (itunes_id)"
+               ");"
+               .format(schema_name))
 
-def normalise_data(db, schema_name):
-    db.execute("INSERT INTO {0}.artist (artist_name) "
-               "SELECT artist "
-               "  FROM itunes.itunes "
-               " WHERE artist IS NOT NULL "
-               " GROUP BY artist "
-               "    ON CONFLICT (artist_name) "
-               "    DO NOTHING;"
+    # What each import changed, so materialized playlists are only refreshed when data they depend on changed
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.data_change ("
+               "change_id BIGINT GENERATED ALWAYS AS IDENTITY,"
+               "changed_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,"
+               "tracks_changed INT NOT NULL,"
+               "first_played_at TIMESTAMP,"
+               "last_played_at TIMESTAMP,"
+               "CONSTRAINT pk_data_change PRIMARY KEY (change_id)"
+               ");"
                .format(schema_name))
 
-    db.execute("INSERT INTO {0}.album (album_name, artist_id, release_year) "
-               "SELECT album, "
-               "       (SELECT artist_id "
-               "          FROM {0}.artist "
-               "         WHERE artist_name = artist), "
-               "       MAX(year :: INT) "
-               "  FROM itunes.itunes "
-               " WHERE album IS NOT NULL "
-               "   AND year IS NOT NULL "
-               " GROUP BY album, artist "
-               "    ON CONFLICT (album_name, artist_id)"
-               "    DO NOTHING;"
+    # Each materialized playlist's watermark is the last change it was refreshed for. A playlist of plays in a period
+    # is closed once plays after the period have been ingested, after which it is never refreshed again.
+    db.execute("CREATE TABLE IF NOT EXISTS {0}.playlist_watermark ("
+               "view_name TEXT NOT NULL,"
+               "materialized_view TEXT NOT NULL,"
+               "period_start TIMESTAMP,"
+               "period_end TIMESTAMP,"
+               "change_id BIGINT NOT NULL,"
+               "closed BOOLEAN NOT NULL DEFAULT FALSE,"
+               "refreshed_at TIMESTAMP NOT NULL DEFAULT LOCALTIMESTAMP,"
+               "CONSTRAINT pk_playlist_watermark PRIMARY KEY (view_name),"
+               "CONSTRAINT ck_playlist_watermark_period CHECK (period_start < period_end)"
+               ");"
                .format(schema_name))
 
-    db.execute("UPDATE {0}.track t "
-               "   SET track_name = i.name, "
-               "       length = i.total_time, "
-               "       album_id = i.album_id, "
-               "       artist_id = i.artist_id, "
-               "       play_count = i.play_count, "
-               "       last_played = i.play_date_utc, "
-               "       date_added = i.date_added, "
-               "       track_number = i.track_number, "
-               "       itunes_id = i.persistent_id, "
-               "       bpm = i.bpm, "
-               "       loved = i.loved "
-               "  FROM (SELECT name, "
-               "               total_time :: BIGINT, "
-               "               al.album_id, "
-               "               ar.artist_id, "
-               "               COALESCE(play_count :: INT, 0) AS play_count, "
-               "               play_date_utc :: TIMESTAMP, "
-               "               date_added :: TIMESTAMP, "
-               "               COALESCE(track_number :: INT, 1) AS track_number, "
-               "               bpm :: INT, "
-               "               COALESCE(loved :: BOOLEAN, FALSE) AS loved, "
-               "               persistent_id "
-               "          FROM itunes.itunes t "
-               "          JOIN {0}.artist ar ON (artist_name = artist) "
-               "          JOIN {0}.album al ON (album_name = album "
-               "                                 AND al.artist_id = ar.artist_id) "
-               ") AS i "
-               "WHERE t.itunes_id =  i.persistent_id "
-               "   OR (t.track_name, t.album_id, t.artist_id, t.track_number) "
-               "    = (i.name, i.album_id, i.artist_id, i.track_number); "
+
+def normalise_data(db, schema_name, source_table=TEMPORARY_TABLE_NAME, play_partitioning=None):
+    source_table = TEMPORARY_SCHEMA_NAME + '.' + source_table
+
+    library_sql.insert_artists_and_albums(db, schema_name, source_table)
+    _, updated, inserted = library_sql.merge_tracks(db, library_sql.POSTGRES, schema_name, source_table)
+
+    if play_partitioning is not None:
+        db.execute("SELECT DISTINCT DATE_TRUNC(%s, last_played) "
+                   "  FROM {0}.track"
+                   " WHERE last_played IS NOT NULL"
+                   "   AND itunes_id IN (SELECT persistent_id FROM {1})"
+                   .format(schema_name, source_table),
+                   [play_partitioning])
+        create_play_partitions(db, schema_name, play_partitioning, [row[0] for row in db.fetchall()])
+
+    _, first_played_at, last_played_at = ingest_plays(db, schema_name, source_table)
+
+    library_sql.update_track_details(db, schema_name, source_table, TRACK_DETAIL_COLUMNS)
+    library_sql.update_track_fingerprints(db, schema_name, source_table, FINGERPRINT_COLUMN_NAME)
+
+    record_data_change(db, schema_name, updated + inserted, first_played_at, last_played_at)
+    refresh_materialized_playlists(db, schema_name)
+
+
+def record_data_change(db, schema_name, tracks_changed, first_played_at, last_played_at):
+    if not tracks_changed and first_played_at is None:
+        return
+    db.execute("INSERT INTO {0}.data_change (tracks_changed, first_played_at, last_played_at) "
+               "VALUES (%s, %s, %s);"
+               .format(schema_name),
+               [tracks_changed, first_played_at, last_played_at])
+
+
+def refresh_materialized_playlists(db, schema_name):
+    # A playlist without a period is refreshed whenever tracks or plays changed. One with a period only once it has
+    # started, when tracks changed or plays were ingested from around the period, until it is closed.
+    db.execute("SELECT w.view_name, "
+               "       w.materialized_view "
+               "  FROM {0}.playlist_watermark w "
+               " WHERE NOT w.closed "
+               "   AND EXISTS (SELECT "
+               "                 FROM {0}.data_change c "
+               "                WHERE c.change_id > w.change_id "
+               "                  AND (w.period_start IS NULL "
+               "                       OR (c.first_played_at < w.period_end "
+               "                           AND c.last_played_at >= w.period_start) "
+               "                       OR (c.tracks_changed > 0 "
+               "                           AND c.changed_at >= w.period_start))) "
+               " ORDER BY w.view_name;"
                .format(schema_name))
+    playlists = db.fetchall()
+
+    # Exports keep reading the previous rows while a playlist is refreshed
+    for view_name, materialized_view in playlists:
+        logging.warning("Refreshing materialized playlist %s...", view_name)
+        db.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY {0}".format(materialized_view))
+
+    db.execute("UPDATE {0}.playlist_watermark "
+               "   SET change_id = (SELECT COALESCE(MAX(change_id), 0) FROM {0}.data_change), "
+               "       closed = COALESCE(period_end <= (SELECT MAX(played_at) FROM {0}.play_watermark), FALSE), "
+               "       refreshed_at = CASE WHEN view_name = ANY(%s) THEN LOCALTIMESTAMP ELSE refreshed_at END "
+               " WHERE NOT closed;"
+               .format(schema_name),
+               [[view_name for view_name, _ in playlists]])
+    return len(playlists)
+
+
+def materialize_playlist(db, schema_name, view_name, period=None):
+    # The rows of the view are kept in a materialized view alongside it, which exports of the view read instead. A
+    # unique index is needed to refresh it concurrently, row_number being unique in every playlist view.
+    materialized_view = '{0}.{1}_mv'.format(schema_name, view_name.split('.')[-1])
+    period_start, period_end = period or (None, None)
+    db.execute("DROP MATERIALIZED VIEW IF EXISTS {0}".format(materialized_view))
+    db.execute("CREATE MATERIALIZED VIEW {0} AS SELECT * FROM {1}".format(materialized_view, view_name))
+    db.execute("CREATE UNIQUE INDEX ON {0} (row_number)".format(materialized_view))
+    db.execute("INSERT INTO {0}.playlist_watermark (view_name, materialized_view, period_start, period_end, change_id, "
+               "                                   closed) "
+               "SELECT %s, "
+               "       %s, "
+               "       %s, "
+               "       %s, "
+               "       (SELECT COALESCE(MAX(change_id), 0) FROM {0}.data_change), "
+               "       COALESCE(%s <= (SELECT MAX(played_at) FROM {0}.play_watermark), FALSE) "
+               "    ON CONFLICT (view_name) "
+               "    DO UPDATE SET materialized_view = EXCLUDED.materialized_view, "
+               "                  period_start = EXCLUDED.period_start, "
+               "                  period_end = EXCLUDED.period_end, "
+               "                  change_id = EXCLUDED.change_id, "
+               "                  closed = EXCLUDED.closed, "
+               "                  refreshed_at = EXCLUDED.refreshed_at;"
+               .format(schema_name),
+               [view_name, materialized_view, period_start, period_end, period_end])
+    return materialized_view
+
+
+def dematerialize_playlist(db, schema_name, view_name):
+    db.execute("DELETE FROM {0}.playlist_watermark "
+               " WHERE view_name = %s "
+               "RETURNING materialized_view;"
+               .format(schema_name),
+               [view_name])
+    for materialized_view, in db.fetchall():
+        db.execute("DROP MATERIALIZED VIEW IF EXISTS {0}".format(materialized_view))
+
+
+def ingest_plays(db, schema_name, source_table):
+    # Each track's watermark is the latest play already ingested for it, so only newer plays are candidates and no
+    # existing plays need to be scanned. The daily rollup and the watermarks move on from the plays inserted here.
+    # Returns the number of tracks played and the times of the first and last of their new plays.
+    db.execute("WITH new_play AS ("
+               "INSERT INTO {0}.play (track_id, played_at) "
+               "SELECT t.track_id, "
+               "       t.last_played "
+               "  FROM {0}.track t "
+               "  LEFT JOIN {0}.play_watermark w ON (w.track_id = t.track_id) "
+               " WHERE t.last_played IS NOT NULL "
+               "   AND t.itunes_id IN (SELECT persistent_id FROM {1}) "
+               "   AND (w.played_at IS NULL OR t.last_played > w.played_at) "
+               "    ON CONFLICT (track_id, played_at) "
+               "    DO NOTHING "
+               "RETURNING track_id, played_at), "
+               "new_play_daily AS ("
+               "INSERT INTO {0}.play_daily (track_id, day, plays) "
+               "SELECT track_id, "
+               "       played_at :: DATE, "
+               "       COUNT(*) "
+               "  FROM new_play "
+               " GROUP BY track_id, played_at :: DATE "
+               "    ON CONFLICT (track_id, day) "
+               "    DO UPDATE SET plays = play_daily.plays + EXCLUDED.plays), "
+               "new_play_watermark AS ("
+               "INSERT INTO {0}.play_watermark (track_id, played_at) "
+               "SELECT track_id, "
+               "       MAX(played_at) "
+               "  FROM new_play "
+               " GROUP BY track_id "
+               "    ON CONFLICT (track_id) "
+               "    DO UPDATE SET played_at = GREATEST(play_watermark.played_at, EXCLUDED.played_at) "
+               "RETURNING track_id) "
+               "SELECT (SELECT COUNT(*) FROM new_play_watermark), "
+               "       MIN(played_at), "
+               "       MAX(played_at) "
+               "  FROM new_play;"
+               .format(schema_name, source_table))
+    played, first_played_at, last_played_at = db.fetchone()
+
+    logging.warning("Plays ingested for %s tracks", played)
+    return played, first_played_at, last_played_at
+
+
+def get_play_table_definition(schema_name, play_partitioning=None, table_name='play'):
+    # A partitioned table's keys have to include the partition key, hence the wider primary key
+    if play_partitioning is None:
+        return ("CREATE TABLE IF NOT EXISTS {0}.{1} ("
+                "play_id BIGINT GENERATED BY DEFAULT AS IDENTITY,"
+                "track_id BIGINT,"
+                "played_at TIMESTAMP NOT NULL,"
+                "CONSTRAINT pk_play PRIMARY KEY (play_id),"
+                "CONSTRAINT fk_play_track_id FOREIGN KEY (track_id) REFERENCES {0}.track (track_id),"
+                "CONSTRAINT uk_play_track_play_at UNIQUE (track_id, played_at)"
+                ");"
+                .format(schema_name, table_name))
+    return ("CREATE TABLE IF NOT EXISTS {0}.{1} ("
+            "play_id BIGINT GENERATED BY DEFAULT AS IDENTITY,"
+            "track_id BIGINT,"
+            "played_at TIMESTAMP NOT NULL,"
+            "CONSTRAINT pk_play PRIMARY KEY (play_id, played_at),"
+            "CONSTRAINT fk_play_track_id FOREIGN KEY (track_id) REFERENCES {0}.track (track_id),"
+            "CONSTRAINT uk_play_track_play_at UNIQUE (track_id, played_at)"
+            ") PARTITION BY RANGE (played_at);"
+            .format(schema_name, table_name))
+
+
+def get_play_partitioning(db, schema_name, default=None):
+    # Partitions are named play_YYYY or play_YYYY_MM, which is how the period of an existing layout is recognised
+    db.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s)", [schema_name + '.play'])
+    row = db.fetchone()
+    if row is None or not row[0]:
+        return None
+
+    db.execute("SELECT c.relname "
+               "  FROM pg_inherits i "
+               "  JOIN pg_class c ON (c.oid = i.inhrelid) "
+               " WHERE i.inhparent = to_regclass(%s) "
+               " LIMIT 1",
+               [schema_name + '.play'])
+    row = db.fetchone()
+    if row is None:
+        return default or 'month'
+    return 'month' if re.match(r'^play_\d{4}_\d{2}$', row[0]) else 'year'
+
+
+def create_play_partitions(db, schema_name, play_partitioning, periods):
+    for period in periods:
+        if play_partitioning == 'month':
+            partition_name = 'play_{0:%Y_%m}'.format(period)
+            start = datetime.datetime(period.year, period.month, 1)
+            end = datetime.datetime(period.year + period.month // 12, period.month % 12 + 1, 1)
+        else:
+            partition_name = 'play_{0:%Y}'.format(period)
+            start = datetime.datetime(period.year, 1, 1)
+            end = datetime.datetime(period.year + 1, 1, 1)
+
+        db.execute("CREATE TABLE IF NOT EXISTS {0}.{1} "
+                   "PARTITION OF {0}.play "
+                   "FOR VALUES FROM (%s) TO (%s);"
+                   .format(schema_name, partition_name),
+                   [start, end])
+
+
+def migrate_play_partitions(db, schema_name, play_partitioning):
+    # Views can't be repointed at a new table, so the ones reading play are re-created from their definitions
+    db.execute("SELECT DISTINCT v.oid :: REGCLASS :: TEXT, "
+               "       pg_get_viewdef(v.oid) "
+               "  FROM pg_depend d "
+               "  JOIN pg_rewrite r ON (r.oid = d.objid) "
+               "  JOIN pg_class v ON (v.oid = r.ev_class) "
+               " WHERE d.refobjid = to_regclass(%s) "
+               "   AND v.oid <> d.refobjid "
+               "   AND v.relkind = 'v'",
+               [schema_name + '.play'])
+    views = db.fetchall()
+
+    db.execute("ALTER TABLE {0}.play RENAME TO play_unpartitioned".format(schema_name))
+    for constraint in ('pk_play', 'fk_play_track_id', 'uk_play_track_play_at'):
+        db.execute("ALTER TABLE {0}.play_unpartitioned RENAME CONSTRAINT {1} TO {1}_unpartitioned"
+                   .format(schema_name, constraint))
+
+    db.execute(get_play_table_definition(schema_name, play_partitioning))
+    db.execute("SELECT DISTINCT DATE_TRUNC(%s, played_at) FROM {0}.play_unpartitioned".format(schema_name),
+               [play_partitioning])
+    create_play_partitions(db, schema_name, play_partitioning, [row[0] for row in db.fetchall()])
 
-    db.execute("INSERT INTO {0}.track (track_name, "
-               "                       length, "
-               "                       album_id, "
-               "                       artist_id, "
-               "                       play_count, "
-               "                       last_played, "
-               "                       date_added, "
-               "                       track_number, "
-               "                       bpm, "
-               "                       loved, "
-               "                       itunes_id) "
-               "     SELECT name AS track_name, "
-               "            total_time, "
-               "            album_id, "
-               "            artist_id, "
-               "            play_count, "
-               "            play_date_utc, "
-               "            date_added, "
-               "            track_number, "
-               "            bpm, "
-               "            loved, "
-               "            itunes_id "
-               "       FROM (SELECT name, "
-               "                    total_time :: BIGINT, "
-               "                    al.album_id, "
-               "                    ar.artist_id, "
-               "                    COALESCE(play_count :: INT, 0) AS play_count, "
-               "                    play_date_utc :: TIMESTAMP, "
-               "                    date_added :: TIMESTAMP, "
-               "                    COALESCE(track_number :: INT, 1) AS track_number, "
-               "                    bpm :: INT, "
-               "                    COALESCE(loved :: BOOLEAN, FALSE) AS loved, "
-               "                    persistent_id AS itunes_id,"
-               "                    ROW_NUMBER() OVER "
-               "                               (PARTITION BY name, "
-               "                                             album, "
-               "                                             artist, "
-               "                                             COALESCE(track_number :: INT, 1) "
-               "                                    ORDER BY COALESCE(play_count :: INT, 0) DESC) "
-               "               FROM itunes.itunes i "
-               "                    JOIN {0}.artist ar "
-               "                         ON (artist_name = artist) "
-               "                    JOIN {0}.album al "
-               "                         ON (album_name = album "
-               "                        AND release_year = year :: int "
-               "                        AND al.artist_id = ar.artist_id) "
-               "              WHERE NOT EXISTS (SELECT "
-               "                                  FROM {0}.track t "
-               "                                 WHERE t.itunes_id = i.persistent_id "
-               "                                    OR (t.track_name, t.album_id, t.artist_id, t.track_number) "
-               "                                     = (i.name, "
-               "                                        al.album_id, "
-               "                                        ar.artist_id, "
-               "                                        COALESCE(track_number :: INT, 1))"
-               "                               )) AS a "
-               "      WHERE row_number = 1; "
+    db.execute("INSERT INTO {0}.play (play_id, track_id, played_at) "
+               "SELECT play_id, "
+               "       track_id, "
+               "       played_at "
+               "  FROM {0}.play_unpartitioned;"
                .format(schema_name))
+    db.execute("SELECT setval(pg_get_serial_sequence(%s, 'play_id'), MAX(play_id)) "
+               "  FROM {0}.play "
+               "HAVING MAX(play_id) IS NOT NULL;"
+               .format(schema_name),
+               [schema_name + '.play'])
 
-    db.execute("INSERT INTO {0}.play (track_id, played_at)"
-               "SELECT track_id,"
-               "       last_played"
-               "  FROM {0}.track"
-               " WHERE last_played IS NOT NULL"
-               "   AND NOT EXISTS (SELECT "
-               "                     FROM {0}.play"
-               "                    WHERE track_id = track_id"
-               "                      AND played_at = last_played);"
+    for view_name, view_definition in views:
+        db.execute("CREATE OR REPLACE VIEW {0} AS {1}".format(view_name, view_definition))
+    db.execute("DROP TABLE {0}.play_unpartitioned".format(schema_name))
+
+    # The indexes migrations added to play went with the old table, whose names they held until it was dropped
+    create_view_indexes(db, schema_name, [index_name for index_name, (table_name, _) in VIEW_INDEXES.items()
+                                          if table_name == 'play'])
+
+
+def rebuild_play_daily(db, schema_name):
+    db.execute("TRUNCATE {0}.play_daily".format(schema_name))
+    db.execute("INSERT INTO {0}.play_daily (track_id, day, plays) "
+               "SELECT track_id, "
+               "       played_at :: DATE, "
+               "       COUNT(*) "
+               "  FROM {0}.play "
+               " GROUP BY track_id, played_at :: DATE;"
                .format(schema_name))
 
 
-def process_tracks(library):
-    all_keys = set()
-    inserts = []
+def iter_library_tracks(library_xml):
+    # Walk the plist incrementally so only one track is held in memory at a time. Parsing stops as soon as the
+    # 'Tracks' dict closes, so the 'Playlists' section that follows it is never read.
+    depth = 0
+    section = None
+    root_element = None
+    tracks_element = None
+
+    for event, element in ElementTree.iterparse(library_xml, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if depth == 2:
+                root_element = element
+            elif depth == 3 and element.tag == 'dict' and section == 'Tracks':
+                tracks_element = element
+            continue
+
+        if depth == 3:
+            if element is tracks_element:
+                return
+            if element.tag == 'key':
+                section = element.text
+            else:
+                root_element.clear()
+        elif depth == 4 and element.tag == 'dict' and tracks_element is not None:
+            yield parse_plist_value(element)
+            tracks_element.clear()
+
+        depth -= 1
+
+
+def parse_plist_value(element):
+    if element.tag == 'dict':
+        children = list(element)
+        return dict((key.text or '', parse_plist_value(value)) for key, value in zip(children[::2], children[1::2]))
+    if element.tag == 'array':
+        return [parse_plist_value(child) for child in element]
+    if element.tag == 'string':
+        return element.text or ''
+    if element.tag == 'integer':
+        return int(element.text)
+    if element.tag == 'real':
+        return float(element.text)
+    if element.tag == 'true':
+        return True
+    if element.tag == 'false':
+        return False
+    if element.tag == 'date':
+        return datetime.datetime.strptime(element.text, '%Y-%m-%dT%H:%M:%SZ')
+    if element.tag == 'data':
+        return base64.b64decode(element.text or '')
+    raise ValueError("Unsupported plist element: " + element.tag)
 
-    for track_id in library['Tracks'].keys():
-        track = library['Tracks'][track_id]
-        track_keys = list(map(slugify, track.keys()))
 
+def process_tracks(tracks):
+    for track in tracks:
         if 'Podcast' in track and track['Podcast']:
-            track.pop('Podcast')
             continue
         if 'Music Video' in track:
-            track.pop('Music Video')
             continue
 
         if 'Artist' not in track:
@@ -308,37 +1314,81 @@ def process_tracks(library):
         if 'Location' in track and 'iTunes%20Media/Audiobooks' in track['Location']:
             continue
 
-        track_values = track.values()
+        yield dict((slugify(key), value) for key, value in track.items())
+
+
+def get_library_identity(library_xml):
+    content_hash = hashlib.sha1()
+    for chunk in iter(lambda: library_xml.read(1024 * 1024), b''):
+        content_hash.update(chunk)
+    library_xml.seek(0)
+
+    stat = os.fstat(library_xml.fileno())
+    return os.path.abspath(library_xml.name), stat.st_size, stat.st_mtime_ns, content_hash.hexdigest()
 
-        all_keys = all_keys.union(set(track_keys))
 
-        inserts.append(get_parameterized(track_keys, track_values))
+def get_import_target(args):
+    if args.backend == 'sqlite':
+        return args.backend, os.path.abspath(sqlite_backend.get_database_file(args.database_name))
+    return args.backend, 'localhost', str(args.port), args.database_name, args.schema_name
 
-    all_keys = list(map(slugify, all_keys))
-    all_keys_with_type = (key + " TEXT" for key in all_keys)
 
-    return "CREATE TABLE IF NOT EXISTS {0}.{1} ({2})".format(TEMPORARY_SCHEMA_NAME, TEMPORARY_TABLE_NAME,
-                                                             ', '.join(all_keys_with_type)), inserts
+def read_cached_identity(cache_file):
+    try:
+        with open(cache_file, 'rb') as fp:
+            return pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
 
 
-def get_parameterized(keys, values):
-    return (
-        "INSERT INTO {0}.{1} ({2}) VALUES ({3})".format(
-            TEMPORARY_SCHEMA_NAME,
-            TEMPORARY_TABLE_NAME,
-            ', '.join(map(str, keys)),
-            ', '.join(['%s'] * len(values))
-        ),
-        [value for value in values]
-    )
+def read_cached_tracks(cache_file):
+    with open(cache_file, 'rb') as fp:
+        pickle.load(fp)
+        while True:
+            try:
+                batch = pickle.load(fp)
+            except EOFError:
+                return
+            yield from batch
+
+
+def write_cached_tracks(tracks, cache_file, library_identity, batch_size=DEFAULT_BATCH_SIZE):
+    # Tracks are pickled in batches so repeated keys are only written once per batch. The cache is written to a
+    # temporary file that only replaces the real one once the import has succeeded.
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    with open(cache_file + '.tmp', 'wb') as fp:
+        pickle.dump(library_identity, fp, pickle.HIGHEST_PROTOCOL)
+        for batch in batched(tracks, batch_size):
+            pickle.dump(batch, fp, pickle.HIGHEST_PROTOCOL)
+            yield from batch
+
+
+def commit_cached_tracks(cache_file):
+    os.replace(cache_file + '.tmp', cache_file)
+
+
+def fingerprint_tracks(tracks):
+    for track in tracks:
+        track[FINGERPRINT_COLUMN_NAME] = hashlib.sha1(repr(sorted(track.items())).encode('utf-8')).hexdigest()
+        yield track
+
+
+def filter_changed_tracks(tracks, fingerprints):
+    for track in tracks:
+        if fingerprints.get(track['persistent_id']) != track[FINGERPRINT_COLUMN_NAME]:
+            yield track
 
 
 def slugify(name):
     return name.lower().replace(' ', '_')
 
 
-def open_db(name, port, user, password):
-    conn = psycopg2.connect(host="localhost", port=port, database=name, user=user, password=password)
+def open_db(name, port, user, password, backend=DEFAULT_BACKEND):
+    if backend == 'sqlite':
+        conn = sqlite_backend.open_db(sqlite_backend.get_database_file(name))
+    else:
+        conn = psycopg2.connect(host="localhost", port=port, database=name, user=user, password=password,
+                                cursor_factory=instrumentation.InstrumentedCursor)
     cur = conn.cursor()
     return conn, cur
 
@@ -349,5 +1399,33 @@ def close_db(conn, cur):
     conn.close()
 
 
+@contextlib.contextmanager
+def transaction(args, shared_conn=None):
+    # Commits once done. The connection is opened for the transaction and closed again unless a shared one is given.
+    # Rolls back if the body raises, leaving a shared connection ready for the next transaction.
+    conn = shared_conn
+    if shared_conn is None:
+        conn, cur = open_db(args.database_name, args.port, args.username, args.password, args.backend)
+    else:
+        cur = shared_conn.cursor()
+    try:
+        yield conn, cur
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        if shared_conn is None:
+            conn.close()
+
+
+# Each migration brings the schema up to its version. Versions are never changed once released, only added.
+SCHEMA_MIGRATIONS = [(1, 'create normalised tables', create_normalised_tables),
+                     (2, 'index plays by played_at', add_play_index),
+                     (3, 'index tracks by album and artist', add_track_indexes),
+                     (4, 'drop idx_track_itunes_id, a duplicate of uk_track_itunes_id', drop_duplicate_track_index),
+                     (5, 'index daily plays by day', add_play_daily_index)]
+
 if __name__ == '__main__':
     main()
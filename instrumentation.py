@@ -0,0 +1,256 @@
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import re
+import resource
+import sqlite3
+import sys
+import threading
+import time
+
+# Only needed for the postgres backend
+try:
+    import psycopg2
+    import psycopg2.extensions
+except ImportError:
+    psycopg2 = None
+
+# Only statements EXPLAIN accepts are explained, anything else (DDL, COPY etc.) is just timed
+EXPLAINABLE_STATEMENT_RE = re.compile(r'\s*(SELECT|INSERT|UPDATE|DELETE|WITH)\b'
+                                      r'|\s*CREATE\s+(TEMP\s+|TEMPORARY\s+|UNLOGGED\s+)?TABLE\s+\S+'
+                                      r'(\s+ON\s+COMMIT\s+\w+)?\s+AS\b',
+                                      re.IGNORECASE)
+STATEMENT_LABEL_LENGTH = 100
+SLOWEST_STATEMENTS_LOGGED = 5
+EXPLAIN_SAVEPOINT_NAME = 'instrumentation_explain'
+
+
+class Run:
+    def __init__(self, script_name, explain=False):
+        self.script_name = script_name
+        self.explain = explain
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.phases = collections.OrderedDict()
+        self.statements = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def get_stack(self):
+        # Each thread has its own stack of open phases. Time spent in a phase is only counted once, against the
+        # innermost phase, so the phases of a run add up to its total time.
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def get_phase_name(self):
+        stack = self.get_stack()
+        return stack[-1][0] if stack else None
+
+    def add_phase(self, name, elapsed, rows, calls=1):
+        peak_rss_kb = get_peak_rss_kb()
+        with self.lock:
+            entry = self.phases.get(name)
+            if entry is None:
+                entry = self.phases[name] = {'name': name, 'elapsed': 0.0, 'calls': 0, 'rows': 0, 'peak_rss_kb': 0}
+            entry['elapsed'] += elapsed
+            entry['calls'] += calls
+            entry['rows'] += rows
+            entry['peak_rss_kb'] = max(entry['peak_rss_kb'], peak_rss_kb)
+
+    def add_statement(self, query, elapsed, rowcount, plan=None):
+        phase_name = self.get_phase_name()
+        label = get_statement_label(query)
+        with self.lock:
+            entry = self.statements.get((phase_name, label))
+            if entry is None:
+                entry = self.statements[(phase_name, label)] = {'phase': phase_name,
+                                                                'statement': label,
+                                                                'elapsed': 0.0,
+                                                                'calls': 0,
+                                                                'rowcount': 0,
+                                                                'plans': []}
+            entry['elapsed'] += elapsed
+            entry['calls'] += 1
+            if rowcount is not None and rowcount >= 0:
+                entry['rowcount'] += rowcount
+            if plan is not None:
+                entry['plans'].append(plan)
+
+
+if psycopg2 is not None:
+    class InstrumentedCursor(psycopg2.extensions.cursor):
+        # Every statement run through these cursors is timed and its rowcount recorded against the current phase
+        def execute(self, query, vars=None):
+            run = _run
+            plan = None
+            if run.explain and not self.connection.autocommit and EXPLAINABLE_STATEMENT_RE.match(get_query_text(query)):
+                plan = explain_statement(self.connection, query, vars)
+
+            start = time.perf_counter()
+            try:
+                return super().execute(query, vars)
+            finally:
+                run.add_statement(query, time.perf_counter() - start, self.rowcount, plan)
+
+        def copy_expert(self, sql, file, size=8192):
+            start = time.perf_counter()
+            try:
+                return super().copy_expert(sql, file, size)
+            finally:
+                _run.add_statement(sql, time.perf_counter() - start, self.rowcount)
+
+
+class InstrumentedSQLiteCursor(sqlite3.Cursor):
+    # The same for the sqlite backend, which has nothing to explain statements with
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _run.add_statement(sql, time.perf_counter() - start, self.rowcount)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _run.add_statement(sql, time.perf_counter() - start, self.rowcount)
+
+
+class InstrumentedSQLiteConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedSQLiteCursor):
+        return super().cursor(factory)
+
+
+_run = Run(None)
+
+
+def start(script_name, explain=False):
+    global _run
+    _run = Run(script_name, explain)
+
+
+@contextlib.contextmanager
+def phase(name):
+    # Rows can be recorded against the phase through the dict it yields
+    run = _run
+    stack = run.get_stack()
+    frame = [name, time.perf_counter(), 0.0]
+    counts = {'rows': 0}
+    stack.append(frame)
+    try:
+        yield counts
+    finally:
+        stack.pop()
+        elapsed = time.perf_counter() - frame[1]
+        if stack:
+            stack[-1][2] += elapsed
+        run.add_phase(name, elapsed - frame[2], counts['rows'])
+
+
+def iterate(name, iterable):
+    # Time spent producing each item is counted against the phase, along with the number of items produced
+    run = _run
+    stack = run.get_stack()
+    iterator = iter(iterable)
+    elapsed = 0.0
+    rows = 0
+    try:
+        while True:
+            frame = [name, time.perf_counter(), 0.0]
+            stack.append(frame)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                stack.pop()
+                step = time.perf_counter() - frame[1]
+                if stack:
+                    stack[-1][2] += step
+                elapsed += step - frame[2]
+            rows += 1
+            yield item
+    finally:
+        run.add_phase(name, elapsed, rows)
+
+
+def explain_statement(conn, query, vars=None):
+    # EXPLAIN ANALYZE really runs the statement, so it is run inside a savepoint that is rolled back straight after.
+    # The statement then runs again for real, so the database ends up the same as without --explain.
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("SAVEPOINT " + EXPLAIN_SAVEPOINT_NAME)
+        try:
+            cur.execute(b"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + cur.mogrify(query, vars))
+            return cur.fetchone()[0]
+        finally:
+            cur.execute("ROLLBACK TO SAVEPOINT " + EXPLAIN_SAVEPOINT_NAME)
+
+
+def get_query_text(query):
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    return str(query)
+
+
+def get_statement_label(query):
+    return ' '.join(get_query_text(query).split())[:STATEMENT_LABEL_LENGTH]
+
+
+def get_peak_rss_kb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+    peak_rss = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return peak_rss
+
+
+def get_report():
+    run = _run
+    with run.lock:
+        return {'script': run.script_name,
+                'started_at': run.started_at.isoformat(),
+                'elapsed': time.perf_counter() - run.start,
+                'explain': run.explain,
+                'peak_rss_kb': get_peak_rss_kb(),
+                'peak_child_rss_kb': get_peak_rss_kb(resource.RUSAGE_CHILDREN),
+                'phases': [dict(entry) for entry in run.phases.values()],
+                'statements': [dict(entry) for entry in run.statements.values()]}
+
+
+def log_summary(report):
+    logging.warning("Finished in %.3fs, peak RSS %s KB:", report['elapsed'], report['peak_rss_kb'])
+    for entry in report['phases']:
+        logging.warning("  %-40s %10.3fs %10s rows", entry['name'], entry['elapsed'], entry['rows'])
+    statements = sorted(report['statements'], key=lambda entry: entry['elapsed'], reverse=True)
+    if statements:
+        logging.warning("Slowest statements:")
+    for entry in statements[:SLOWEST_STATEMENTS_LOGGED]:
+        logging.warning("  %10.3fs %10s rows  %s", entry['elapsed'], entry['rowcount'], entry['statement'])
+
+
+def write_report(report, report_file):
+    with open(report_file, 'w') as fp:
+        json.dump(report, fp, indent=2)
+        fp.write('\n')
+
+
+def store_report(conn, report, table_name):
+    # A plain cursor, so storing the report is neither explained nor recorded in it
+    with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+        cur.execute("CREATE TABLE IF NOT EXISTS {0} ("
+                    "run_id BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY, "
+                    "script TEXT NOT NULL, "
+                    "started_at TIMESTAMP NOT NULL, "
+                    "elapsed DOUBLE PRECISION NOT NULL, "
+                    "peak_rss_kb BIGINT, "
+                    "report JSONB NOT NULL);"
+                    .format(table_name))
+        cur.execute("INSERT INTO {0} (script, started_at, elapsed, peak_rss_kb, report) "
+                    "VALUES (%s, %s, %s, %s, %s);"
+                    .format(table_name),
+                    [report['script'], report['started_at'], report['elapsed'], report['peak_rss_kb'],
+                     json.dumps(report)])
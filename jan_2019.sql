@@ -3,19 +3,19 @@ CREATE OR REPLACE VIEW jan_2019 AS
         ROW_NUMBER() OVER (ORDER BY playlist_tracks.count DESC) AS row_number,
         playlist_tracks.count,
         playlist_tracks.track_name
-   FROM (SELECT play.track_id,
+   FROM (SELECT play_daily.track_id,
                 track.itunes_id,
                 track.track_name,
-                COUNT(*) AS count,
-                ROW_NUMBER() OVER (PARTITION BY track.album_id ORDER BY (COUNT(*)) DESC) AS album_rows,
-                ROW_NUMBER() OVER (PARTITION BY track.artist_id ORDER BY (COUNT(*)) DESC) AS artist_rows
-           FROM play
+                SUM(play_daily.plays) AS count,
+                ROW_NUMBER() OVER (PARTITION BY track.album_id ORDER BY (SUM(play_daily.plays)) DESC) AS album_rows,
+                ROW_NUMBER() OVER (PARTITION BY track.artist_id ORDER BY (SUM(play_daily.plays)) DESC) AS artist_rows
+           FROM play_daily
            JOIN track USING (track_id)
            JOIN artist USING (artist_id)
            JOIN album USING (album_id, artist_id)
-          WHERE DATE_PART('month'::text, play.played_at) = '1':: DOUBLE PRECISION
-            AND DATE_PART('year'::text, play.played_at) = '2019':: DOUBLE PRECISION
-          GROUP BY play.track_id, track.track_name, track.itunes_id, track.album_id, track.artist_id) AS playlist_tracks
+          WHERE play_daily.day >= '2019-01-01'::DATE
+            AND play_daily.day < '2019-02-01'::DATE
+          GROUP BY play_daily.track_id, track.track_name, track.itunes_id, track.album_id, track.artist_id) AS playlist_tracks
   WHERE playlist_tracks.album_rows <= 2
     AND playlist_tracks.artist_rows <= 5
     AND playlist_tracks.count > 1
@@ -0,0 +1,170 @@
+import collections
+import logging
+
+# The SQL normalising staged tracks is the same for both backends bar the schema temporary tables live in, the clause
+# ending their CREATE TABLE, how query parameters are written and how rows are compared treating NULLs as equal. The
+# normalised tables are qualified by schema name in both, sqlite naming the database file's main schema.
+Dialect = collections.namedtuple('Dialect', ['temp_schema', 'temp_table_clause', 'placeholder', 'distinct_from'])
+
+POSTGRES = Dialect('pg_temp', 'ON COMMIT DROP', '%s', 'IS DISTINCT FROM')
+SQLITE = Dialect('temp', '', '?', 'IS NOT')
+
+# The track columns a merge sets from the staged rows
+TRACK_COLUMNS = ['track_name', 'length', 'album_id', 'artist_id', 'play_count', 'last_played', 'date_added',
+                 'track_number', 'itunes_id', 'bpm', 'loved']
+
+
+def insert_artists_and_albums(db, schema_name, source_table):
+    db.execute("INSERT INTO {0}.artist (artist_name) "
+               "SELECT artist "
+               "  FROM {1} "
+               " WHERE artist IS NOT NULL "
+               " GROUP BY artist "
+               "    ON CONFLICT (artist_name) "
+               "    DO NOTHING;"
+               .format(schema_name, source_table))
+
+    db.execute("INSERT INTO {0}.album (album_name, artist_id, release_year) "
+               "SELECT album, "
+               "       (SELECT artist_id "
+               "          FROM {0}.artist "
+               "         WHERE artist_name = artist), "
+               "       MAX(year) "
+               "  FROM {1} "
+               " WHERE album IS NOT NULL "
+               "   AND year IS NOT NULL "
+               " GROUP BY album, artist "
+               "    ON CONFLICT (album_name, artist_id)"
+               "    DO NOTHING;"
+               .format(schema_name, source_table))
+
+
+def merge_tracks(db, dialect, schema_name, source_table):
+    # Each staged row is first resolved to an existing track, by Persistent ID and then by natural key, so that the
+    # update and insert that follow are plain equi-joins on track_id rather than an OR of both keys
+    db.execute("DROP TABLE IF EXISTS {0}.track_key_map".format(dialect.temp_schema))
+    db.execute("CREATE TEMPORARY TABLE {2}.track_key_map {3} AS "
+               "SELECT CAST(NULL AS BIGINT) AS track_id, "
+               "       name AS track_name, "
+               "       total_time AS length, "
+               "       al.album_id, "
+               "       ar.artist_id, "
+               "       COALESCE(play_count, 0) AS play_count, "
+               "       play_date_utc AS last_played, "
+               "       date_added, "
+               "       COALESCE(track_number, 1) AS track_number, "
+               "       bpm, "
+               "       COALESCE(loved, FALSE) AS loved, "
+               "       persistent_id AS itunes_id, "
+               "       al.release_year = year AS release_year_matches "
+               "  FROM {1} i "
+               "  JOIN {0}.artist ar ON (artist_name = artist) "
+               "  JOIN {0}.album al ON (album_name = album "
+               "                        AND al.artist_id = ar.artist_id);"
+               .format(schema_name, source_table, dialect.temp_schema, dialect.temp_table_clause))
+    db.execute("ANALYZE {0}.track_key_map".format(dialect.temp_schema))
+
+    db.execute("UPDATE {1}.track_key_map AS k "
+               "   SET track_id = t.track_id "
+               "  FROM {0}.track t "
+               " WHERE t.itunes_id = k.itunes_id;"
+               .format(schema_name, dialect.temp_schema))
+    matched = db.rowcount
+
+    db.execute("UPDATE {1}.track_key_map AS k "
+               "   SET track_id = t.track_id "
+               "  FROM {0}.track t "
+               " WHERE k.track_id IS NULL "
+               "   AND t.track_name = k.track_name "
+               "   AND t.album_id = k.album_id "
+               "   AND t.artist_id = k.artist_id "
+               "   AND t.track_number = k.track_number;"
+               .format(schema_name, dialect.temp_schema))
+    matched += db.rowcount
+
+    # Only tracks that changed are updated, so that a full import counts the tracks it actually changed and
+    # materialized playlists are only refreshed for those
+    db.execute("UPDATE {0}.track AS t "
+               "   SET track_name = k.track_name, "
+               "       length = k.length, "
+               "       album_id = k.album_id, "
+               "       artist_id = k.artist_id, "
+               "       play_count = k.play_count, "
+               "       last_played = k.last_played, "
+               "       date_added = k.date_added, "
+               "       track_number = k.track_number, "
+               "       itunes_id = k.itunes_id, "
+               "       bpm = k.bpm, "
+               "       loved = k.loved "
+               "  FROM {1}.track_key_map k "
+               " WHERE t.track_id = k.track_id "
+               "   AND ({2}) {3} ({4});"
+               .format(schema_name, dialect.temp_schema, ', '.join('t.' + column for column in TRACK_COLUMNS),
+                       dialect.distinct_from, ', '.join('k.' + column for column in TRACK_COLUMNS)))
+    updated = db.rowcount
+
+    # Updating a track can give it the natural key of a staged row that was unmatched beforehand, those are skipped
+    db.execute("INSERT INTO {0}.track (track_name, "
+               "                       length, "
+               "                       album_id, "
+               "                       artist_id, "
+               "                       play_count, "
+               "                       last_played, "
+               "                       date_added, "
+               "                       track_number, "
+               "                       bpm, "
+               "                       loved, "
+               "                       itunes_id) "
+               "     SELECT track_name, "
+               "            length, "
+               "            album_id, "
+               "            artist_id, "
+               "            play_count, "
+               "            last_played, "
+               "            date_added, "
+               "            track_number, "
+               "            bpm, "
+               "            loved, "
+               "            itunes_id "
+               "       FROM (SELECT *, "
+               "                    ROW_NUMBER() OVER "
+               "                               (PARTITION BY track_name, "
+               "                                             album_id, "
+               "                                             artist_id, "
+               "                                             track_number "
+               "                                    ORDER BY play_count DESC) AS row_number "
+               "               FROM {1}.track_key_map "
+               "              WHERE track_id IS NULL "
+               "                AND release_year_matches) AS a "
+               "      WHERE row_number = 1 "
+               "         ON CONFLICT DO NOTHING;"
+               .format(schema_name, dialect.temp_schema))
+    inserted = db.rowcount
+
+    logging.warning("Tracks merged: %s matched, %s updated, %s inserted", matched, updated, inserted)
+    return matched, updated, inserted
+
+
+def update_track_details(db, schema_name, source_table, track_detail_columns):
+    # sqlite needs the WHERE to tell an upsert's ON CONFLICT from a join's ON
+    columns = [column for column, _ in track_detail_columns.values()]
+
+    db.execute("INSERT INTO {0}.track_detail ({2}) "
+               "SELECT {3} "
+               "  FROM {1} "
+               " WHERE TRUE "
+               "    ON CONFLICT (itunes_id) "
+               "    DO UPDATE SET {4};"
+               .format(schema_name, source_table, ', '.join(columns), ', '.join(track_detail_columns),
+                       ', '.join("{0} = EXCLUDED.{0}".format(column) for column in columns[1:])))
+
+
+def update_track_fingerprints(db, schema_name, source_table, fingerprint_column):
+    db.execute("INSERT INTO {0}.track_fingerprint (itunes_id, fingerprint) "
+               "SELECT persistent_id, "
+               "       {2} "
+               "  FROM {1} "
+               " WHERE TRUE "
+               "    ON CONFLICT (itunes_id) "
+               "    DO UPDATE SET fingerprint = EXCLUDED.fingerprint;"
+               .format(schema_name, source_table, fingerprint_column))
@@ -0,0 +1,121 @@
+import logging
+import os
+
+import numpy
+
+TRACK_DTYPE = numpy.dtype([('track_id', 'i8'), ('itunes_id', 'S16'), ('album_id', 'i8'), ('artist_id', 'i8')])
+PLAY_DTYPE = numpy.dtype([('track_id', 'i8'), ('day', 'M8[D]'), ('plays', 'i4')])
+
+
+class PlaylistEngine:
+    # Tracks and their daily plays as columns, from which playlists declared with playlist_rules are ranked in memory.
+    # Plays refer to tracks by their position in the track columns, which are ordered by track_id.
+    def __init__(self, track_id, itunes_id, album_id, artist_id, play_track, play_day, play_count):
+        self.track_id = track_id
+        self.itunes_id = itunes_id
+        self.album_id = album_id
+        self.artist_id = artist_id
+        self.play_track = play_track
+        self.play_day = play_day
+        self.play_count = play_count
+
+    def get_counts(self, playlist):
+        # Each track's plays, or days played, within the playlist's period
+        in_period = numpy.ones(len(self.play_day), dtype=bool)
+        if playlist.start is not None:
+            in_period &= self.play_day >= numpy.datetime64(playlist.start, 'D')
+        if playlist.end is not None:
+            in_period &= self.play_day < numpy.datetime64(playlist.end, 'D')
+        weights = self.play_count[in_period] if playlist.metric == 'plays' else None
+        return numpy.bincount(self.play_track[in_period], weights=weights, minlength=len(self.track_id))
+
+    def rank(self, playlist):
+        # The itunes_ids of the playlist in order, as the playlist's SQL would return them: tracks played in the
+        # period, ranked by count and then track_id, numbered within their album and artist in that order for the
+        # caps, then filtered by min_count and cut to size
+        counts = self.get_counts(playlist)
+        played = numpy.flatnonzero(counts)
+        ranked = played[numpy.lexsort((self.track_id[played], -counts[played]))]
+
+        keep = numpy.ones(len(ranked), dtype=bool)
+        if playlist.album_cap is not None:
+            keep &= get_group_row_numbers(self.album_id[ranked]) <= playlist.album_cap
+        if playlist.artist_cap is not None:
+            keep &= get_group_row_numbers(self.artist_id[ranked]) <= playlist.artist_cap
+        if playlist.min_count is not None:
+            keep &= counts[ranked] >= playlist.min_count
+
+        ranked = ranked[keep][:playlist.size]
+        return [itunes_id.decode('ascii') for itunes_id in self.itunes_id[ranked]]
+
+
+def get_group_row_numbers(keys):
+    # ROW_NUMBER() OVER (PARTITION BY key) of each row, numbering the rows of a key in the order they are given
+    order = numpy.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    positions = numpy.arange(len(keys))
+    group_starts = numpy.maximum.accumulate(numpy.where(numpy.r_[True, sorted_keys[1:] != sorted_keys[:-1]],
+                                                        positions, 0))
+    row_numbers = numpy.empty(len(keys), dtype=numpy.int64)
+    row_numbers[order] = positions - group_starts + 1
+    return row_numbers
+
+
+def load_engine(conn, schema_name, source, cache_file):
+    # The columns are cached on disk alongside the database's version they were loaded at, so they are only loaded
+    # from the database again once an import has changed tracks or plays. Source identifies the database.
+    version = '{0} {1}'.format(source, get_data_version(conn, schema_name))
+    engine = read_cached_engine(cache_file, version)
+    if engine is not None:
+        return engine
+
+    logging.warning("Loading tracks and plays into the playlist engine...")
+    engine = fetch_engine(conn, schema_name)
+    write_cached_engine(engine, cache_file, version)
+    return engine
+
+
+def get_data_version(conn, schema_name):
+    # Changes whenever tracks are added or plays ingested. Tracks moving to another album or artist, which is rare and
+    # doesn't come with new plays, isn't noticed until then.
+    cur = conn.cursor()
+    cur.execute("SELECT (SELECT COUNT(*) FROM {0}.track), "
+                "       (SELECT COALESCE(MAX(track_id), 0) FROM {0}.track), "
+                "       (SELECT COUNT(*) FROM {0}.play_daily), "
+                "       (SELECT COALESCE(SUM(plays), 0) FROM {0}.play_daily)"
+                .format(schema_name))
+    version = ' '.join(str(value) for value in cur.fetchone())
+    cur.close()
+    return version
+
+
+def fetch_engine(conn, schema_name):
+    cur = conn.cursor()
+    cur.execute("SELECT track_id, itunes_id, album_id, artist_id FROM {0}.track ORDER BY track_id".format(schema_name))
+    tracks = numpy.array(cur.fetchall(), dtype=TRACK_DTYPE)
+    cur.execute("SELECT track_id, day, plays FROM {0}.play_daily".format(schema_name))
+    plays = numpy.array(cur.fetchall(), dtype=PLAY_DTYPE)
+    cur.close()
+    return PlaylistEngine(tracks['track_id'], tracks['itunes_id'], tracks['album_id'], tracks['artist_id'],
+                          numpy.searchsorted(tracks['track_id'], plays['track_id']).astype(numpy.int32),
+                          plays['day'], plays['plays'])
+
+
+def read_cached_engine(cache_file, version):
+    try:
+        with numpy.load(cache_file) as cached:
+            if str(cached['version']) != version:
+                return None
+            return PlaylistEngine(cached['track_id'], cached['itunes_id'], cached['album_id'], cached['artist_id'],
+                                  cached['play_track'], cached['play_day'], cached['play_count'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def write_cached_engine(engine, cache_file, version):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file + '.tmp', 'wb') as fp:
+        numpy.savez(fp, version=numpy.array(version), track_id=engine.track_id, itunes_id=engine.itunes_id,
+                    album_id=engine.album_id, artist_id=engine.artist_id, play_track=engine.play_track,
+                    play_day=engine.play_day, play_count=engine.play_count)
+    os.replace(cache_file + '.tmp', cache_file)
@@ -0,0 +1,144 @@
+import calendar
+import collections
+import datetime
+import json
+
+# A playlist of the tracks played most between start (inclusive) and end (exclusive), or ever if there are no dates.
+# Tracks are ranked by their total plays, or by the number of days they were played on, in the period. At most
+# album_cap tracks of an album and artist_cap tracks of an artist make it into the playlist, only tracks ranked with
+# at least min_count plays (or days), and no more than size tracks in all. Caps of None don't apply.
+Playlist = collections.namedtuple('Playlist',
+                                  ['name', 'start', 'end', 'metric', 'album_cap', 'artist_cap', 'min_count', 'size'],
+                                  defaults=[None, None, 'plays', 2, 5, 2, 50])
+
+METRICS = collections.OrderedDict([('plays', 'SUM(pd.plays)'),
+                                   ('days', 'COUNT(*)')])
+DEFAULT_NAME_FORMAT = '{0:%B %Y}'
+
+
+def monthly_playlists(year, name_format=DEFAULT_NAME_FORMAT, **rules):
+    # One playlist for each month of the year, named after the month's first day
+    playlists = []
+    for month in range(1, 13):
+        start = datetime.date(year, month, 1)
+        end = start + datetime.timedelta(days=calendar.monthrange(year, month)[1])
+        playlists.append(Playlist(name_format.format(start), start, end, **rules))
+    return playlists
+
+
+def yearly_playlists(years, name_format='Top {0:%Y}', **rules):
+    return [Playlist(name_format.format(datetime.date(year, 1, 1)), datetime.date(year, 1, 1),
+                     datetime.date(year + 1, 1, 1), **rules)
+            for year in years]
+
+
+def load_playlists(specs):
+    # Playlists from JSON, e.g. a manifest's rules. A spec with "months" stands for the months of that year, named
+    # with "name" as a format string.
+    playlists = []
+    for spec in specs:
+        spec = dict(spec)
+        for key in ('start', 'end'):
+            if spec.get(key) is not None:
+                spec[key] = datetime.date.fromisoformat(spec[key])
+        if 'months' in spec:
+            year = spec.pop('months')
+            playlists.extend(monthly_playlists(year, spec.pop('name', DEFAULT_NAME_FORMAT), **spec))
+        else:
+            playlists.append(Playlist(**spec))
+    for playlist in playlists:
+        if playlist.metric not in METRICS:
+            raise ValueError("Unsupported metric for playlist {0}: {1}".format(playlist.name, playlist.metric))
+    return playlists
+
+
+def get_rule_key(playlist):
+    # Identifies the rules a playlist was exported with, e.g. alongside its fingerprint
+    return json.dumps(playlist._asdict(), default=str, sort_keys=True)
+
+
+def get_family_sql(playlists, schema_name='public'):
+    # A single query for all the playlists, returning their tracks as (playlist, itunes_id, row_number), where
+    # playlist is the playlist's index in the list. The daily play rollup is scanned once, by a range of days covering
+    # every period, and each day's plays are counted towards the playlists whose period it falls in. Ranking and caps
+    # are then window functions partitioned by playlist.
+    periods = ', '.join("({0}, {1}, {2}, {3}, {4}, {5}, {6}, {7})"
+                        .format(index,
+                                get_date_literal(playlist.start, '-infinity'),
+                                get_date_literal(playlist.end, 'infinity'),
+                                get_text_literal(playlist.metric),
+                                get_int_literal(playlist.album_cap),
+                                get_int_literal(playlist.artist_cap),
+                                get_int_literal(playlist.min_count),
+                                get_int_literal(playlist.size))
+                        for index, playlist in enumerate(playlists))
+
+    # Bounding the scan by the days of all periods lets it use the index on day, unless a playlist covers all time
+    days = ''
+    if all(playlist.start is not None and playlist.end is not None for playlist in playlists):
+        days = ("   AND pd.day >= {0} "
+                "   AND pd.day < {1} "
+                .format(get_date_literal(min(playlist.start for playlist in playlists)),
+                        get_date_literal(max(playlist.end for playlist in playlists))))
+
+    return ("WITH period (playlist, period_start, period_end, metric, album_cap, artist_cap, min_count, size) AS ("
+            "VALUES {1}), "
+            "track_count AS ("
+            "SELECT p.playlist, "
+            "       pd.track_id, "
+            "       t.itunes_id, "
+            "       t.album_id, "
+            "       t.artist_id, "
+            "       CASE p.metric {3} END AS count "
+            "  FROM {0}.play_daily pd "
+            "  JOIN period p ON (pd.day >= p.period_start "
+            "                    AND pd.day < p.period_end) "
+            "  JOIN {0}.track t ON (t.track_id = pd.track_id) "
+            " WHERE TRUE "
+            "{2}"
+            " GROUP BY p.playlist, p.metric, pd.track_id, t.itunes_id, t.album_id, t.artist_id), "
+            "ranked_track AS ("
+            "SELECT c.playlist, "
+            "       c.track_id, "
+            "       c.itunes_id, "
+            "       c.count, "
+            "       ROW_NUMBER() OVER (PARTITION BY c.playlist, c.album_id "
+            "                          ORDER BY c.count DESC, c.track_id) AS album_rows, "
+            "       ROW_NUMBER() OVER (PARTITION BY c.playlist, c.artist_id "
+            "                          ORDER BY c.count DESC, c.track_id) AS artist_rows "
+            "  FROM track_count c), "
+            "playlist_track AS ("
+            "SELECT r.playlist, "
+            "       r.itunes_id, "
+            "       ROW_NUMBER() OVER (PARTITION BY r.playlist "
+            "                          ORDER BY r.count DESC, r.track_id) AS row_number "
+            "  FROM ranked_track r "
+            "  JOIN period p ON (p.playlist = r.playlist) "
+            " WHERE (p.album_cap IS NULL OR r.album_rows <= p.album_cap) "
+            "   AND (p.artist_cap IS NULL OR r.artist_rows <= p.artist_cap) "
+            "   AND (p.min_count IS NULL OR r.count >= p.min_count)) "
+            "SELECT pt.playlist, "
+            "       pt.itunes_id, "
+            "       pt.row_number "
+            "  FROM playlist_track pt "
+            "  JOIN period p ON (p.playlist = pt.playlist) "
+            " WHERE p.size IS NULL OR pt.row_number <= p.size"
+            .format(schema_name, periods, days,
+                    ' '.join("WHEN {0} THEN {1}".format(get_text_literal(metric), aggregate)
+                             for metric, aggregate in METRICS.items())))
+
+
+def get_date_literal(value, default=None):
+    if value is None:
+        return "'{0}' :: DATE".format(default)
+    return "'{0}' :: DATE".format(value.isoformat())
+
+
+def get_int_literal(value):
+    if value is None:
+        return 'NULL :: INT'
+    return '{0:d} :: INT'.format(value)
+
+
+def get_text_literal(value):
+    return "'{0}' :: TEXT".format(value.replace("'", "''"))
@@ -0,0 +1,340 @@
+import datetime
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+import threading
+
+import instrumentation
+import library_sql
+
+# The tables live in the database file's main schema, which the exporters' queries name in place of a postgres schema
+SCHEMA_NAME = 'main'
+STAGING_TABLE_NAME = 'itunes'
+DEFAULT_SUFFIX = '.db'
+BUSY_TIMEOUT = 30.0
+# UPDATE ... FROM
+MINIMUM_VERSION = (3, 33, 0)
+
+# SQLite types of the postgres types the importer declares columns with. Timestamps, dates and booleans keep their
+# names so they are converted back to Python values when read.
+COLUMN_TYPES = {'text': 'TEXT',
+                'varchar(16)': 'TEXT',
+                'int': 'INTEGER',
+                'int4': 'INTEGER',
+                'bigint': 'INTEGER',
+                'int8': 'INTEGER',
+                'float8': 'REAL',
+                'bytea': 'BLOB',
+                'bool': 'BOOLEAN',
+                'boolean': 'BOOLEAN',
+                'timestamp': 'TIMESTAMP',
+                'date': 'DATE'}
+
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(' '))
+sqlite3.register_adapter(datetime.date, lambda value: value.isoformat())
+sqlite3.register_converter('TIMESTAMP', lambda value: datetime.datetime.fromisoformat(value.decode()))
+sqlite3.register_converter('DATE', lambda value: datetime.date.fromisoformat(value.decode()))
+sqlite3.register_converter('BOOLEAN', lambda value: bool(int(value)))
+
+
+class ConnectionPool:
+    # Stands in for psycopg2's ThreadedConnectionPool. Each thread exporting at the same time gets a connection of its
+    # own, readers never blocking each other or the importer in WAL mode.
+    def __init__(self, database_file, maxconn):
+        self.database_file = database_file
+        self.maxconn = maxconn
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return open_db(self.database_file, check_same_thread=False)
+
+    def putconn(self, conn):
+        conn.rollback()
+        with self.lock:
+            self.idle.append(conn)
+
+    def closeall(self):
+        with self.lock:
+            for conn in self.idle:
+                conn.close()
+            self.idle = []
+
+
+def get_database_file(name):
+    # The database is named like a postgres one, e.g. music, or by the path of its file
+    name = os.path.expanduser(name)
+    if not os.path.splitext(name)[1]:
+        name += DEFAULT_SUFFIX
+    return name
+
+
+def is_sqlite(conn):
+    return isinstance(conn, sqlite3.Connection)
+
+
+def open_db(database_file, check_same_thread=True):
+    if sqlite3.sqlite_version_info < MINIMUM_VERSION:
+        raise RuntimeError("The sqlite backend needs SQLite {0} or later, found {1}"
+                           .format('.'.join(map(str, MINIMUM_VERSION)), sqlite3.sqlite_version))
+    conn = sqlite3.connect(database_file, timeout=BUSY_TIMEOUT, detect_types=sqlite3.PARSE_DECLTYPES,
+                           check_same_thread=check_same_thread, factory=instrumentation.InstrumentedSQLiteConnection)
+    # With a write-ahead log, exports keep reading while an import writes, and commits only need to sync the log
+    cur = conn.cursor()
+    cur.execute("PRAGMA journal_mode = WAL")
+    cur.execute("PRAGMA synchronous = NORMAL")
+    cur.execute("PRAGMA foreign_keys = ON")
+    cur.execute("PRAGMA temp_store = MEMORY")
+    cur.close()
+    return conn
+
+
+def get_column_type(column_type):
+    return COLUMN_TYPES[column_type.lower()]
+
+
+def schema_is_current(db):
+    # The schema's version is kept in the database file's header, so checking it doesn't even touch a table
+    db.execute("PRAGMA user_version")
+    return db.fetchone()[0] >= SCHEMA_MIGRATIONS[-1][0]
+
+
+def migrate_schema(db, track_detail_columns):
+    db.execute("PRAGMA user_version")
+    version = db.fetchone()[0]
+    for migration_version, description, migrate in SCHEMA_MIGRATIONS:
+        if migration_version <= version:
+            continue
+        logging.warning("Migrating database to version %s: %s", migration_version, description)
+        migrate(db, track_detail_columns)
+        db.execute("PRAGMA user_version = {0:d}".format(migration_version))
+
+
+def add_play_index(db, track_detail_columns):
+    db.execute("CREATE INDEX IF NOT EXISTS idx_play_played_at ON play (played_at);")
+
+
+def add_track_indexes(db, track_detail_columns):
+    db.execute("CREATE INDEX IF NOT EXISTS idx_track_album_id ON track (album_id);")
+    db.execute("CREATE INDEX IF NOT EXISTS idx_track_artist_id ON track (artist_id);")
+
+
+def add_play_daily_index(db, track_detail_columns):
+    db.execute("CREATE INDEX IF NOT EXISTS idx_play_daily_day ON play_daily (day);")
+
+
+def create_normalised_tables(db, track_detail_columns):
+    # The same tables as in postgres. Tables keyed on a single lookup column are WITHOUT ROWID, so their rows are
+    # stored in the primary key's b-tree and a lookup by key reads the whole row, like postgres' covering indexes.
+    db.execute("CREATE TABLE IF NOT EXISTS artist ("
+               "artist_id   INTEGER PRIMARY KEY,"
+               "artist_name TEXT NOT NULL,"
+               "CONSTRAINT uk_artist_name UNIQUE (artist_name)"
+               ");")
+
+    db.execute("CREATE TABLE IF NOT EXISTS album ("
+               "album_id  INTEGER PRIMARY KEY,"
+               "album_name TEXT NOT NULL,"
+               "artist_id INTEGER NOT NULL,"
+               "release_year INTEGER,"
+               "CONSTRAINT fk_album_artist_id FOREIGN KEY (artist_id) REFERENCES artist (artist_id),"
+               "CONSTRAINT ck_album_release_year CHECK (release_year BETWEEN 1900 AND 2050),"
+               "CONSTRAINT uk_album_artist UNIQUE (album_name, artist_id)"
+               ");")
+
+    db.execute("CREATE TABLE IF NOT EXISTS track ("
+               "track_id INTEGER PRIMARY KEY, "
+               "track_name TEXT NOT NULL, "
+               "length INTEGER NOT NULL, "
+               "album_id INTEGER NOT NULL, "
+               "artist_id INTEGER NOT NULL, "
+               "play_count INTEGER NOT NULL, "
+               "last_played TIMESTAMP, "
+               "date_added TIMESTAMP, "
+               "track_number INTEGER NOT NULL, "
+               "bpm INTEGER, "
+               "loved BOOLEAN NOT NULL, "
+               "itunes_id TEXT NOT NULL, "
+               "CONSTRAINT fk_track_artist_id FOREIGN KEY (artist_id) REFERENCES artist (artist_id), "
+               "CONSTRAINT fk_track_album_id FOREIGN KEY (album_id) REFERENCES album (album_id), "
+               "CONSTRAINT ck_track_date_added CHECK (date_added <= CURRENT_TIMESTAMP), "
+               "CONSTRAINT ck_track_play_count CHECK (play_count >= 0), "
+               "CONSTRAINT uk_track_artist_album UNIQUE (track_name, album_id, artist_id, track_number), "
+               "CONSTRAINT uk_track_itunes_id UNIQUE (itunes_id));")
+
+    db.execute("CREATE TABLE IF NOT EXISTS play ("
+               "play_id INTEGER PRIMARY KEY,"
+               "track_id INTEGER,"
+               "played_at TIMESTAMP NOT NULL,"
+               "CONSTRAINT fk_play_track_id FOREIGN KEY (track_id) REFERENCES track (track_id),"
+               "CONSTRAINT uk_play_track_play_at UNIQUE (track_id, played_at)"
+               ");")
+
+    db.execute("CREATE TABLE IF NOT EXISTS track_detail ({0}, "
+               "CONSTRAINT pk_track_detail PRIMARY KEY (itunes_id)"
+               ") WITHOUT ROWID;"
+               .format(', '.join(column + ' ' + get_column_type(column_type)
+                                 for column, column_type in track_detail_columns.values())))
+
+    db.execute("CREATE TABLE IF NOT EXISTS play_daily ("
+               "track_id INTEGER NOT NULL,"
+               "day DATE NOT NULL,"
+               "plays INTEGER NOT NULL,"
+               "CONSTRAINT pk_play_daily PRIMARY KEY (track_id, day),"
+               "CONSTRAINT fk_play_daily_track_id FOREIGN KEY (track_id) REFERENCES track (track_id),"
+               "CONSTRAINT ck_play_daily_plays CHECK (plays > 0)"
+               ") WITHOUT ROWID;")
+
+    db.execute("CREATE TABLE IF NOT EXISTS play_watermark ("
+               "track_id INTEGER PRIMARY KEY,"
+               "played_at TIMESTAMP NOT NULL,"
+               "CONSTRAINT fk_play_watermark_track_id FOREIGN KEY (track_id) REFERENCES track (track_id)"
+               ");")
+
+    db.execute("CREATE TABLE IF NOT EXISTS track_fingerprint ("
+               "itunes_id TEXT NOT NULL,"
+               "fingerprint TEXT NOT NULL,"
+               "CONSTRAINT pk_track_fingerprint PRIMARY KEY (itunes_id)"
+               ") WITHOUT ROWID;")
+
+
+def track_details_exist(db):
+    db.execute("SELECT EXISTS (SELECT 1 FROM track_detail)")
+    return bool(db.fetchone()[0])
+
+
+def fetch_track_fingerprints(db):
+    db.execute("SELECT itunes_id, fingerprint FROM track_fingerprint")
+    return dict(db.fetchall())
+
+
+def stage_tracks(db, tracks, column_types, batch_size):
+    # Only the columns normalisation and the exporters read are staged, each batch bound to one prepared INSERT. The
+    # staging table is TEMP, so it lives in memory and never reaches the database file.
+    db.execute("DROP TABLE IF EXISTS temp.{0}".format(STAGING_TABLE_NAME))
+    db.execute("CREATE TEMP TABLE {0} ({1})"
+               .format(STAGING_TABLE_NAME,
+                       ', '.join(key + ' ' + get_column_type(column_type) for key, column_type in column_types.items())))
+    insert = ("INSERT INTO temp.{0} ({1}) VALUES ({2})"
+              .format(STAGING_TABLE_NAME, ', '.join(column_types), ', '.join('?' * len(column_types))))
+
+    staged = 0
+    iterator = iter(tracks)
+    batch = list(itertools.islice(iterator, batch_size))
+    while batch:
+        db.executemany(insert, [[track.get(key) for key in column_types] for track in batch])
+        staged += len(batch)
+        batch = list(itertools.islice(iterator, batch_size))
+
+    db.execute("CREATE UNIQUE INDEX temp.idx_itunes_itunes_id ON {0} (persistent_id);".format(STAGING_TABLE_NAME))
+    return staged
+
+
+def normalise_data(db, track_detail_columns, fingerprint_column):
+    source_table = library_sql.SQLITE.temp_schema + '.' + STAGING_TABLE_NAME
+
+    library_sql.insert_artists_and_albums(db, SCHEMA_NAME, source_table)
+    library_sql.merge_tracks(db, library_sql.SQLITE, SCHEMA_NAME, source_table)
+    ingest_plays(db, source_table)
+    library_sql.update_track_details(db, SCHEMA_NAME, source_table, track_detail_columns)
+    library_sql.update_track_fingerprints(db, SCHEMA_NAME, source_table, fingerprint_column)
+
+
+def ingest_plays(db, source_table):
+    # SQLite has no data-modifying CTEs, so the new plays postgres gets back from its INSERT are collected first and
+    # the rollup and watermarks move on from those
+    db.execute("DROP TABLE IF EXISTS temp.new_play")
+    db.execute("CREATE TEMP TABLE new_play AS "
+               "SELECT t.track_id, "
+               "       t.last_played AS played_at "
+               "  FROM track t "
+               "  LEFT JOIN play_watermark w ON (w.track_id = t.track_id) "
+               " WHERE t.last_played IS NOT NULL "
+               "   AND t.itunes_id IN (SELECT persistent_id FROM {0}) "
+               "   AND (w.played_at IS NULL OR t.last_played > w.played_at) "
+               "   AND NOT EXISTS (SELECT 1 "
+               "                     FROM play p "
+               "                    WHERE p.track_id = t.track_id "
+               "                      AND p.played_at = t.last_played);"
+               .format(source_table))
+
+    db.execute("INSERT INTO play (track_id, played_at) "
+               "SELECT track_id, "
+               "       played_at "
+               "  FROM new_play;")
+    played = db.rowcount
+
+    db.execute("INSERT INTO play_daily (track_id, day, plays) "
+               "SELECT track_id, "
+               "       date(played_at), "
+               "       COUNT(*) "
+               "  FROM new_play "
+               " WHERE TRUE "
+               " GROUP BY track_id, date(played_at) "
+               "    ON CONFLICT (track_id, day) "
+               "    DO UPDATE SET plays = play_daily.plays + excluded.plays;")
+
+    db.execute("INSERT INTO play_watermark (track_id, played_at) "
+               "SELECT track_id, "
+               "       MAX(played_at) "
+               "  FROM new_play "
+               " WHERE TRUE "
+               " GROUP BY track_id "
+               "    ON CONFLICT (track_id) "
+               "    DO UPDATE SET played_at = MAX(play_watermark.played_at, excluded.played_at);")
+
+    logging.warning("Plays ingested for %s tracks", played)
+    return played
+
+
+def rebuild_play_daily(db):
+    db.execute("DELETE FROM play_daily")
+    db.execute("INSERT INTO play_daily (track_id, day, plays) "
+               "SELECT track_id, "
+               "       date(played_at), "
+               "       COUNT(*) "
+               "  FROM play "
+               " GROUP BY track_id, date(played_at);")
+
+
+def fetch_rows(conn, query, itersize):
+    # SQLite steps through the result as it is read, so rows are never all held in memory at once either
+    cur = conn.cursor()
+    cur.arraysize = itersize
+    try:
+        cur.execute(query)
+        yield from cur
+    finally:
+        cur.close()
+
+
+def get_playlist_source(conn, view_name, schema_name=SCHEMA_NAME):
+    # There are no materialized playlists, views are always read directly
+    return view_name
+
+
+def fetch_playlist_fingerprint(conn, view_name):
+    # SQLite has no md5, so the same digest postgres computes is built up here from the view's ordered rows
+    digest = hashlib.md5()
+    count = 0
+    for itunes_id, row_number in fetch_rows(conn,
+                                            "SELECT itunes_id, row_number "
+                                            "  FROM {0} "
+                                            " ORDER BY row_number, itunes_id"
+                                            .format(view_name),
+                                            1000):
+        digest.update('{0}{1}:{2}'.format(',' if count else '', itunes_id, row_number).encode('utf-8'))
+        count += 1
+    return digest.hexdigest(), count
+
+
+# The same migrations as the postgres schema's, numbered alike, bar the ones that don't apply
+SCHEMA_MIGRATIONS = [(1, 'create normalised tables', create_normalised_tables),
+                     (2, 'index plays by played_at', add_play_index),
+                     (3, 'index tracks by album and artist', add_track_indexes),
+                     (5, 'index daily plays by day', add_play_daily_index)]
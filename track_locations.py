@@ -0,0 +1,134 @@
+import collections
+import concurrent.futures
+import itertools
+import json
+import logging
+import os
+import pickle
+import threading
+from urllib.parse import quote, unquote
+
+import instrumentation
+
+DEFAULT_WORKERS = 16
+DEFAULT_CHUNK_SIZE = 2000
+DEFAULT_CACHE_FILE_LOCATION = os.path.expanduser('~/.cache/smarter-playlists/locations.pickle')
+MISSING_TRACKS_LOGGED = 5
+
+
+class LocationResolver:
+    # Turns the file:// locations of tracks into the paths playlists refer to them by, replacing the longest matching
+    # prefix from the relocation table, e.g. the iTunes media folder with where it is mounted on another machine.
+    # With check_files, paths are also checked to exist, many at once on a pool of threads since stat calls on network
+    # and USB storage are slow one at a time. Tracks found are cached by itunes_id alongside the mtime of their
+    # directory, which changes whenever a file in it is added, removed or renamed, so a track found before only costs
+    # a stat of its directory, shared with the other tracks in it.
+    def __init__(self, relocations=(), check_files=False, workers=DEFAULT_WORKERS, cache=None):
+        self.relocations = sorted(relocations, key=lambda relocation: len(relocation[0]), reverse=True)
+        self.check_files = check_files
+        self.workers = workers
+        self.cache = cache if cache is not None else {}
+        self.directory_mtimes = {}
+        self.missing = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def relocate(self, location):
+        path = unquote(location).replace("file://", "")
+        for prefix, replacement in self.relocations:
+            if path.startswith(prefix):
+                return replacement + path[len(prefix):]
+        return path
+
+    def resolve(self, playlist_name, rows, columns, chunk_size=DEFAULT_CHUNK_SIZE):
+        # Yields each row of the given columns with its track's path, which is None if the track has no location or
+        # its file is missing. Rows are resolved a chunk at a time as they arrive, and missing tracks are kept to be
+        # reported in bulk.
+        location_index = columns.index('location')
+        id_index = columns.index('a.itunes_id')
+        with self.lock:
+            missing = self.missing.setdefault(playlist_name, [])
+        rows = iter(rows)
+        for chunk in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+            paths = [self.relocate(row[location_index]) if row[location_index] is not None else None
+                     for row in chunk]
+            if self.check_files:
+                with instrumentation.phase(playlist_name + ': check files') as counts:
+                    paths = self.check_paths([row[id_index] for row in chunk], paths)
+                    counts['rows'] = len(chunk)
+            for row, path in zip(chunk, paths):
+                if path is None:
+                    missing.append(collections.OrderedDict((column.split('.')[-1], row[columns.index(column)])
+                                                           for column in ('a.itunes_id', 'name', 'artist',
+                                                                          'location')))
+                yield row, path
+
+    def check_paths(self, itunes_ids, paths):
+        # Directories are stat'ed once per run. Files are only stat'ed if their directory exists and has changed since
+        # their track was last found in it.
+        with self.lock:
+            directories = set(os.path.dirname(path) for path in paths if path is not None) - set(self.directory_mtimes)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            directory_mtimes = dict(zip(directories, executor.map(get_mtime, directories)))
+            with self.lock:
+                self.directory_mtimes.update(directory_mtimes)
+                entries = [(path, self.directory_mtimes[os.path.dirname(path)]) if path is not None else None
+                           for path in paths]
+                unchecked = [entry[0] for itunes_id, entry in zip(itunes_ids, entries)
+                             if entry is not None and entry[1] is not None and self.cache.get(itunes_id) != entry]
+            found = dict(zip(unchecked, executor.map(os.path.isfile, unchecked)))
+
+        checked = []
+        with self.lock:
+            for itunes_id, entry in zip(itunes_ids, entries):
+                if entry is None or entry[1] is None or not found.get(entry[0], True):
+                    checked.append(None)
+                    continue
+                self.cache[itunes_id] = entry
+                checked.append(entry[0])
+        return checked
+
+    def log_missing(self, playlist_name):
+        missing = self.missing.get(playlist_name)
+        if not missing:
+            return
+        logging.warning("%s tracks of %s have no file: %s%s", len(missing), playlist_name,
+                        ", ".join("{0} by {1}".format(track['name'], track['artist'])
+                                  for track in missing[:MISSING_TRACKS_LOGGED]),
+                        ", ..." if len(missing) > MISSING_TRACKS_LOGGED else "")
+
+    def write_report(self, report_file):
+        # Every missing track of every playlist exported, by playlist
+        with open(report_file, 'w') as fp:
+            json.dump(collections.OrderedDict((playlist_name, missing)
+                                              for playlist_name, missing in self.missing.items() if missing),
+                      fp, indent=2)
+            fp.write('\n')
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def get_location(location, path):
+    # The file:// location of a relocated path, the original location being kept as it was if it wasn't relocated
+    if path == unquote(location).replace("file://", ""):
+        return location
+    return 'file://' + quote(path)
+
+
+def read_cache(cache_file):
+    try:
+        with open(cache_file, 'rb') as fp:
+            return pickle.load(fp)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+
+
+def write_cache(cache, cache_file):
+    os.makedirs(os.path.dirname(cache_file) or '.', exist_ok=True)
+    with open(cache_file + '.tmp', 'wb') as fp:
+        pickle.dump(cache, fp, pickle.HIGHEST_PROTOCOL)
+    os.replace(cache_file + '.tmp', cache_file)
@@ -9,8 +9,25 @@ if [ -z "$2" ]
     echo "No view name supplied"
 fi
 
+# The playlist is only re-imported into iTunes if its tracks changed since it was last exported, which the exporter
+# signals by exiting with status 3. Their fingerprint is only recorded once the import succeeded, so a failed one is
+# retried on the next run.
+status=0
+/usr/local/bin/python3 /Users/stephan/Development/smarter-playlists/export-to-playlist.py -n "$1" -v $2 -p 4359 --skip-unchanged --defer-fingerprint --no-open || status=$?
+if [ $status -eq 3 ]
+  then
+    exit 0
+fi
+if [ $status -ne 0 ]
+  then
+    exit $status
+fi
+
 /usr/bin/osascript /Users/stephan/Development/smarter-playlists/applescript/delete-playlist-tracks.scpt "$1"
 
-/usr/local/bin/python3 /Users/stephan/Development/smarter-playlists/export-to-playlist.py -n "$1" -v $2 -p 4359
+/usr/bin/open "$1.m3u8"
+rm "$1.m3u8"
+
+/usr/local/bin/python3 /Users/stephan/Development/smarter-playlists/export-to-playlist.py -n "$1" -v $2 -p 4359 --record-fingerprint
 
 /usr/bin/osascript /Users/stephan/Development/smarter-playlists/applescript/pause.scpt
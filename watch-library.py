@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+import argparse
+import ctypes
+import ctypes.util
+import importlib
+import json
+import logging
+import os
+import select
+import shlex
+import struct
+import sys
+import time
+
+# Only needed for the postgres backend
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+import playlist_rules
+import sqlite_backend
+import track_locations
+
+import_to_postgres = importlib.import_module('import-to-postgres')
+export_to_playlist = importlib.import_module('export-to-playlist')
+
+DEFAULT_DEBOUNCE = 5.0
+DEFAULT_POLL_INTERVAL = 2.0
+RETRY_INTERVAL = 60.0
+
+# From <sys/inotify.h>. The library file is watched through its directory, as iTunes saves it by writing a new file
+# and renaming it over the old one.
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    def __init__(self, file_name):
+        self.directory, self.name = os.path.split(os.path.abspath(file_name))
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0 or libc.inotify_add_watch(self.fd, os.fsencode(self.directory),
+                                                 IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+    def wait(self, timeout=None):
+        # Returns whether the library file changed within the timeout, or ever if there is none
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            if self.read_events():
+                return True
+
+    def read_events(self):
+        data = os.read(self.fd, 64 * 1024)
+        changed = False
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            changed = changed or name == self.name or bool(mask & IN_Q_OVERFLOW)
+        return changed
+
+
+class PollingWatcher:
+    def __init__(self, file_name, interval=DEFAULT_POLL_INTERVAL):
+        self.file_name = file_name
+        self.interval = interval
+        self.state = get_file_state(file_name)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = get_file_state(self.file_name)
+            if state != self.state:
+                self.state = state
+                return True
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.interval, remaining))
+
+
+def main(arg_list=None):
+    args = parse_args(arg_list)
+
+    # Every import is a delta import, skipped altogether if the library file's contents didn't actually change
+    import_args = import_to_postgres.parse_args(['--library', args.library_file,
+                                                 '--backend', args.backend,
+                                                 '--db', args.database_name,
+                                                 '--port', str(args.port),
+                                                 '--schema', args.schema_name,
+                                                 '--user', args.username,
+                                                 '--pass', args.password,
+                                                 '--delta',
+                                                 '--skip-if-unchanged'] + shlex.split(args.import_args))
+
+    watcher = open_watcher(args.library_file, args.poll, args.poll_interval)
+    logging.warning("Watching library file at location %s for changes", args.library_file)
+
+    conn = None
+    export_pool = None
+    # Changes made while not running are picked up by importing straight away. The playlists are exported straight
+    # away too, in case the last export before stopping failed, which is cheap as unchanged playlists are skipped.
+    changed = True
+    export_pending = args.manifest_file is not None
+    try:
+        while True:
+            if not changed:
+                changed = watcher.wait()
+                continue
+
+            # Saving the library can take several writes, which are only imported once they have settled down
+            while watcher.wait(args.debounce):
+                pass
+            changed = False
+
+            try:
+                if conn is None:
+                    conn, _ = import_to_postgres.open_db(args.database_name, args.port, args.username,
+                                                         args.password, args.backend)
+                start = time.perf_counter()
+                changed_tracks = import_to_postgres.import_library(import_args, conn)
+                # Playlists can only have changed if tracks did, or if exporting them failed since. A retried import
+                # is skipped once the library file has been imported, so a failed export is retried on its own.
+                if changed_tracks and args.manifest_file is not None:
+                    export_pending = True
+                if export_pending:
+                    manifest = read_manifest(args.manifest_file)
+                    # The export pool is kept open between imports, sized for the workers of the first batch exported
+                    if export_pool is None:
+                        export_pool = export_to_playlist.open_pool(args.database_name, args.port, args.username,
+                                                                   args.password, get_export_workers(manifest),
+                                                                   args.backend)
+                    export_playlists(args, manifest, export_pool)
+                    export_pending = False
+                if changed_tracks:
+                    logging.warning("Library synced in %.3fs", time.perf_counter() - start)
+            except Exception as e:
+                logging.error("Failed to sync library, retrying in %ss: %s", RETRY_INTERVAL, e)
+                # An import that failed part way may have changed tracks already, which its retry won't report
+                export_pending = args.manifest_file is not None
+                conn = reset_connection(conn)
+                if export_pool is not None:
+                    export_pool.closeall()
+                    export_pool = None
+                # Tried again as soon as the library changes, or after a while regardless
+                watcher.wait(RETRY_INTERVAL)
+                changed = True
+    except KeyboardInterrupt:
+        logging.warning("Stopped watching library file")
+    finally:
+        if conn is not None:
+            conn.close()
+        if export_pool is not None:
+            export_pool.closeall()
+
+
+def parse_args(arg_list):
+    parser = argparse.ArgumentParser(description='Import the library file whenever it changes and re-export the '
+                                                 'playlists of a manifest after each import')
+    parser.add_argument('--library',
+                        help='Path to XML library file [%(default)s]',
+                        dest='library_file',
+                        default=import_to_postgres.DEFAULT_LIBRARY_FILE_LOCATION)
+    parser.add_argument('--manifest', '-m',
+                        help='JSON manifest of playlist names and views, or rules, to export after each import, '
+                             'read again each time',
+                        dest='manifest_file')
+    parser.add_argument('--backend',
+                        help='Database to import to and export from, a postgres server or an SQLite database file '
+                             '[%(default)s]',
+                        dest='backend',
+                        choices=['postgres', 'sqlite'],
+                        default=import_to_postgres.DEFAULT_BACKEND)
+    parser.add_argument('--db', '-d',
+                        help='Name of postgres database, or path of the SQLite database file [%(default)s]',
+                        dest='database_name',
+                        default=import_to_postgres.DEFAULT_DATABASE_NAME)
+    parser.add_argument('--port', '-p',
+                        help='Local database port [%(default)s]',
+                        dest='port',
+                        default=import_to_postgres.DEFAULT_PORT)
+    parser.add_argument('--schema', '-s',
+                        help='Name of database schema [%(default)s]',
+                        dest='schema_name',
+                        default=import_to_postgres.DEFAULT_SCHEMA_NAME)
+    parser.add_argument('--user', '-u',
+                        help='Postgres username [%(default)s]',
+                        dest='username',
+                        default=import_to_postgres.DEFAULT_USER_NAME)
+    parser.add_argument('--pass', '-x',
+                        help='Postgres password [%(default)s]',
+                        dest='password',
+                        default=import_to_postgres.DEFAULT_PASSWORD)
+    parser.add_argument('--debounce',
+                        help='Seconds the library file has to go unchanged for before it is imported [%(default)s]',
+                        dest='debounce',
+                        type=float,
+                        default=DEFAULT_DEBOUNCE)
+    parser.add_argument('--poll',
+                        help='Poll the library file for changes instead of using inotify, which is only available '
+                             'on Linux',
+                        dest='poll',
+                        action='store_true')
+    parser.add_argument('--poll-interval',
+                        help='Seconds between checks of the library file when polling [%(default)s]',
+                        dest='poll_interval',
+                        type=float,
+                        default=DEFAULT_POLL_INTERVAL)
+    parser.add_argument('--import-args',
+                        help='Extra arguments passed to every import, e.g. "--workers 4"',
+                        dest='import_args',
+                        default='')
+    args = parser.parse_args(arg_list)
+    return args
+
+
+def open_watcher(file_name, poll=False, poll_interval=DEFAULT_POLL_INTERVAL):
+    if not poll and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(file_name)
+        except (OSError, AttributeError) as e:
+            logging.warning("Unable to watch library file with inotify, polling it instead: %s", e)
+    return PollingWatcher(file_name, poll_interval)
+
+
+def get_file_state(file_name):
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def read_manifest(manifest_file):
+    # Read again for every export, so it can be edited without restarting
+    with open(manifest_file) as fp:
+        return json.load(fp)
+
+
+def get_export_workers(manifest):
+    return manifest.get('workers', export_to_playlist.DEFAULT_WORKERS)
+
+
+def export_playlists(args, manifest, export_pool):
+    # Raises if any playlist failed to export, for the export to be retried
+    playlist_format = manifest.get('format', export_to_playlist.DEFAULT_FORMAT)
+    output_dir = os.path.expanduser(manifest.get('output_dir', export_to_playlist.DEFAULT_OUTPUT_DIR))
+    workers = get_export_workers(manifest)
+    if playlist_format not in export_to_playlist.EXPORTERS:
+        raise ValueError("Unsupported format selected: " + playlist_format)
+
+    schema_name = sqlite_backend.SCHEMA_NAME if args.backend == 'sqlite' else args.schema_name
+    playlists = manifest.get('playlists', {})
+    rules = playlist_rules.load_playlists(manifest.get('rules', []))
+    # Rules are ranked by the database as with export-to-playlist.py -m, or by the playlist engine with the sqlite
+    # backend, which has no family SQL
+    engine_cache = None
+    if rules and args.backend == 'sqlite':
+        if export_to_playlist.playlist_engine is None:
+            raise ValueError("Playlist rules with the sqlite backend need numpy, which is not installed")
+        engine_cache = export_to_playlist.DEFAULT_ENGINE_CACHE_FILE_LOCATION
+
+    # Tracks are relocated and checked as the manifest says, with the export script's cache of files found
+    check_files = manifest.get('check_files', False)
+    resolver = track_locations.LocationResolver(
+        manifest.get('relocate', {}).items(), check_files,
+        cache=track_locations.read_cache(track_locations.DEFAULT_CACHE_FILE_LOCATION) if check_files else None)
+
+    # Most imports only change a few playlists, the rest are skipped
+    failed = []
+    if playlists:
+        failed, _ = export_to_playlist.export_batch(args.database_name, args.password, args.port, args.username,
+                                                    playlists, playlist_format, output_dir,
+                                                    min(workers, export_pool.maxconn), schema_name,
+                                                    pool=export_pool, skip_unchanged=True, backend=args.backend,
+                                                    resolver=resolver)
+    if rules:
+        rule_failed, _ = export_to_playlist.export_rules(args.database_name, args.password, args.port, args.username,
+                                                         rules, playlist_format, output_dir, schema_name,
+                                                         skip_unchanged=True, backend=args.backend,
+                                                         engine_cache=engine_cache, resolver=resolver)
+        failed += rule_failed
+    if check_files:
+        track_locations.write_cache(resolver.cache, track_locations.DEFAULT_CACHE_FILE_LOCATION)
+    if failed:
+        raise RuntimeError("Failed to export playlists: " + ", ".join(failed))
+
+
+def reset_connection(conn):
+    # A connection that broke is dropped, to be opened again on the next import
+    if conn is None:
+        return None
+    if sqlite_backend.is_sqlite(conn):
+        conn.rollback()
+        return conn
+    if not conn.closed:
+        try:
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            pass
+    conn.close()
+    return None
+
+
+if __name__ == '__main__':
+    main()